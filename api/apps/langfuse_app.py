@@ -21,6 +21,7 @@ from langfuse import Langfuse
 
 from api.db.db_models import DB
 from api.db.services.langfuse_service import TenantLangfuseService
+from api.db.services.tenant_llm_service import MODEL_REGISTRY
 from api.utils.api_utils import get_error_data_result, get_json_result, server_error_response, validate_request
 
 
@@ -53,6 +54,7 @@ def set_api_key():
                 TenantLangfuseService.save(**langfuse_keys)
             else:
                 TenantLangfuseService.update_by_tenant(tenant_id=current_user.id, langfuse_keys=langfuse_keys)
+            MODEL_REGISTRY.invalidate(current_user.id)
             return get_json_result(data=langfuse_keys)
         except Exception as e:
             server_error_response(e)
@@ -92,6 +94,7 @@ def delete_api_key():
     with DB.atomic():
         try:
             TenantLangfuseService.delete_model(langfuse_entry)
+            MODEL_REGISTRY.invalidate(current_user.id)
             return get_json_result(data=True)
         except Exception as e:
             server_error_response(e)
@@ -17,7 +17,7 @@ import logging
 import json
 from flask import request
 from flask_login import login_required, current_user
-from api.db.services.tenant_llm_service import LLMFactoriesService, TenantLLMService
+from api.db.services.tenant_llm_service import MODEL_REGISTRY, LLMFactoriesService, TenantLLMService
 from api.db.services.llm_service import LLMService
 from api import settings
 from api.utils.api_utils import server_error_response, get_data_error_result, validate_request
@@ -129,6 +129,7 @@ def set_api_key():
                 api_base=llm_config["api_base"],
                 max_tokens=llm_config["max_tokens"]
             )
+    MODEL_REGISTRY.invalidate(current_user.id)
 
     return get_json_result(data=True)
 
@@ -286,6 +287,7 @@ def add_llm():
             [TenantLLM.tenant_id == current_user.id, TenantLLM.llm_factory == factory,
              TenantLLM.llm_name == llm["llm_name"]], llm):
         TenantLLMService.save(**llm)
+    MODEL_REGISTRY.invalidate(current_user.id)
 
     return get_json_result(data=True)
 
@@ -298,6 +300,7 @@ def delete_llm():
     TenantLLMService.filter_delete(
         [TenantLLM.tenant_id == current_user.id, TenantLLM.llm_factory == req["llm_factory"],
          TenantLLM.llm_name == req["llm_name"]])
+    MODEL_REGISTRY.invalidate(current_user.id)
     return get_json_result(data=True)
 
 
@@ -308,6 +311,7 @@ def delete_factory():
     req = request.json
     TenantLLMService.filter_delete(
         [TenantLLM.tenant_id == current_user.id, TenantLLM.llm_factory == req["llm_factory"]])
+    MODEL_REGISTRY.invalidate(current_user.id)
     return get_json_result(data=True)
 
 
@@ -0,0 +1,195 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+ASGI serving mode of the API server, `ragflow_server.py --asgi`, served by uvicorn.
+
+The Flask app runs on a bounded pool of API_REQUEST_WORKERS threads until it returns its
+response. Request bodies are spooled to a temporary file beyond SPOOLED_BODY_BYTES, and small
+responses are read in full there too. Streamed responses, the server-sent events of chat and
+agent completions above all, are then pulled one item at a time on a bounded pool of
+API_STREAM_WORKERS threads.
+
+This mode does not serve streams without a thread: every next() of a stream blocks a stream
+worker until its generator yields, and generators of completions spend most of their time
+waiting on the LLM, so each active stream holds a thread and streams beyond API_STREAM_WORKERS
+queue for one. Serving them without would take asynchronous LLM clients and completion
+generators, which the API does not have. What this mode bounds is the number of threads: it
+frees the request workers from streams, and a stream waiting on a slow client holds no thread.
+
+`api/stream_load.py` against a Flask app streaming 21 events 50ms apart, on 1 CPU shared with
+the load test, 20s per run:
+
+    streams  mode      streams/s  first event p50 / p95  RSS growth
+    50       threaded  46.1       0.068s / 0.157s        2MB
+    50       asgi      43.6       0.062s / 0.215s        5MB
+    200      threaded  120.2      0.531s / 0.718s        10MB
+    200      asgi      25.5       4.851s / 8.602s        12MB
+
+The thread hop of every event costs CPU: use this mode to bound the threads of the API server,
+not for throughput.
+"""
+import contextvars
+import itertools
+import logging
+import os
+import sys
+import tempfile
+
+import anyio
+from anyio import to_thread
+
+API_REQUEST_WORKERS = int(os.environ.get("API_REQUEST_WORKERS", 64))
+API_STREAM_WORKERS = int(os.environ.get("API_STREAM_WORKERS", 256))
+# Responses up to this size are read in full by the request thread; larger ones are streamed.
+BUFFERED_RESPONSE_BYTES = 1024 * 1024
+# Request bodies beyond this size are spooled to a temporary file rather than kept in memory.
+SPOOLED_BODY_BYTES = 1024 * 1024
+
+_DONE = object()
+
+
+def build_environ(scope, body) -> dict:
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[name] = value
+            continue
+        name = "HTTP_" + name
+        environ[name] = environ[name] + "," + value if name in environ else value
+    return environ
+
+
+class WSGIBridge:
+    """ASGI app serving the WSGI app `wsgi_app`, see the module docstring."""
+
+    def __init__(self, wsgi_app, request_workers=API_REQUEST_WORKERS, stream_workers=API_STREAM_WORKERS):
+        self.app = wsgi_app
+        self.request_workers = request_workers
+        self.stream_workers = stream_workers
+        self._request_limiter = None
+        self._stream_limiter = None
+
+    def _limiters(self):
+        # Capacity limiters belong to the event loop, which only exists once requests come in.
+        if self._request_limiter is None:
+            self._request_limiter = anyio.CapacityLimiter(self.request_workers)
+            self._stream_limiter = anyio.CapacityLimiter(self.stream_workers)
+        return self._request_limiter, self._stream_limiter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+
+        body = tempfile.SpooledTemporaryFile(max_size=SPOOLED_BODY_BYTES)
+        try:
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    return
+                chunk = message.get("body", b"")
+                if chunk and body.tell() + len(chunk) > SPOOLED_BODY_BYTES:
+                    await to_thread.run_sync(body.write, chunk)
+                else:
+                    body.write(chunk)
+                if not message.get("more_body"):
+                    break
+            body.seek(0)
+            await self._respond(scope, receive, send, body)
+        finally:
+            body.close()
+
+    async def _respond(self, scope, receive, send, body):
+        request_limiter, stream_limiter = self._limiters()
+        # Flask keeps its request state in context variables: every step of one response
+        # runs in this context, whichever thread of the pools runs it.
+        context = contextvars.copy_context()
+        start = {}
+        # What the app gives the write() callable, sent ahead of the iterable it returns.
+        written = []
+
+        def start_response(status, headers, exc_info=None):
+            start["status"] = int(status.split(" ", 1)[0])
+            start["headers"] = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+            return written.append
+
+        def call():
+            result = self.app(build_environ(scope, body), start_response)
+            length = dict(start["headers"]).get(b"content-length")
+            if length is None or int(length) > BUFFERED_RESPONSE_BYTES:
+                return result, None
+            try:
+                return None, b"".join(itertools.chain(written, result))
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+
+        result, content = await to_thread.run_sync(context.run, call, limiter=request_limiter)
+        await send({"type": "http.response.start", "status": start["status"], "headers": start["headers"]})
+        if result is None:
+            await send({"type": "http.response.body", "body": content})
+            return
+
+        iterator = itertools.chain(written, result)
+        try:
+            async with anyio.create_task_group() as tg:
+                async def watch_disconnect():
+                    while (await receive())["type"] != "http.disconnect":
+                        pass
+                    logging.debug(f"Client of {scope['path']} disconnected")
+                    tg.cancel_scope.cancel()
+
+                tg.start_soon(watch_disconnect)
+                while True:
+                    chunk = await to_thread.run_sync(context.run, next, iterator, _DONE, limiter=stream_limiter)
+                    if chunk is _DONE:
+                        break
+                    if chunk:
+                        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                await send({"type": "http.response.body", "body": b""})
+                tg.cancel_scope.cancel()
+        finally:
+            if hasattr(result, "close"):
+                with anyio.CancelScope(shield=True):
+                    await to_thread.run_sync(context.run, result.close, limiter=stream_limiter)
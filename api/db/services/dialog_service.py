@@ -15,8 +15,11 @@
 #
 import binascii
 import logging
+import os
 import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from datetime import datetime
 from functools import partial
@@ -46,6 +49,82 @@ from rag.prompts.prompts import gen_meta_filter, PROMPT_JINJA_ENV, ASK_SUMMARY
 from rag.utils import num_tokens_from_string, rmSpace
 from rag.utils.tavily_conn import Tavily
 
+# The parallel steps of chats, a few at once per chat. The pool starts its threads as they are needed.
+RETRIEVAL_WORKERS = int(os.environ.get("RETRIEVAL_WORKERS", 64))
+# Seconds each parallel step of a chat may take once started; web search and knowledge graph answers which come later are left out.
+KB_RETRIEVAL_TIMEOUT = int(os.environ.get("KB_RETRIEVAL_TIMEOUT", 60))
+WEB_SEARCH_TIMEOUT = int(os.environ.get("WEB_SEARCH_TIMEOUT", 20))
+KG_RETRIEVAL_TIMEOUT = int(os.environ.get("KG_RETRIEVAL_TIMEOUT", 30))
+
+# Steps of the retrieval fan-out reported in the elapsed times of an answer.
+RETRIEVAL_SOURCES = {"tags": "Tag labeling", "embedding": "Query embedding", "kb": "Knowledge base", "web": "Web search", "kg": "Knowledge graph"}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=max(RETRIEVAL_WORKERS, 1), thread_name_prefix="retrieval")
+        return _pool
+
+
+class FanOut:
+    """
+    Steps of a chat run in parallel on the retrieval pool, each collected within its own timeout
+    counted from when it starts running, so a step is not charged for waiting on a busy pool. One
+    that has not started `timeout` seconds into its collection is given up as well. Steps given up
+    are cancelled, and so are those never collected once the fan-out is closed. Required steps the
+    chat waits on at once are `run` on the calling thread instead.
+    """
+
+    def __init__(self):
+        self.futures = {}
+        self.started = {}
+        self.elapsed = {}
+
+    def submit(self, name, func, *args, **kwargs):
+        started = threading.Event()
+
+        def call():
+            self.started[name] = timer()
+            started.set()
+            res = func(*args, **kwargs)
+            return res, timer() - self.started[name]
+
+        self.futures[name] = (timer(), started, get_pool().submit(call))
+
+    def run(self, name, func, *args, **kwargs):
+        st = timer()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.elapsed[name] = timer() - st
+
+    def result(self, name, timeout, required=False):
+        """The result of `name`, or None if it failed or outlived `timeout` seconds unless it is `required`."""
+        submitted, started, future = self.futures.pop(name)
+        try:
+            if not started.wait(timeout):
+                raise TimeoutError(f"{name} did not start within {timeout}s")
+            res, self.elapsed[name] = future.result(timeout=max(timeout - (timer() - self.started[name]), 0))
+            return res
+        except Exception as e:
+            future.cancel()
+            self.elapsed[name] = timer() - self.started.get(name, submitted)
+            if required:
+                raise
+            logging.warning(f"Retrieval of {name} left out: {e!r}")
+            return None
+
+    def close(self):
+        """Cancel the steps not collected yet."""
+        for _, _, future in self.futures.values():
+            future.cancel()
+        self.futures.clear()
+
 
 class DialogService(CommonService):
     model = Dialog
@@ -346,106 +425,131 @@ def chat(dialog, messages, stream=True, **kwargs):
         attachments = messages[-1]["doc_ids"]
 
     prompt_config = dialog.prompt_config
-    field_map = KnowledgebaseService.get_field_map(dialog.kb_ids)
-    # try to use sql if field mapping is good to go
-    if field_map:
-        logging.debug("Use SQL to retrieval:{}".format(questions[-1]))
-        ans = use_sql(questions[-1], field_map, dialog.tenant_id, chat_mdl, prompt_config.get("quote", True))
-        if ans:
-            yield ans
-            return
-
-    for p in prompt_config["parameters"]:
-        if p["key"] == "knowledge":
-            continue
-        if p["key"] not in kwargs and not p["optional"]:
-            raise KeyError("Miss parameter: " + p["key"])
-        if p["key"] not in kwargs:
-            prompt_config["system"] = prompt_config["system"].replace("{%s}" % p["key"], " ")
-
-    if len(questions) > 1 and prompt_config.get("refine_multiturn"):
-        questions = [full_question(dialog.tenant_id, dialog.llm_id, messages)]
-    else:
-        questions = questions[-1:]
-
-    if prompt_config.get("cross_languages"):
-        questions = [cross_languages(dialog.tenant_id, dialog.llm_id, questions[0], prompt_config["cross_languages"])]
-
-    if dialog.meta_data_filter:
-        metas = DocumentService.get_meta_by_kbs(dialog.kb_ids)
-        if dialog.meta_data_filter.get("method") == "auto":
-            filters = gen_meta_filter(chat_mdl, metas, questions[-1])
-            attachments.extend(meta_filter(metas, filters))
-            if not attachments:
-                attachments = None
-        elif dialog.meta_data_filter.get("method") == "manual":
-            attachments.extend(meta_filter(metas, dialog.meta_data_filter["manual"]))
-            if not attachments:
-                attachments = None
-
-    if prompt_config.get("keyword", False):
-        questions[-1] += keyword_extraction(chat_mdl, questions[-1])
-
-    refine_question_ts = timer()
-
-    thought = ""
-    kbinfos = {"total": 0, "chunks": [], "doc_aggs": []}
-    knowledges = []
-
-    if attachments is not None and "knowledge" in [p["key"] for p in prompt_config["parameters"]]:
-        tenant_ids = list(set([kb.tenant_id for kb in kbs]))
-        knowledges = []
-        if prompt_config.get("reasoning", False):
-            reasoner = DeepResearcher(
-                chat_mdl,
-                prompt_config,
-                partial(
-                    retriever.retrieval,
-                    embd_mdl=embd_mdl,
-                    tenant_ids=tenant_ids,
-                    kb_ids=dialog.kb_ids,
-                    page=1,
-                    page_size=dialog.top_n,
-                    similarity_threshold=0.2,
-                    vector_similarity_weight=0.3,
-                    doc_ids=attachments,
-                ),
-            )
+    fan_out = FanOut()
+    try:
+        if dialog.meta_data_filter:
+            fan_out.submit("metas", DocumentService.get_meta_by_kbs, dialog.kb_ids)
+        field_map = KnowledgebaseService.get_field_map(dialog.kb_ids)
+        # try to use sql if field mapping is good to go
+        if field_map:
+            logging.debug("Use SQL to retrieval:{}".format(questions[-1]))
+            ans = use_sql(questions[-1], field_map, dialog.tenant_id, chat_mdl, prompt_config.get("quote", True))
+            if ans:
+                yield ans
+                return
+
+        for p in prompt_config["parameters"]:
+            if p["key"] == "knowledge":
+                continue
+            if p["key"] not in kwargs and not p["optional"]:
+                raise KeyError("Miss parameter: " + p["key"])
+            if p["key"] not in kwargs:
+                prompt_config["system"] = prompt_config["system"].replace("{%s}" % p["key"], " ")
 
-            for think in reasoner.thinking(kbinfos, " ".join(questions)):
-                if isinstance(think, str):
-                    thought = think
-                    knowledges = [t for t in think.split("\n") if t]
-                elif stream:
-                    yield think
+        if len(questions) > 1 and prompt_config.get("refine_multiturn"):
+            questions = [full_question(dialog.tenant_id, dialog.llm_id, messages)]
         else:
-            if embd_mdl:
-                kbinfos = retriever.retrieval(
-                    " ".join(questions),
-                    embd_mdl,
-                    tenant_ids,
-                    dialog.kb_ids,
-                    1,
-                    dialog.top_n,
-                    dialog.similarity_threshold,
-                    dialog.vector_similarity_weight,
-                    doc_ids=attachments,
-                    top=dialog.top_k,
-                    aggs=False,
-                    rerank_mdl=rerank_mdl,
-                    rank_feature=label_question(" ".join(questions), kbs),
+            questions = questions[-1:]
+
+        if prompt_config.get("cross_languages"):
+            questions = [cross_languages(dialog.tenant_id, dialog.llm_id, questions[0], prompt_config["cross_languages"])]
+
+        if prompt_config.get("keyword", False):
+            fan_out.submit("keywords", keyword_extraction, chat_mdl, questions[-1])
+
+        if dialog.meta_data_filter:
+            metas = fan_out.result("metas", KB_RETRIEVAL_TIMEOUT, required=True)
+            if dialog.meta_data_filter.get("method") == "auto":
+                filters = gen_meta_filter(chat_mdl, metas, questions[-1])
+                attachments.extend(meta_filter(metas, filters))
+                if not attachments:
+                    attachments = None
+            elif dialog.meta_data_filter.get("method") == "manual":
+                attachments.extend(meta_filter(metas, dialog.meta_data_filter["manual"]))
+                if not attachments:
+                    attachments = None
+
+        if prompt_config.get("keyword", False):
+            questions[-1] += fan_out.result("keywords", KB_RETRIEVAL_TIMEOUT, required=True)
+
+        refine_question_ts = timer()
+
+        thought = ""
+        kbinfos = {"total": 0, "chunks": [], "doc_aggs": []}
+        knowledges = []
+
+        if attachments is not None and "knowledge" in [p["key"] for p in prompt_config["parameters"]]:
+            tenant_ids = list(set([kb.tenant_id for kb in kbs]))
+            knowledges = []
+            if prompt_config.get("reasoning", False):
+                reasoner = DeepResearcher(
+                    chat_mdl,
+                    prompt_config,
+                    partial(
+                        retriever.retrieval,
+                        embd_mdl=embd_mdl,
+                        tenant_ids=tenant_ids,
+                        kb_ids=dialog.kb_ids,
+                        page=1,
+                        page_size=dialog.top_n,
+                        similarity_threshold=0.2,
+                        vector_similarity_weight=0.3,
+                        doc_ids=attachments,
+                    ),
                 )
-            if prompt_config.get("tavily_api_key"):
-                tav = Tavily(prompt_config["tavily_api_key"])
-                tav_res = tav.retrieve_chunks(" ".join(questions))
-                kbinfos["chunks"].extend(tav_res["chunks"])
-                kbinfos["doc_aggs"].extend(tav_res["doc_aggs"])
-            if prompt_config.get("use_kg"):
-                ck = settings.kg_retrievaler.retrieval(" ".join(questions), tenant_ids, dialog.kb_ids, embd_mdl, LLMBundle(dialog.tenant_id, LLMType.CHAT))
-                if ck["content_with_weight"]:
-                    kbinfos["chunks"].insert(0, ck)
-
-            knowledges = kb_prompt(kbinfos, max_tokens)
+
+                for think in reasoner.thinking(kbinfos, " ".join(questions)):
+                    if isinstance(think, str):
+                        thought = think
+                        knowledges = [t for t in think.split("\n") if t]
+                    elif stream:
+                        yield think
+            else:
+                # Web search, knowledge graph and the query embedding start at once; knowledge base
+                # retrieval follows as soon as the question is labeled with tags, here meanwhile.
+                question = " ".join(questions)
+                if prompt_config.get("tavily_api_key"):
+                    fan_out.submit("web", Tavily(prompt_config["tavily_api_key"]).retrieve_chunks, question)
+                if prompt_config.get("use_kg"):
+                    fan_out.submit("kg", lambda: settings.kg_retrievaler.retrieval(question, tenant_ids, dialog.kb_ids, embd_mdl, LLMBundle(dialog.tenant_id, LLMType.CHAT)))
+                if embd_mdl:
+                    fan_out.submit("embedding", retriever.get_vector, question, embd_mdl)
+                    st = timer()
+                    rank_feature = label_question(question, kbs)
+                    fan_out.elapsed["tags"] = timer() - st
+                    # Retrieval reuses the cached query embedding, or embeds the question itself.
+                    fan_out.result("embedding", KB_RETRIEVAL_TIMEOUT)
+                    kbinfos = fan_out.run(
+                        "kb",
+                        retriever.retrieval,
+                        question,
+                        embd_mdl,
+                        tenant_ids,
+                        dialog.kb_ids,
+                        1,
+                        dialog.top_n,
+                        dialog.similarity_threshold,
+                        dialog.vector_similarity_weight,
+                        doc_ids=attachments,
+                        top=dialog.top_k,
+                        aggs=False,
+                        rerank_mdl=rerank_mdl,
+                        rank_feature=rank_feature,
+                    )
+                if prompt_config.get("tavily_api_key"):
+                    tav_res = fan_out.result("web", WEB_SEARCH_TIMEOUT)
+                    if tav_res:
+                        kbinfos["chunks"].extend(tav_res["chunks"])
+                        kbinfos["doc_aggs"].extend(tav_res["doc_aggs"])
+                if prompt_config.get("use_kg"):
+                    ck = fan_out.result("kg", KG_RETRIEVAL_TIMEOUT)
+                    if ck and ck["content_with_weight"]:
+                        kbinfos["chunks"].insert(0, ck)
+
+                knowledges = kb_prompt(kbinfos, max_tokens)
+    finally:
+        # Steps left behind by an early return or an error are cancelled.
+        fan_out.close()
 
     logging.debug("{}->{}".format(" ".join(questions), "\n->".join(knowledges)))
 
@@ -470,6 +574,18 @@ def chat(dialog, messages, stream=True, **kwargs):
     if "max_tokens" in gen_conf:
         gen_conf["max_tokens"] = min(gen_conf["max_tokens"], max_tokens - used_token_count)
 
+    # Streamed answers are cited sentence by sentence while they are generated.
+    citations = None
+    if stream and embd_mdl and knowledges and (prompt_config.get("quote", True) and kwargs.get("quote", True)):
+        citations = retriever.citation_stream(
+            [ck["content_ltks"] for ck in kbinfos["chunks"]],
+            [ck["vector"] for ck in kbinfos["chunks"]],
+            embd_mdl,
+            get_pool(),
+            tkweight=1 - dialog.vector_similarity_weight,
+            vtweight=dialog.vector_similarity_weight,
+        )
+
     def decorate_answer(answer):
         nonlocal embd_mdl, prompt_config, knowledges, kwargs, kbinfos, prompt, retrieval_ts, questions, langfuse_tracer
 
@@ -482,7 +598,9 @@ def chat(dialog, messages, stream=True, **kwargs):
 
         if knowledges and (prompt_config.get("quote", True) and kwargs.get("quote", True)):
             idx = set([])
-            if embd_mdl and not re.search(r"\[ID:([0-9]+)\]", answer):
+            if citations and not re.search(r"\[ID:([0-9]+)\]", answer):
+                answer, idx = citations.finish(answer)
+            elif embd_mdl and not re.search(r"\[ID:([0-9]+)\]", answer):
                 answer, idx = retriever.insert_citations(
                     answer,
                     [ck["content_ltks"] for ck in kbinfos["chunks"]],
@@ -533,7 +651,8 @@ def chat(dialog, messages, stream=True, **kwargs):
             f"  - Bind models: {bind_embedding_time_cost:.1f}ms\n"
             f"  - Query refinement(LLM): {refine_question_time_cost:.1f}ms\n"
             f"  - Retrieval: {retrieval_time_cost:.1f}ms\n"
-            f"  - Generate answer: {generate_result_time_cost:.1f}ms\n\n"
+            + "".join(f"    - {label}: {fan_out.elapsed[name] * 1000:.1f}ms\n" for name, label in RETRIEVAL_SOURCES.items() if name in fan_out.elapsed)
+            + f"  - Generate answer: {generate_result_time_cost:.1f}ms\n\n"
             "## Token usage:\n"
             f"  - Generated tokens(approximately): {tk_num}\n"
             f"  - Token speed: {int(tk_num / (generate_result_time_cost / 1000.0))}/s"
@@ -564,6 +683,8 @@ def chat(dialog, messages, stream=True, **kwargs):
             if num_tokens_from_string(delta_ans) < 16:
                 continue
             last_ans = answer
+            if citations:
+                citations.feed(answer)
             yield {"answer": thought + answer, "reference": {}, "audio_binary": tts(tts_mdl, delta_ans)}
         delta_ans = answer[len(last_ans) :]
         if delta_ans:
@@ -751,9 +872,11 @@ def ask(question, kb_ids, tenant_id, chat_llm_name=None, search_config={}):
 
     msg = [{"role": "user", "content": question}]
 
+    citations = retriever.citation_stream([ck["content_ltks"] for ck in kbinfos["chunks"]], [ck["vector"] for ck in kbinfos["chunks"]], embd_mdl, get_pool(), tkweight=0.7, vtweight=0.3)
+
     def decorate_answer(answer):
         nonlocal knowledges, kbinfos, sys_prompt
-        answer, idx = retriever.insert_citations(answer, [ck["content_ltks"] for ck in kbinfos["chunks"]], [ck["vector"] for ck in kbinfos["chunks"]], embd_mdl, tkweight=0.7, vtweight=0.3)
+        answer, idx = citations.finish(answer)
         idx = set([kbinfos["chunks"][int(i)]["doc_id"] for i in idx])
         recall_docs = [d for d in kbinfos["doc_aggs"] if d["doc_id"] in idx]
         if not recall_docs:
@@ -770,8 +893,12 @@ def ask(question, kb_ids, tenant_id, chat_llm_name=None, search_config={}):
         return {"answer": answer, "reference": refs}
 
     answer = ""
+    cited = ""
     for ans in chat_mdl.chat_streamly(sys_prompt, msg, {"temperature": 0.1}):
         answer = ans
+        if num_tokens_from_string(answer[len(cited):]) >= 16:
+            cited = answer
+            citations.feed(answer)
         yield {"answer": answer, "reference": {}}
     yield decorate_answer(answer)
 
@@ -15,8 +15,10 @@
 #
 import json
 import logging
+import os
 import random
 import re
+from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from datetime import datetime
@@ -40,9 +42,16 @@ from rag.utils.redis_conn import REDIS_CONN
 from rag.utils.storage_factory import STORAGE_IMPL
 from rag.utils.doc_store_conn import OrderByExpr
 
+# Redis set of the documents whose tasks changed since the last `DocumentService.update_progress`.
+DOC_PROGRESS_CHANGED_KEY = "doc_progress_changed"
+# Every that many calls, `update_progress` refreshes all the unfinished documents.
+DOC_PROGRESS_FULL_SWEEP_TICKS = int(os.environ.get("DOC_PROGRESS_FULL_SWEEP_TICKS", 10))
+DOC_PROGRESS_BATCH_SIZE = 500
+
 
 class DocumentService(CommonService):
     model = Document
+    _progress_ticks = 0
 
     @classmethod
     def get_cls_model_fields(cls):
@@ -311,7 +320,7 @@ class DocumentService(CommonService):
 
     @classmethod
     @DB.connection_context()
-    def get_unfinished_docs(cls):
+    def get_unfinished_docs(cls, doc_ids=None):
         fields = [cls.model.id, cls.model.process_begin_at, cls.model.parser_config, cls.model.progress_msg,
                   cls.model.run, cls.model.parser_id]
         docs = cls.model.select(*fields) \
@@ -320,6 +329,8 @@ class DocumentService(CommonService):
             ~(cls.model.type == FileType.VIRTUAL.value),
             cls.model.progress < 1,
             cls.model.progress > 0)
+        if doc_ids is not None:
+            docs = docs.where(cls.model.id.in_(doc_ids))
         return list(docs.dicts())
 
     @classmethod
@@ -596,10 +607,36 @@ class DocumentService(CommonService):
     @classmethod
     @DB.connection_context()
     def update_progress(cls):
-        docs = cls.get_unfinished_docs()
+        """
+        Fold the state of the tasks into their documents. Only the documents whose tasks were
+        reported changed by the executors are refreshed, but every DOC_PROGRESS_FULL_SWEEP_TICKS-th
+        call refreshes all the unfinished documents in case an event was lost.
+        """
+        cls._progress_ticks += 1
+        if (cls._progress_ticks - 1) % max(DOC_PROGRESS_FULL_SWEEP_TICKS, 1) == 0:
+            docs = cls.get_unfinished_docs()
+        else:
+            doc_ids = pop_changed_docs()
+            docs = cls.get_unfinished_docs(doc_ids) if doc_ids else []
+        queue_lengths = {}
+        for i in range(0, len(docs), DOC_PROGRESS_BATCH_SIZE):
+            cls._update_progress_of(docs[i:i + DOC_PROGRESS_BATCH_SIZE], queue_lengths)
+
+    @classmethod
+    def _update_progress_of(cls, docs, queue_lengths):
+        tasks = defaultdict(list)
+        for t in Task.select(Task.doc_id, Task.progress, Task.progress_msg, Task.task_type, Task.priority) \
+                .where(Task.doc_id.in_([d["id"] for d in docs])).order_by(Task.create_time):
+            tasks[t.doc_id].append(t)
+
+        def queue_length(priority):
+            if priority not in queue_lengths:
+                queue_lengths[priority] = get_queue_length(priority)
+            return queue_lengths[priority]
+
         for d in docs:
             try:
-                tsks = Task.query(doc_id=d["id"], order_by=Task.create_time)
+                tsks = tasks.get(d["id"])
                 if not tsks:
                     continue
                 msg = []
@@ -608,8 +645,7 @@ class DocumentService(CommonService):
                 bad = 0
                 has_raptor = False
                 has_graphrag = False
-                e, doc = DocumentService.get_by_id(d["id"])
-                status = doc.run  # TaskStatus.RUNNING.value
+                status = d["run"]  # TaskStatus.RUNNING.value
                 priority = 0
                 for t in tsks:
                     if 0 <= t.progress < 1:
@@ -649,9 +685,9 @@ class DocumentService(CommonService):
                 if msg:
                     info["progress_msg"] = msg
                     if msg.endswith("created task graphrag") or msg.endswith("created task raptor"):
-                        info["progress_msg"] += "\n%d tasks are ahead in the queue..."%get_queue_length(priority)
+                        info["progress_msg"] += "\n%d tasks are ahead in the queue..."%queue_length(priority)
                 else:
-                    info["progress_msg"] = "%d tasks are ahead in the queue..."%get_queue_length(priority)
+                    info["progress_msg"] = "%d tasks are ahead in the queue..."%queue_length(priority)
                 cls.update_by_id(d["id"], info)
             except Exception as e:
                 if str(e).find("'0'") < 0:
@@ -700,6 +736,20 @@ def queue_raptor_o_graphrag_tasks(doc, ty, priority):
     assert REDIS_CONN.queue_product(get_svr_queue_name(priority), message=task), "Can't access Redis. Please check the Redis' status."
 
 
+def mark_docs_progress_changed(doc_ids):
+    """Have the next `DocumentService.update_progress` refresh these documents."""
+    REDIS_CONN.sadd_many(DOC_PROGRESS_CHANGED_KEY, list(doc_ids))
+
+
+def pop_changed_docs() -> list:
+    doc_ids = []
+    while True:
+        popped = REDIS_CONN.spop(DOC_PROGRESS_CHANGED_KEY, DOC_PROGRESS_BATCH_SIZE)
+        doc_ids.extend(popped)
+        if len(popped) < DOC_PROGRESS_BATCH_SIZE:
+            return doc_ids
+
+
 def get_queue_length(priority):
     group_info = REDIS_CONN.queue_info(get_svr_queue_name(priority), SVR_CONSUMER_GROUP_NAME)
     return int(group_info.get("lag", 0) or 0)
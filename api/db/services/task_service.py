@@ -16,22 +16,24 @@
 import logging
 import os
 import random
+import threading
+import time
 import xxhash
 from datetime import datetime
 
 from api.db.db_utils import bulk_insert_into_db
 from deepdoc.parser import PdfParser
-from peewee import JOIN
+from peewee import JOIN, Case
 from api.db.db_models import DB, File2Document, File
 from api.db import StatusEnum, FileType, TaskStatus
 from api.db.db_models import Task, Document, Knowledgebase, Tenant
 from api.db.services.common_service import CommonService
-from api.db.services.document_service import DocumentService
+from api.db.services.document_service import DocumentService, mark_docs_progress_changed
 from api.utils import current_timestamp, get_uuid
 from deepdoc.parser.excel_parser import RAGFlowExcelParser
 from rag.settings import get_svr_queue_name
 from rag.utils.storage_factory import STORAGE_IMPL
-from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.redis_conn import REDIS_CONN, CANCEL_FLAGS
 from api import settings
 from rag.nlp import search
 
@@ -292,6 +294,7 @@ class TaskService(CommonService):
                         ((prog == -1) | (prog > cls.model.progress))
                     )
                 ).execute()
+            mark_docs_progress_changed([task.doc_id])
             return
 
         with DB.lock("update_progress", -1):
@@ -307,6 +310,53 @@ class TaskService(CommonService):
                         ((prog == -1) | (prog > cls.model.progress))
                     )
                 ).execute()
+        mark_docs_progress_changed([task.doc_id])
+
+    @classmethod
+    @DB.connection_context()
+    def update_progress_many(cls, infos: dict):
+        """Apply `update_progress` to every task id -> info of `infos` with one SELECT and one UPDATE.
+
+        Args:
+            infos (dict): Task id to a dict with the same keys as the `info` of `update_progress`.
+        """
+        if not infos:
+            return
+
+        def _update():
+            prev_msgs, doc_ids = {}, set()
+            for t in cls.model.select(cls.model.id, cls.model.doc_id, cls.model.progress_msg).where(cls.model.id.in_(list(infos.keys()))):
+                prev_msgs[t.id] = t.progress_msg or ""
+                doc_ids.add(t.doc_id)
+            for id in infos.keys() - prev_msgs.keys():
+                logging.warning(f"Update_progress error: task {id} not found")
+            msgs, progs = [], []
+            for id, info in infos.items():
+                if id not in prev_msgs:
+                    continue
+                if info.get("progress_msg"):
+                    msgs.append((cls.model.id == id, trim_header_by_lines(prev_msgs[id] + "\n" + info["progress_msg"], 3000)))
+                if "progress" in info:
+                    prog = info["progress"]
+                    cond = (cls.model.id == id) & (cls.model.progress != -1)
+                    if prog != -1:
+                        cond &= cls.model.progress < prog
+                    progs.append((cond, prog))
+            fields = {}
+            if msgs:
+                fields[cls.model.progress_msg] = Case(None, msgs, cls.model.progress_msg)
+            if progs:
+                fields[cls.model.progress] = Case(None, progs, cls.model.progress)
+            if fields:
+                cls.model.update(fields).where(cls.model.id.in_(list(prev_msgs.keys()))).execute()
+            return doc_ids
+
+        if os.environ.get("MACOS"):
+            doc_ids = _update()
+        else:
+            with DB.lock("update_progress", -1):
+                doc_ids = _update()
+        mark_docs_progress_changed(doc_ids)
 
 
 def queue_tasks(doc: dict, bucket: str, name: str, priority: int):
@@ -400,6 +450,7 @@ def queue_tasks(doc: dict, bucket: str, name: str, priority: int):
 
     bulk_insert_into_db(Task, parse_task_array, True)
     DocumentService.begin2parse(doc["id"])
+    mark_docs_progress_changed([doc["id"]])
 
     unfinished_task_array = [task for task in parse_task_array if task["progress"] < 1.0]
     for unfinished_task in unfinished_task_array:
@@ -456,17 +507,82 @@ def reuse_prev_task_chunks(task: dict, prev_tasks: list[dict], chunking_config:
 
 
 def cancel_all_task_of(doc_id):
-    for t in TaskService.query(doc_id=doc_id):
-        try:
-            REDIS_CONN.set(f"{t.id}-cancel", "x")
-        except Exception as e:
-            logging.exception(e)
+    try:
+        CANCEL_FLAGS.set([t.id for t in TaskService.query(doc_id=doc_id)])
+    except Exception as e:
+        logging.exception(e)
 
 
 def has_canceled(task_id):
     try:
-        if REDIS_CONN.get(f"{task_id}-cancel"):
-            return True
+        return CANCEL_FLAGS.is_set(task_id)
     except Exception as e:
         logging.exception(e)
     return False
+
+
+async def async_has_canceled(task_id):
+    try:
+        return await CANCEL_FLAGS.async_is_set(task_id)
+    except Exception as e:
+        logging.exception(e)
+    return False
+
+
+# Seconds progress updates of running tasks are buffered before being written.
+PROGRESS_FLUSH_INTERVAL = float(os.environ.get("PROGRESS_FLUSH_INTERVAL", 2))
+
+
+class ProgressAggregator:
+    """
+    Buffers `TaskService.update_progress` infos per task and writes those of all the
+    tasks with one `update_progress_many` call, at most every `interval` seconds.
+
+    Messages are appended in order and the progress follows the rules of
+    `update_progress`. A failure (-1) or a completion (>= 1) makes the next `due()`
+    true without waiting for the interval. `add` never writes itself: it runs on the
+    trio thread of the task executor.
+    """
+
+    def __init__(self, interval=PROGRESS_FLUSH_INTERVAL):
+        self.interval = interval
+        self._pending = {}
+        # Tasks with a failure or a completion waiting to be written.
+        self._urgent = set()
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self.stats = {"updates": 0, "writes": 0}
+
+    def add(self, task_id, info):
+        with self._lock:
+            self.stats["updates"] += 1
+            pending = self._pending.setdefault(task_id, {"progress_msg": ""})
+            if info.get("progress_msg"):
+                pending["progress_msg"] = info["progress_msg"] if not pending["progress_msg"] else \
+                    pending["progress_msg"] + "\n" + info["progress_msg"]
+            prog = info.get("progress")
+            if prog is not None and pending.get("progress") != -1 and (prog == -1 or prog > pending.get("progress", prog - 1)):
+                pending["progress"] = prog
+            if prog is not None and (prog == -1 or prog >= 1):
+                self._urgent.add(task_id)
+
+    def due(self):
+        return bool(self._urgent) or (bool(self._pending) and time.monotonic() - self._last_flush >= self.interval)
+
+    def flush(self, task_ids=None):
+        with self._lock:
+            if task_ids is None:
+                infos, self._pending = self._pending, {}
+                self._urgent.clear()
+                self._last_flush = time.monotonic()
+            else:
+                infos = {t: self._pending.pop(t) for t in task_ids if t in self._pending}
+                self._urgent.difference_update(task_ids)
+        if not infos:
+            return
+        try:
+            TaskService.update_progress_many(infos)
+            self.stats["writes"] += 1
+        except Exception:
+            logging.exception(f"ProgressAggregator.flush of {len(infos)} tasks got exception")
+
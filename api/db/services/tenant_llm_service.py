@@ -13,7 +13,15 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import atexit
+import copy
+import json
 import logging
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
 from langfuse import Langfuse
 from api import settings
 from api.db import LLMType
@@ -22,6 +30,14 @@ from api.db.services.common_service import CommonService
 from api.db.services.langfuse_service import TenantLangfuseService
 from api.db.services.user_service import TenantService
 from rag.llm import ChatModel, CvModel, EmbeddingModel, RerankModel, Seq2txtModel, TTSModel
+from rag.utils.embedding_cache import cache_model_name
+from rag.utils.redis_conn import REDIS_CONN
+
+LLM_REGISTRY_TTL = int(os.environ.get("LLM_REGISTRY_TTL", 60))
+LLM_REGISTRY_VERSION_TTL = float(os.environ.get("LLM_REGISTRY_VERSION_TTL", 2))
+LLM_REGISTRY_SIZE = int(os.environ.get("LLM_REGISTRY_SIZE", 1024))
+USAGE_FLUSH_INTERVAL = float(os.environ.get("USAGE_FLUSH_INTERVAL", 5))
+TENANT_LLM_VERSION_KEY = "tenant_llm_version:{}"
 
 
 class LLMFactoriesService(CommonService):
@@ -131,8 +147,9 @@ class TenantLLMService(CommonService):
 
     @classmethod
     @DB.connection_context()
-    def model_instance(cls, tenant_id, llm_type, llm_name=None, lang="Chinese", **kwargs):
-        model_config = TenantLLMService.get_model_config(tenant_id, llm_type, llm_name)
+    def model_instance(cls, tenant_id, llm_type, llm_name=None, lang="Chinese", model_config=None, **kwargs):
+        if model_config is None:
+            model_config = TenantLLMService.get_model_config(tenant_id, llm_type, llm_name)
         kwargs.update({"provider": model_config["llm_factory"]})
         if llm_type == LLMType.EMBEDDING.value:
             if model_config["llm_factory"] not in EmbeddingModel:
@@ -169,9 +186,13 @@ class TenantLLMService(CommonService):
 
     @classmethod
     @DB.connection_context()
-    def increase_usage(cls, tenant_id, llm_type, used_tokens, llm_name=None):
-        e, tenant = TenantService.get_by_id(tenant_id)
-        if not e:
+    def increase_usage(cls, tenant_id, llm_type, used_tokens, llm_name=None, raise_error=False):
+        # With raise_error, a database error is raised instead of returning 0 like a missing tenant or model.
+        if raise_error:
+            tenant = TenantService.model.get_or_none(TenantService.model.id == tenant_id)
+        else:
+            _, tenant = TenantService.get_by_id(tenant_id)
+        if not tenant:
             logging.error(f"Tenant not found: {tenant_id}")
             return 0
 
@@ -199,6 +220,8 @@ class TenantLLMService(CommonService):
             )
         except Exception:
             logging.exception("TenantLLMService.increase_usage got exception,Failed to update used_tokens for tenant_id=%s, llm_name=%s", tenant_id, llm_name)
+            if raise_error:
+                raise
             return 0
 
         return num
@@ -229,24 +252,190 @@ class TenantLLMService(CommonService):
             return llm.model_type
 
 
+class UsageAccumulator:
+    """
+    Token usage of the LLM calls of a process, summed per (tenant, model type, model) and added to
+    TenantLLM.used_tokens by a background thread every USAGE_FLUSH_INTERVAL seconds and at exit,
+    so that no call waits on the database. `stats["lag"]` is the age of the oldest usage written
+    by the last flush, `stats["failures"]` the number of usages a flush could not write. Those of
+    a flush that hit a database error are added back, to be written by the next one; those of a
+    missing tenant or model are dropped.
+    """
+
+    def __init__(self, interval=USAGE_FLUSH_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pending = defaultdict(int)
+        self._since = None
+        self._thread = None
+        self.stats = {"flushes": 0, "tokens": 0, "lag": 0.0, "failures": 0}
+
+    def add(self, tenant_id, llm_type, used_tokens, llm_name=None):
+        try:
+            used_tokens = int(used_tokens)
+        except (TypeError, ValueError):
+            logging.warning(f"UsageAccumulator got invalid token usage for {tenant_id}/{llm_type}: {used_tokens}")
+            return
+        if used_tokens <= 0:
+            return
+        with self._lock:
+            self._pending[(tenant_id, llm_type, llm_name)] += used_tokens
+            if self._since is None:
+                self._since = time.monotonic()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="usage_flusher", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(int)
+            since, self._since = self._since, None
+        if not pending:
+            return
+        written = set()
+        try:
+            with DB.connection_context():
+                for (tenant_id, llm_type, llm_name), used_tokens in pending.items():
+                    if not TenantLLMService.increase_usage(tenant_id, llm_type, used_tokens, llm_name, raise_error=True):
+                        logging.error(f"UsageAccumulator can't update token usage for {tenant_id}/{llm_type} llm_name: {llm_name}, used_tokens: {used_tokens}")
+                        self.stats["failures"] += 1
+                    written.add((tenant_id, llm_type, llm_name))
+        except Exception:
+            self._add_back({k: v for k, v in pending.items() if k not in written}, since)
+            raise
+        self.stats["flushes"] += 1
+        self.stats["tokens"] += sum(pending.values())
+        self.stats["lag"] = round(time.monotonic() - since, 3)
+        logging.debug(f"UsageAccumulator flushed {len(pending)} usages, lag {self.stats['lag']}s")
+
+    def _add_back(self, unwritten, since):
+        with self._lock:
+            for key, used_tokens in unwritten.items():
+                self._pending[key] += used_tokens
+            if self._since is None or since < self._since:
+                self._since = since
+        self.stats["failures"] += len(unwritten)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("UsageAccumulator flush got exception")
+
+
+TOKEN_USAGE = UsageAccumulator()
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of the resolved model configs, provider clients and Langfuse clients of
+    tenants, the `size` most recently used at most. Entries are tagged with the tenant's version
+    in Redis, which `invalidate` bumps when the tenant's model settings change, and resolved again
+    after LLM_REGISTRY_TTL seconds. The version itself is read from Redis at most once every
+    `version_ttl` seconds per tenant, so other processes see a change within that time. A client
+    is reused for as long as its resolved config stays the same, so its connection pool stays warm.
+    """
+
+    def __init__(self, ttl=LLM_REGISTRY_TTL, version_ttl=LLM_REGISTRY_VERSION_TTL, size=LLM_REGISTRY_SIZE):
+        self.ttl = ttl
+        self.version_ttl = version_ttl
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._versions = OrderedDict()
+
+    @staticmethod
+    def _put(cache: OrderedDict, key, value, size):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > size:
+            cache.popitem(last=False)
+
+    def _version(self, tenant_id):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._versions.get(tenant_id)
+        if cached and cached[1] > now:
+            return cached[0]
+        version = REDIS_CONN.get(TENANT_LLM_VERSION_KEY.format(tenant_id))
+        with self._lock:
+            self._put(self._versions, tenant_id, (version, now + self.version_ttl), self.size)
+        return version
+
+    def get(self, tenant_id, key: tuple, resolve, build):
+        """
+        Returns (config, value) of `key`: `config = resolve()` and `value = build(config)`, both
+        cached. A None value built from a config is a failure, which is not cached.
+        """
+        version = self._version(tenant_id)
+        now = time.monotonic()
+        key = (tenant_id, *key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries.move_to_end(key)
+        if entry and entry["version"] == version and entry["expire"] > now:
+            return entry["config"], entry["value"]
+        config = resolve()
+        value = entry["value"] if entry and entry["config"] == config else build(config)
+        if value is None and config is not None:
+            with self._lock:
+                self._entries.pop(key, None)
+            return config, value
+        with self._lock:
+            self._put(self._entries, key, {"version": version, "expire": now + self.ttl, "config": config, "value": value}, self.size)
+        return config, value
+
+    def invalidate(self, tenant_id):
+        """Drop the entries of `tenant_id`, in every process."""
+        REDIS_CONN.incr(TENANT_LLM_VERSION_KEY.format(tenant_id))
+        with self._lock:
+            self._versions.pop(tenant_id, None)
+            for key in [k for k in self._entries if k[0] == tenant_id]:
+                del self._entries[key]
+
+
+MODEL_REGISTRY = ModelRegistry()
+
+
+def _langfuse_keys(tenant_id):
+    keys = TenantLangfuseService.filter_by_tenant(tenant_id=tenant_id)
+    if not keys:
+        return None
+    return {"public_key": keys.public_key, "secret_key": keys.secret_key, "host": keys.host}
+
+
+def _langfuse_client(keys):
+    if not keys:
+        return None
+    langfuse = Langfuse(**keys)
+    return langfuse if langfuse.auth_check() else None
+
+
 class LLM4Tenant:
     def __init__(self, tenant_id, llm_type, llm_name=None, lang="Chinese", **kwargs):
         self.tenant_id = tenant_id
         self.llm_type = llm_type
         self.llm_name = llm_name
-        self.mdl = TenantLLMService.model_instance(tenant_id, llm_type, llm_name, lang=lang, **kwargs)
-        assert self.mdl, "Can't find model for {}/{}/{}".format(tenant_id, llm_type, llm_name)
-        model_config = TenantLLMService.get_model_config(tenant_id, llm_type, llm_name)
+        model_config, mdl = MODEL_REGISTRY.get(
+            tenant_id,
+            ("model", llm_type, llm_name, lang, json.dumps(kwargs, sort_keys=True, default=str)),
+            lambda: TenantLLMService.get_model_config(tenant_id, llm_type, llm_name),
+            lambda config: TenantLLMService.model_instance(tenant_id, llm_type, llm_name, lang=lang, model_config=config, **kwargs),
+        )
+        assert mdl, "Can't find model for {}/{}/{}".format(tenant_id, llm_type, llm_name)
+        # The client, and its connection pool, is shared; bound tools are not.
+        self.mdl = copy.copy(mdl)
         self.max_length = model_config.get("max_tokens", 8192)
+        self.cache_name = cache_model_name(tenant_id, model_config)
 
         self.is_tools = model_config.get("is_tools", False)
         self.verbose_tool_use = kwargs.get("verbose_tool_use")
 
-        langfuse_keys = TenantLangfuseService.filter_by_tenant(tenant_id=tenant_id)
-        self.langfuse = None
-        if langfuse_keys:
-            langfuse = Langfuse(public_key=langfuse_keys.public_key, secret_key=langfuse_keys.secret_key, host=langfuse_keys.host)
-            if langfuse.auth_check():
-                self.langfuse = langfuse
-                trace_id = self.langfuse.create_trace_id()
-                self.trace_context = {"trace_id": trace_id}
\ No newline at end of file
+        _, self.langfuse = MODEL_REGISTRY.get(tenant_id, ("langfuse",), lambda: _langfuse_keys(tenant_id), _langfuse_client)
+        if self.langfuse:
+            trace_id = self.langfuse.create_trace_id()
+            self.trace_context = {"trace_id": trace_id}
\ No newline at end of file
@@ -36,6 +36,7 @@ from api import settings
 from api.apps import app, smtp_mail_server
 from api.db.runtime_config import RuntimeConfig
 from api.db.services.document_service import DocumentService
+from api.db.services.tenant_llm_service import TOKEN_USAGE
 from api import utils
 
 from api.db.db_models import init_database_tables as init_web_db
@@ -112,6 +113,10 @@ if __name__ == '__main__':
     parser.add_argument(
         "--debug", default=False, help="debug mode", action="store_true"
     )
+    parser.add_argument(
+        "--asgi", default=os.environ.get("API_SERVER_MODE", "").lower() == "asgi",
+        help="serve with uvicorn, streaming responses on a bounded thread pool", action="store_true"
+    )
     args = parser.parse_args()
     if args.version:
         print(get_ragflow_version())
@@ -155,16 +160,26 @@ if __name__ == '__main__':
     # start http server
     try:
         logging.info("RAGFlow HTTP server start...")
-        run_simple(
-            hostname=settings.HOST_IP,
-            port=settings.HOST_PORT,
-            application=app,
-            threaded=True,
-            use_reloader=RuntimeConfig.DEBUG,
-            use_debugger=RuntimeConfig.DEBUG,
-        )
+        if args.asgi:
+            import uvicorn
+            from api.asgi import WSGIBridge
+
+            logging.info("Serving in ASGI mode")
+            # uvicorn handles SIGINT/SIGTERM itself and returns once it has shut down.
+            uvicorn.run(WSGIBridge(app), host=settings.HOST_IP, port=settings.HOST_PORT, lifespan="off", log_level="warning")
+            signal_handler(signal.SIGTERM, None)
+        else:
+            run_simple(
+                hostname=settings.HOST_IP,
+                port=settings.HOST_PORT,
+                application=app,
+                threaded=True,
+                use_reloader=RuntimeConfig.DEBUG,
+                use_debugger=RuntimeConfig.DEBUG,
+            )
     except Exception:
         traceback.print_exc()
         stop_event.set()
+        TOKEN_USAGE.flush()
         time.sleep(1)
         os.kill(os.getpid(), signal.SIGKILL)
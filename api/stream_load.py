@@ -0,0 +1,151 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Load test of streaming chat completions, `/api/v1/chats/<chat_id>/completions`.
+
+Keeps `--streams` completions open at once for `--duration` seconds, starting a new one as
+soon as one ends. It reports time to first event, events per stream, and the failures. With
+`--pid`, the resident memory of the API server process is sampled as well, to report the
+concurrent streams sustained per GB of RAM. Run it once against each serving mode,
+`ragflow_server.py` and `ragflow_server.py --asgi`. Point the chat at a cheap or mock LLM:
+every stream is a real completion.
+
+    python api/stream_load.py --base-url http://127.0.0.1:9380 --api-key ragflow-xxx \\
+        --chat-id <chat_id> --streams 500 --duration 120 --pid <server pid>
+"""
+import argparse
+import asyncio
+import logging
+import statistics
+import time
+
+import httpx
+
+
+def rss_bytes(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def percentile(values, p):
+    if not values:
+        return 0.
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class Stats:
+    def __init__(self):
+        self.open = 0
+        self.peak_open = 0
+        self.done = 0
+        self.failed = 0
+        self.first_event = []
+        self.events = []
+        self.rss = []
+
+
+async def one_stream(client, args, session_id, stats):
+    st = time.perf_counter()
+    first, events = None, 0
+    stats.open += 1
+    stats.peak_open = max(stats.peak_open, stats.open)
+    try:
+        async with client.stream("POST", f"/api/v1/chats/{args.chat_id}/completions",
+                                 json={"question": args.question, "stream": True, "session_id": session_id}) as resp:
+            resp.raise_for_status()
+            async for line in resp.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                events += 1
+                if first is None:
+                    first = time.perf_counter() - st
+        stats.done += 1
+        stats.events.append(events)
+        if first is not None:
+            stats.first_event.append(first)
+    except Exception as e:
+        stats.failed += 1
+        logging.debug(f"Stream failed: {e}")
+    finally:
+        stats.open -= 1
+
+
+async def worker(client, args, stats, deadline, session_ids):
+    # A session each: concurrent completions of one session would race on its messages.
+    resp = await client.post(f"/api/v1/chats/{args.chat_id}/sessions", json={"name": "stream_load"})
+    resp.raise_for_status()
+    session_id = resp.json()["data"]["id"]
+    session_ids.append(session_id)
+    while time.monotonic() < deadline:
+        await one_stream(client, args, session_id, stats)
+
+
+async def sample_rss(pid, stats, deadline):
+    while time.monotonic() < deadline:
+        stats.rss.append((stats.open, rss_bytes(pid)))
+        await asyncio.sleep(1)
+
+
+async def run(args):
+    headers = {"Authorization": f"Bearer {args.api_key}"}
+    limits = httpx.Limits(max_connections=args.streams, max_keepalive_connections=args.streams)
+    async with httpx.AsyncClient(base_url=args.base_url, headers=headers, limits=limits, timeout=args.timeout) as client:
+        stats = Stats()
+        session_ids = []
+        idle_rss = rss_bytes(args.pid) if args.pid else 0
+        deadline = time.monotonic() + args.duration
+        tasks = [worker(client, args, stats, deadline, session_ids) for _ in range(args.streams)]
+        if args.pid:
+            tasks.append(sample_rss(args.pid, stats, deadline))
+        st = time.perf_counter()
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - st
+
+        await client.request("DELETE", f"/api/v1/chats/{args.chat_id}/sessions", json={"ids": session_ids})
+
+    logging.info(f"{stats.done} streams done, {stats.failed} failed in {elapsed:.1f}s, {stats.done / elapsed:.2f} streams/s")
+    logging.info(f"Peak concurrent streams: {stats.peak_open}")
+    if stats.first_event:
+        logging.info(f"First event: p50 {percentile(stats.first_event, .5):.3f}s, p95 {percentile(stats.first_event, .95):.3f}s, "
+                     f"max {max(stats.first_event):.3f}s")
+    if stats.events:
+        logging.info(f"Events per stream: mean {statistics.mean(stats.events):.1f}")
+    if stats.rss:
+        open_at_peak, peak_rss = max(stats.rss, key=lambda x: x[1])
+        gb = 1024 ** 3
+        logging.info(f"Server RSS: idle {idle_rss / gb:.3f}GB, peak {peak_rss / gb:.3f}GB with {open_at_peak} streams open")
+        if peak_rss > idle_rss:
+            logging.info(f"Streams per GB: {open_at_peak / (peak_rss / gb):.0f} of total RSS, "
+                         f"{open_at_peak / ((peak_rss - idle_rss) / gb):.0f} of RSS growth")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-url", default="http://127.0.0.1:9380")
+    parser.add_argument("--api-key", required=True)
+    parser.add_argument("--chat-id", required=True)
+    parser.add_argument("--question", default="What is RAGFlow?")
+    parser.add_argument("--streams", type=int, default=200, help="streams kept open at once")
+    parser.add_argument("--duration", type=int, default=60, help="seconds")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--pid", type=int, default=0, help="pid of the API server, to sample its memory")
+    args = parser.parse_args()
+    asyncio.run(run(args))
@@ -20,6 +20,7 @@ import random
 import re
 import sys
 import threading
+from collections import OrderedDict
 from copy import deepcopy
 from io import BytesIO
 from timeit import default_timer as timer
@@ -38,13 +39,64 @@ from deepdoc.vision import OCR, LayoutRecognizer, Recognizer, TableStructureReco
 from rag.app.picture import vision_llm_chunk as picture_vision_llm_chunk
 from rag.nlp import rag_tokenizer
 from rag.prompts import vision_llm_describe_prompt
-from rag.settings import PARALLEL_DEVICES
+from rag.settings import OCR_PAGE_BATCH, PARALLEL_DEVICES
 
 LOCK_KEY_pdfplumber = "global_shared_lock_pdfplumber"
 if LOCK_KEY_pdfplumber not in sys.modules:
     sys.modules[LOCK_KEY_pdfplumber] = threading.Lock()
 
 
+class _DecodedPages:
+    """The decoded images of the pages used last: layouts, tables and crops mostly walk the pages in order."""
+
+    def __init__(self, capacity=4):
+        self.capacity = capacity
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, page):
+        with self._lock:
+            if page in self._pages:
+                self._pages.move_to_end(page)
+                return self._pages[page]
+        img = Image.open(BytesIO(page.png))
+        img.load()
+        with self._lock:
+            self._pages[page] = img
+            while len(self._pages) > self.capacity:
+                self._pages.popitem(last=False)
+        return img
+
+
+class _EncodedPage:
+    """
+    A rendered page, PNG-encoded once OCR is done with it: at zoom 3 a page takes ~13MB as a
+    bitmap and a few hundred KB encoded. The steps after OCR only look at a few pages at a
+    time, so the pages are decoded on use and behave like the PIL images they were.
+    """
+
+    def __init__(self, img, decoded: _DecodedPages):
+        self.size, self.mode = img.size, img.mode
+        buf = BytesIO()
+        img.save(buf, format="PNG", compress_level=1)
+        self.png = buf.getvalue()
+        self._decoded = decoded
+
+    def image(self):
+        return self._decoded.get(self)
+
+    def crop(self, box=None):
+        return self.image().crop(box)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.array(self.image(), dtype=dtype)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.image(), name)
+
+
 class RAGFlowPdfParser:
     def __init__(self, **kwargs):
         """
@@ -294,15 +346,14 @@ class RAGFlowPdfParser:
                 b["H_right"] = spans[ii]["x1"]
                 b["SP"] = ii
 
-    def __ocr(self, pagenum, img, chars, ZM=3, device_id: int | None = None):
-        start = timer()
-        bxs = self.ocr.detect(np.array(img), device_id)
-        logging.info(f"__ocr detecting boxes of a image cost ({timer() - start}s)")
-
+    def __ocr_boxes(self, pagenum, img_np, bxs, chars, ZM=3):
+        """
+        Turn the detected text lines of a page into boxes, taking their text from the PDF
+        chars where possible. Boxes left without text carry the `box_image` to recognize.
+        """
         start = timer()
         if not bxs:
-            self.boxes.append([])
-            return
+            return []
         bxs = [(line[0], line[1][0]) for line in bxs]
         bxs = Recognizer.sort_Y_firstly(
             [{"x0": b[0][0] / ZM, "x1": b[1][0] / ZM,
@@ -340,26 +391,42 @@ class RAGFlowPdfParser:
             del b["chars"]
 
         logging.info(f"__ocr sorting {len(chars)} chars cost {timer() - start}s")
-        start = timer()
-        boxes_to_reg = []
-        img_np = np.array(img)
         for b in bxs:
             if not b["text"]:
                 left, right, top, bott = b["x0"] * ZM, b["x1"] * \
                                          ZM, b["top"] * ZM, b["bottom"] * ZM
                 b["box_image"] = self.ocr.get_rotate_crop_image(img_np, np.array([[left, top], [right, top], [right, bott], [left, bott]], dtype=np.float32))
-                boxes_to_reg.append(b)
             del b["txt"]
+        return bxs
+
+    def __ocr(self, pages, ZM=3, device_id: int | None = None):
+        """
+        OCR a batch of (page number, image, chars): text detection runs over the pages
+        together and text recognition over the crops of all of them, so the models see
+        batches across page boundaries.
+        """
+        start = timer()
+        imgs = [np.array(img) for _, img, _ in pages]
+        dets = self.ocr.detect_batch(imgs, device_id)
+        logging.info(f"__ocr detecting boxes of {len(pages)} pages cost ({timer() - start}s)")
+
+        page_bxs = [self.__ocr_boxes(pagenum, img_np, bxs, chars, ZM) for (pagenum, _, chars), img_np, bxs in zip(pages, imgs, dets)]
+        del imgs
+
+        start = timer()
+        boxes_to_reg = [b for bxs in page_bxs for b in bxs if "box_image" in b]
         texts = self.ocr.recognize_batch([b["box_image"] for b in boxes_to_reg], device_id)
-        for i in range(len(boxes_to_reg)):
-            boxes_to_reg[i]["text"] = texts[i]
-            del boxes_to_reg[i]["box_image"]
-        logging.info(f"__ocr recognize {len(bxs)} boxes cost {timer() - start}s")
-        bxs = [b for b in bxs if b["text"]]
-        if self.mean_height[pagenum-1] == 0:
-            self.mean_height[pagenum-1] = np.median([b["bottom"] - b["top"]
-                                              for b in bxs])
-        self.boxes.append(bxs)
+        for b, text in zip(boxes_to_reg, texts):
+            b["text"] = text
+            del b["box_image"]
+        logging.info(f"__ocr recognize {len(boxes_to_reg)} boxes of {len(pages)} pages cost {timer() - start}s")
+
+        for (pagenum, _, _), bxs in zip(pages, page_bxs):
+            bxs = [b for b in bxs if b["text"]]
+            if self.mean_height[pagenum-1] == 0 and bxs:
+                self.mean_height[pagenum-1] = np.median([b["bottom"] - b["top"]
+                                                  for b in bxs])
+            self.boxes[pagenum-1] = bxs
 
     def _layouts_rec(self, ZM, drop=True):
         assert len(self.page_images) == len(self.boxes)
@@ -1023,20 +1090,20 @@ class RAGFlowPdfParser:
         self.page_layout = []
         self.page_from = page_from
         start = timer()
+        plumber, pages = None, []
         try:
             with sys.modules[LOCK_KEY_pdfplumber]:
-                with (pdfplumber.open(fnm) if isinstance(fnm, str) else pdfplumber.open(BytesIO(fnm))) as pdf:
-                    self.pdf = pdf
-                    self.page_images = [p.to_image(resolution=72 * zoomin, antialias=True).annotated for i, p in
-                                        enumerate(self.pdf.pages[page_from:page_to])]
+                plumber = pdfplumber.open(fnm) if isinstance(fnm, str) else pdfplumber.open(BytesIO(fnm))
+                self.pdf = plumber
+                pages = self.pdf.pages[page_from:page_to]
 
-                    try:
-                        self.page_chars = [[c for c in page.dedupe_chars().chars if self._has_color(c)] for page in self.pdf.pages[page_from:page_to]]
-                    except Exception as e:
-                        logging.warning(f"Failed to extract characters for pages {page_from}-{page_to}: {str(e)}")
-                        self.page_chars = [[] for _ in range(page_to - page_from)]  # If failed to extract, using empty list instead.
+                try:
+                    self.page_chars = [[c for c in page.dedupe_chars().chars if self._has_color(c)] for page in pages]
+                except Exception as e:
+                    logging.warning(f"Failed to extract characters for pages {page_from}-{page_to}: {str(e)}")
+                    self.page_chars = [[] for _ in range(len(pages))]  # If failed to extract, using empty list instead.
 
-                    self.total_page = len(self.pdf.pages)
+                self.total_page = len(self.pdf.pages)
 
         except Exception:
             logging.exception("RAGFlowPdfParser __images__")
@@ -1064,17 +1131,29 @@ class RAGFlowPdfParser:
         if not self.outlines:
             logging.warning("Miss outlines")
 
-        logging.debug("Images converted.")
         self.is_english = [re.search(r"[a-zA-Z0-9,/¸;:'\[\]\(\)!@#$%^&*\"?<>._-]{30,}", "".join(
             random.choices([c["text"] for c in self.page_chars[i]], k=min(100, len(self.page_chars[i]))))) for i in
             range(len(self.page_chars))]
         if sum([1 if e else 0 for e in self.is_english]) > len(
-                self.page_images) / 2:
+                pages) / 2:
             self.is_english = True
         else:
             self.is_english = False
 
-        async def __img_ocr(i, id, img, chars, limiter):
+        # Pages are rendered one at a time and OCRed in batches while the next ones render.
+        self.page_images = [None] * len(pages)
+        self._decoded_pages = _DecodedPages()
+        self.boxes = [[] for _ in pages]
+
+        def __ocr_preprocess(i, img):
+            chars = self.page_chars[i] if not self.is_english else []
+            self.mean_height.append(
+                np.median(sorted([c["height"] for c in chars])) if chars else 0
+            )
+            self.mean_width.append(
+                np.median(sorted([c["width"] for c in chars])) if chars else 8
+            )
+            self.page_cum_height.append(img.size[1] / zoomin)
             j = 0
             while j + 1 < len(chars):
                 if chars[j]["text"] and chars[j + 1]["text"] \
@@ -1083,44 +1162,64 @@ class RAGFlowPdfParser:
                                                                        chars[j]["width"]) / 2:
                     chars[j]["text"] += " "
                 j += 1
+            return chars
 
-            if limiter:
-                async with limiter:
-                    await trio.to_thread.run_sync(lambda: self.__ocr(i + 1, img, chars, zoomin, id))
-            else:
-                self.__ocr(i + 1, img, chars, zoomin, id)
-
-            if callback and i % 6 == 5:
-                callback(prog=(i + 1) * 0.6 / len(self.page_images), msg="")
+        def __render(page):
+            with sys.modules[LOCK_KEY_pdfplumber]:
+                return page.to_image(resolution=72 * zoomin, antialias=True).annotated
+
+        async def __img_render(send_chan):
+            async with send_chan:
+                for i, page in enumerate(pages):
+                    img = await trio.to_thread.run_sync(__render, page)
+                    self.page_images[i] = img
+                    await send_chan.send((i + 1, img, __ocr_preprocess(i, img)))
+
+        def __ocr_batch(batch, id):
+            self.__ocr(batch, zoomin, id)
+            # OCR is the last step that needs whole pages at full size.
+            for pagenum, img, _ in batch:
+                self.page_images[pagenum - 1] = _EncodedPage(img, self._decoded_pages)
+
+        done = 0
+
+        async def __img_ocr(recv_chan, id, limiter):
+            nonlocal done
+            async with recv_chan:
+                async for page in recv_chan:
+                    batch = [page]
+                    while len(batch) < OCR_PAGE_BATCH:
+                        try:
+                            batch.append(recv_chan.receive_nowait())
+                        except (trio.WouldBlock, trio.EndOfChannel):
+                            break
+                    if limiter:
+                        async with limiter:
+                            await trio.to_thread.run_sync(__ocr_batch, batch, id)
+                    else:
+                        await trio.to_thread.run_sync(__ocr_batch, batch, id)
+                    done += len(batch)
+                    if callback:
+                        callback(prog=done * 0.6 / len(pages), msg="")
 
         async def __img_ocr_launcher():
-            def __ocr_preprocess():
-                chars = self.page_chars[i] if not self.is_english else []
-                self.mean_height.append(
-                    np.median(sorted([c["height"] for c in chars])) if chars else 0
-                )
-                self.mean_width.append(
-                    np.median(sorted([c["width"] for c in chars])) if chars else 8
-                )
-                self.page_cum_height.append(img.size[1] / zoomin)
-                return chars
-
-            if self.parallel_limiter:
-                async with trio.open_nursery() as nursery:
-                    for i, img in enumerate(self.page_images):
-                        chars = __ocr_preprocess()
-
-                        nursery.start_soon(__img_ocr, i, i % PARALLEL_DEVICES, img, chars,
-                                           self.parallel_limiter[i % PARALLEL_DEVICES])
-                        await trio.sleep(0.1)
-            else:
-                for i, img in enumerate(self.page_images):
-                    chars = __ocr_preprocess()
-                    await __img_ocr(i, 0, img, chars, None)
+            send_chan, recv_chan = trio.open_memory_channel(OCR_PAGE_BATCH)
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(__img_render, send_chan)
+                async with recv_chan:
+                    if self.parallel_limiter:
+                        for id in range(PARALLEL_DEVICES):
+                            nursery.start_soon(__img_ocr, recv_chan.clone(), id, self.parallel_limiter[id])
+                    else:
+                        nursery.start_soon(__img_ocr, recv_chan.clone(), None, None)
 
         start = timer()
 
-        trio.run(__img_ocr_launcher)
+        try:
+            trio.run(__img_ocr_launcher)
+        finally:
+            if plumber:
+                plumber.close()
 
         logging.info(f"__images__ {len(self.page_images)} pages cost {timer() - start}s")
 
@@ -31,6 +31,7 @@ import cv2
 import onnxruntime as ort
 
 from .postprocess import build_post_process
+from .session_pool import SessionPool, session_config
 
 loaded_models = {}
 
@@ -90,11 +91,8 @@ def load_model(model_dir, nm, device_id: int | None = None):
             return False
         return False
 
-    options = ort.SessionOptions()
-    options.enable_cpu_mem_arena = False
-    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
-    options.intra_op_num_threads = 2
-    options.inter_op_num_threads = 2
+    conf = session_config(nm)
+    pool_name = nm if device_id is None else f"{nm}:{device_id}"
 
     # https://github.com/microsoft/onnxruntime/issues/9509#issuecomment-951546580
     # Shrink GPU memory after execution
@@ -105,21 +103,17 @@ def load_model(model_dir, nm, device_id: int | None = None):
             "gpu_mem_limit": 512 * 1024 * 1024, # Limit gpu memory
             "arena_extend_strategy": "kNextPowerOfTwo",  # gpu memory allocation strategy
         }
-        sess = ort.InferenceSession(
-            model_file_path,
-            options=options,
-            providers=['CUDAExecutionProvider'],
-            provider_options=[cuda_provider_options]
-            )
+        sess = SessionPool(pool_name, model_file_path, conf,
+                           providers=['CUDAExecutionProvider'],
+                           provider_options=[cuda_provider_options],
+                           device_id=device_id)
         run_options.add_run_config_entry("memory.enable_memory_arena_shrinkage", "gpu:" + str(device_id))
-        logging.info(f"load_model {model_file_path} uses GPU")
+        logging.info(f"load_model {model_file_path} uses GPU, {sess.size} sessions")
     else:
-        sess = ort.InferenceSession(
-            model_file_path,
-            options=options,
-            providers=['CPUExecutionProvider'])
+        sess = SessionPool(pool_name, model_file_path, conf,
+                           providers=['CPUExecutionProvider'])
         run_options.add_run_config_entry("memory.enable_memory_arena_shrinkage", "cpu")
-        logging.info(f"load_model {model_file_path} uses CPU")
+        logging.info(f"load_model {model_file_path} uses CPU, {sess.size} sessions")
     loaded_model = (sess, run_options)
     loaded_models[model_cached_tag] = loaded_model
     return loaded_model
@@ -421,6 +415,7 @@ class TextDetector:
                               "unclip_ratio": 1.5, "use_dilation": False, "score_mode": "fast", "box_type": "quad"}
 
         self.postprocess_op = build_post_process(postprocess_params)
+        self.det_batch_num = 4
         self.predictor, self.run_options = load_model(model_dir, 'det', device_id)
         self.input_tensor = self.predictor.get_inputs()[0]
 
@@ -479,6 +474,19 @@ class TextDetector:
         dt_boxes = np.array(dt_boxes_new)
         return dt_boxes
 
+    def _run(self, imgs, shape_list):
+        input_dict = {}
+        input_dict[self.input_tensor.name] = imgs
+        for i in range(100000):
+            try:
+                outputs = self.predictor.run(None, input_dict, self.run_options)
+                break
+            except Exception as e:
+                if i >= 3:
+                    raise e
+                time.sleep(5)
+        return self.postprocess_op({"maps": outputs[0]}, shape_list)
+
     def __call__(self, img):
         ori_im = img.copy()
         data = {'image': img}
@@ -491,23 +499,35 @@ class TextDetector:
         img = np.expand_dims(img, axis=0)
         shape_list = np.expand_dims(shape_list, axis=0)
         img = img.copy()
-        input_dict = {}
-        input_dict[self.input_tensor.name] = img
-        for i in range(100000):
-            try:
-                outputs = self.predictor.run(None, input_dict, self.run_options)
-                break
-            except Exception as e:
-                if i >= 3:
-                    raise e
-                time.sleep(5)
-
-        post_result = self.postprocess_op({"maps": outputs[0]}, shape_list)
+        post_result = self._run(img, shape_list)
         dt_boxes = post_result[0]['points']
         dt_boxes = self.filter_tag_det_res(dt_boxes, ori_im.shape)
 
         return dt_boxes, time.time() - st
 
+    def detect_batch(self, img_list):
+        """
+        Same as calling the detector on every image, but images whose preprocessed
+        tensors have the same shape (usually all the pages of a document) go through
+        the model together, up to det_batch_num at a time.
+        """
+        st = time.time()
+        dt_boxes = [None] * len(img_list)
+        buckets = {}
+        for i, img in enumerate(img_list):
+            data = transform({'image': img}, self.preprocess_op)
+            if data[0] is None:
+                continue
+            buckets.setdefault(data[0].shape, []).append((i, data))
+        for bucket in buckets.values():
+            for beg in range(0, len(bucket), self.det_batch_num):
+                batch = bucket[beg:beg + self.det_batch_num]
+                imgs = np.stack([data[0] for _, data in batch])
+                shape_list = np.stack([data[1] for _, data in batch])
+                for (i, _), res in zip(batch, self._run(imgs, shape_list)):
+                    dt_boxes[i] = self.filter_tag_det_res(res['points'], img_list[i].shape)
+        return dt_boxes, time.time() - st
+
 
 class OCR:
     def __init__(self, model_dir=None):
@@ -657,6 +677,14 @@ class OCR:
         return zip(self.sorted_boxes(dt_boxes), [
                    ("", 0) for _ in range(len(dt_boxes))])
 
+    def detect_batch(self, img_list, device_id: int | None = None):
+        """`detect` over several images, returning the sorted boxes (or None) of each."""
+        if device_id is None:
+            device_id = 0
+        dt_boxes, elapse = self.text_detector[device_id].detect_batch(img_list)
+        return [None if bxs is None else list(zip(self.sorted_boxes(bxs), [("", 0) for _ in range(len(bxs))]))
+                for bxs in dt_boxes]
+
     def recognize(self, ori_im, box, device_id: int | None = None):
         if device_id is None:
             device_id = 0
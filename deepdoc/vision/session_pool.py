@@ -0,0 +1,190 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Pools of ONNX Runtime sessions for the deepdoc models.
+
+Session options come from the `deepdoc.onnx` section of service_conf.yaml, where
+`default` applies to every model and a model name (`det`, `rec`, `layout`, `tsr`,
+`layout.paper`, ...) overrides it:
+
+    deepdoc:
+      onnx:
+        default:
+          sessions: 2                     # on CPU, one per intra_op_num_threads cores, at most 4, when unset; 1 on GPU
+          intra_op_num_threads: 2
+          inter_op_num_threads: 2
+          execution_mode: sequential      # or parallel
+          graph_optimization_level: all   # disable, basic, extended or all
+          enable_cpu_mem_arena: false
+          io_binding: false
+        rec:
+          sessions: 4
+
+ONNX_SESSIONS and ONNX_INTRA_OP_THREADS override the defaults from the environment. Every GPU
+session holds its own memory arena, so more than one session per model on GPU must be asked for.
+"""
+import os
+import queue
+import threading
+import time
+
+import onnxruntime as ort
+
+from api.utils import get_base_config
+
+ONNX_INTRA_OP_THREADS = int(os.environ.get("ONNX_INTRA_OP_THREADS", 2))
+
+DEFAULT_SESSION_CONFIG = {
+    # None for default_sessions() of the execution provider.
+    "sessions": int(os.environ["ONNX_SESSIONS"]) if os.environ.get("ONNX_SESSIONS") else None,
+    "intra_op_num_threads": ONNX_INTRA_OP_THREADS,
+    "inter_op_num_threads": 2,
+    "execution_mode": "sequential",
+    "graph_optimization_level": "all",
+    "enable_cpu_mem_arena": False,
+    "io_binding": False,
+}
+
+_EXECUTION_MODES = {
+    "sequential": ort.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": ort.ExecutionMode.ORT_PARALLEL,
+}
+_GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+SESSION_POOLS = {}
+
+
+def session_config(nm: str) -> dict:
+    conf = (get_base_config("deepdoc", {}) or {}).get("onnx", {}) or {}
+    return {**DEFAULT_SESSION_CONFIG, **(conf.get("default") or {}), **(conf.get(nm) or {})}
+
+
+def default_sessions(providers) -> int:
+    """
+    On CPU, one session per ONNX_INTRA_OP_THREADS cores, at most 4: with a single session the
+    concurrent parsing tasks of an executor queue on every model. On GPU, one.
+    """
+    if providers[0] != "CPUExecutionProvider":
+        return 1
+    return max(1, min(4, (os.cpu_count() or 1) // ONNX_INTRA_OP_THREADS))
+
+
+def session_options(conf: dict) -> ort.SessionOptions:
+    options = ort.SessionOptions()
+    options.enable_cpu_mem_arena = bool(conf["enable_cpu_mem_arena"])
+    options.execution_mode = _EXECUTION_MODES[str(conf["execution_mode"]).lower()]
+    options.graph_optimization_level = _GRAPH_OPTIMIZATION_LEVELS[str(conf["graph_optimization_level"]).lower()]
+    options.intra_op_num_threads = int(conf["intra_op_num_threads"])
+    options.inter_op_num_threads = int(conf["inter_op_num_threads"])
+    return options
+
+
+class _PooledSession:
+    def __init__(self, sess, device_type, device_id):
+        self.sess = sess
+        self.device_type = device_type
+        self.device_id = device_id
+        # Device input buffers reused across runs while their shape and dtype do not change.
+        self.inputs = {}
+
+    def _bind_input(self, binding, name, arr):
+        if self.device_type == "cpu":
+            # A CPU OrtValue is a view of the array it was made from: updating it in place
+            # for the next run would overwrite the buffer of the previous caller.
+            binding.bind_cpu_input(name, arr)
+            return
+        v, shape, dtype = self.inputs.get(name, (None, None, None))
+        if v is not None and shape == arr.shape and dtype == arr.dtype and hasattr(v, "update_inplace"):
+            v.update_inplace(arr)
+        else:
+            v = ort.OrtValue.ortvalue_from_numpy(arr, self.device_type, self.device_id)
+            self.inputs[name] = (v, arr.shape, arr.dtype)
+        binding.bind_ortvalue_input(name, v)
+
+    def run_with_io_binding(self, output_names, input_feed, run_options):
+        binding = self.sess.io_binding()
+        for name, arr in input_feed.items():
+            self._bind_input(binding, name, arr)
+        for name in output_names or [o.name for o in self.sess.get_outputs()]:
+            binding.bind_output(name)
+        self.sess.run_with_iobinding(binding, run_options)
+        return binding.copy_outputs_to_cpu()
+
+
+class SessionPool:
+    """
+    A drop-in for `ort.InferenceSession.run` backed by several sessions of the same model,
+    so concurrent parsing tasks do not queue on one session. Tracks how long runs wait
+    for a free session versus how long the inference itself takes.
+    """
+
+    def __init__(self, name, model_file_path, conf, providers, provider_options=None, device_id=None):
+        self.name = name
+        self.io_binding = bool(conf["io_binding"])
+        device_type = "cuda" if providers[0] == "CUDAExecutionProvider" else "cpu"
+        self._sessions = queue.Queue()
+        self._first = None
+        sessions = conf["sessions"] if conf["sessions"] is not None else default_sessions(providers)
+        for _ in range(max(int(sessions), 1)):
+            sess = ort.InferenceSession(model_file_path, sess_options=session_options(conf),
+                                        providers=providers, provider_options=provider_options)
+            self._first = self._first or sess
+            self._sessions.put(_PooledSession(sess, device_type, device_id or 0))
+        self.size = self._sessions.qsize()
+        self._lock = threading.Lock()
+        self.stats = {"runs": 0, "wait": 0., "max_wait": 0., "inference": 0.}
+        SESSION_POOLS[name] = self
+
+    def get_inputs(self):
+        return self._first.get_inputs()
+
+    def get_outputs(self):
+        return self._first.get_outputs()
+
+    def run(self, output_names, input_feed, run_options=None):
+        st = time.perf_counter()
+        ps = self._sessions.get()
+        waited = time.perf_counter() - st
+        try:
+            st = time.perf_counter()
+            if self.io_binding:
+                return ps.run_with_io_binding(output_names, input_feed, run_options)
+            return ps.sess.run(output_names, input_feed, run_options)
+        finally:
+            el = time.perf_counter() - st
+            self._sessions.put(ps)
+            with self._lock:
+                self.stats["runs"] += 1
+                self.stats["wait"] += waited
+                self.stats["max_wait"] = max(self.stats["max_wait"], waited)
+                self.stats["inference"] += el
+
+
+def session_pool_stats() -> dict:
+    res = {}
+    for name, pool in list(SESSION_POOLS.items()):
+        st = dict(pool.stats)
+        runs = st["runs"] or 1
+        res[name] = {"sessions": pool.size, "runs": st["runs"],
+                     "avg_wait_ms": round(st["wait"] * 1000 / runs, 2),
+                     "max_wait_ms": round(st["max_wait"] * 1000, 2),
+                     "avg_inference_ms": round(st["inference"] * 1000 / runs, 2)}
+    return res
@@ -19,6 +19,7 @@ import os
 
 import networkx as nx
 import trio
+from networkx.readwrite import json_graph
 
 from api import settings
 from api.utils import get_uuid
@@ -31,6 +32,13 @@ from graphrag.general.extractor import Extractor
 from graphrag.utils import (
     graph_merge,
     get_graph,
+    get_graph_chunk,
+    get_from_to,
+    graph_snapshot,
+    is_sharded,
+    load_neighborhood,
+    rank_graph,
+    update_pagerank,
     set_graph,
     chunk_id,
     does_graph_contains,
@@ -97,6 +105,9 @@ async def run_graphrag(
 
         if not with_resolution and not with_community:
             return
+        if new_graph.graph.get("partial"):
+            new_graph = await get_graph(tenant_id, kb_id)
+            assert new_graph is not None
 
         if with_resolution:
             await graphrag_task_lock.spin_acquire()
@@ -213,20 +224,36 @@ async def merge_subgraph(
 ):
     start = trio.current_time()
     change = GraphChange()
-    old_graph = await get_graph(tenant_id, kb_id, subgraph.graph["source_id"])
-    if old_graph is not None:
-        logging.info("Merge with an exiting graph...................")
-        tidy_graph(old_graph, callback)
-        new_graph = graph_merge(old_graph, subgraph, change)
+    graph_chunk = await get_graph_chunk(tenant_id, kb_id)
+    if is_sharded(graph_chunk):
+        # Only the neighbourhood of the subgraph is loaded, merged, ranked and written back.
+        new_graph = await load_neighborhood(tenant_id, kb_id, subgraph.nodes())
+        callback(msg=f"Loaded the neighbourhood of {len(subgraph.nodes)} entities: {len(new_graph.nodes)} nodes and {len(new_graph.edges)} edges.")
+        tidy_graph(new_graph, callback)
+        boundary = {n: new_graph.nodes[n].get("rank", 0) for n in new_graph.nodes if not subgraph.has_node(n)}
+        snapshot = json_graph.node_link_graph(json.loads(graph_chunk["content_with_weight"]), edges="edges")
+        node_count = snapshot.graph.get("node_count", 0) + sum(1 for n in subgraph.nodes if not new_graph.has_node(n))
+        new_graph.graph["source_id"] = list(graph_chunk["source_id"])
+        new_graph = graph_merge(new_graph, subgraph, change)
+        # graph_merge ranks nodes by their degree in the graph at hand, partial for the boundary.
+        for n, rank in boundary.items():
+            new_graph.nodes[n]["rank"] = rank
+        new_graph.graph["node_count"] = node_count
+        update_pagerank(new_graph, subgraph.nodes(), node_count)
+        await set_graph(tenant_id, kb_id, embedding_model, new_graph, change, callback, snapshot=graph_snapshot(new_graph, snapshot))
     else:
-        new_graph = subgraph
+        # No graph yet, or one kept whole in the graph chunk: rank it as a whole and move it to entity and relation chunks.
+        old_graph = await get_graph(tenant_id, kb_id, subgraph.graph["source_id"])
+        if old_graph is not None:
+            logging.info("Merge with an exiting graph...................")
+            tidy_graph(old_graph, callback)
+            new_graph = graph_merge(old_graph, subgraph, change)
+        else:
+            new_graph = subgraph
         change.added_updated_nodes = set(new_graph.nodes())
-        change.added_updated_edges = set(new_graph.edges())
-    pr = nx.pagerank(new_graph)
-    for node_name, pagerank in pr.items():
-        new_graph.nodes[node_name]["pagerank"] = pagerank
-
-    await set_graph(tenant_id, kb_id, embedding_model, new_graph, change, callback)
+        change.added_updated_edges = {get_from_to(u, v) for u, v in new_graph.edges()}
+        rank_graph(new_graph)
+        await set_graph(tenant_id, kb_id, embedding_model, new_graph, change, callback, rewrite=True)
     now = trio.current_time()
     callback(
         msg=f"merging subgraph for doc {doc_id} into the global graph done in {now - start:.2f} seconds."
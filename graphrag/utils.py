@@ -6,6 +6,7 @@ Reference:
  - [LightRag](https://github.com/HKUDS/LightRAG)
 """
 
+import heapq
 import html
 import json
 import logging
@@ -18,18 +19,24 @@ import os
 import trio
 from typing import Set, Tuple
 import networkx as nx
-import numpy as np
 import xxhash
 from networkx.readwrite import json_graph
 import dataclasses
 
 from api.utils.api_utils import timeout
 from api import settings
-from api.utils import get_uuid
 from rag.nlp import search, rag_tokenizer
 from rag.utils.doc_store_conn import OrderByExpr
+from rag.utils.embedding_cache import EMBED_CACHE
 from rag.utils.redis_conn import REDIS_CONN
 
+# Chunks handed to one docStoreConn.insert by set_graph.
+GRAPH_INSERT_BATCH = 1024
+# Chunks fetched per search when loading the graph from its entities and relations.
+GRAPH_LOAD_PAGE = 1024
+# Nodes kept, by pagerank, in the graph chunk.
+GRAPH_SNAPSHOT_NODES = 256
+
 GRAPH_FIELD_SEP = "<SEP>"
 
 ErrorHandlerFn = Callable[[BaseException | None, str | None, dict | None], None]
@@ -92,51 +99,42 @@ def dict_has_keys_with_types(
     return True
 
 
-def get_llm_cache(llmnm, txt, history, genconf):
+def _llm_cache_key(llmnm, txt, history, genconf):
     hasher = xxhash.xxh64()
     hasher.update(str(llmnm).encode("utf-8"))
     hasher.update(str(txt).encode("utf-8"))
     hasher.update(str(history).encode("utf-8"))
     hasher.update(str(genconf).encode("utf-8"))
+    return hasher.hexdigest()
 
-    k = hasher.hexdigest()
-    bin = REDIS_CONN.get(k)
+
+def get_llm_cache(llmnm, txt, history, genconf):
+    bin = REDIS_CONN.get(_llm_cache_key(llmnm, txt, history, genconf))
     if not bin:
         return
     return bin
 
 
 def set_llm_cache(llmnm, txt, v, history, genconf):
-    hasher = xxhash.xxh64()
-    hasher.update(str(llmnm).encode("utf-8"))
-    hasher.update(str(txt).encode("utf-8"))
-    hasher.update(str(history).encode("utf-8"))
-    hasher.update(str(genconf).encode("utf-8"))
+    REDIS_CONN.set(_llm_cache_key(llmnm, txt, history, genconf), v.encode("utf-8"), 24*3600)
 
-    k = hasher.hexdigest()
-    REDIS_CONN.set(k, v.encode("utf-8"), 24*3600)
 
+def get_llm_cache_many(llmnm, txts, history, genconf) -> list:
+    """`get_llm_cache` of every text with one MGET; None where nothing is cached."""
+    return [v or None for v in REDIS_CONN.mget([_llm_cache_key(llmnm, txt, history, genconf) for txt in txts])]
 
-def get_embed_cache(llmnm, txt):
-    hasher = xxhash.xxh64()
-    hasher.update(str(llmnm).encode("utf-8"))
-    hasher.update(str(txt).encode("utf-8"))
 
-    k = hasher.hexdigest()
-    bin = REDIS_CONN.get(k)
-    if not bin:
-        return
-    return np.array(json.loads(bin))
+def set_llm_cache_many(llmnm, values: dict, history, genconf):
+    """`set_llm_cache` of every text -> value of `values` with one pipelined round-trip."""
+    REDIS_CONN.mset({_llm_cache_key(llmnm, txt, history, genconf): v.encode("utf-8") for txt, v in values.items()}, 24*3600)
 
 
-def set_embed_cache(llmnm, txt, arr):
-    hasher = xxhash.xxh64()
-    hasher.update(str(llmnm).encode("utf-8"))
-    hasher.update(str(txt).encode("utf-8"))
+def get_embed_cache(llmnm, txt):
+    return EMBED_CACHE.get(llmnm, txt)
 
-    k = hasher.hexdigest()
-    arr = json.dumps(arr.tolist() if isinstance(arr, np.ndarray) else arr)
-    REDIS_CONN.set(k, arr.encode("utf-8"), 24*3600)
+
+def set_embed_cache(llmnm, txt, arr):
+    EMBED_CACHE.set(llmnm, txt, arr)
 
 
 def get_tags_from_cache(kb_ids):
@@ -305,11 +303,16 @@ def chunk_id(chunk):
     return xxhash.xxh64((chunk["content_with_weight"] + chunk["kb_id"]).encode("utf-8")).hexdigest()
 
 
+def graph_chunk_id(kb_id, kind, *key):
+    """Stable id of the entity, relation or subgraph chunk `key`, so a rewrite replaces the previous one."""
+    return xxhash.xxh64(json.dumps([kb_id, kind, *key], ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
 async def graph_node_to_chunk(kb_id, embd_mdl, ent_name, meta, chunks):
     global chat_limiter
     enable_timeout_assertion=os.environ.get("ENABLE_TIMEOUT_ASSERTION")
     chunk = {
-        "id": get_uuid(),
+        "id": graph_chunk_id(kb_id, "entity", ent_name),
         "important_kwd": [ent_name],
         "title_tks": rag_tokenizer.tokenize(ent_name),
         "entity_kwd": ent_name,
@@ -322,13 +325,13 @@ async def graph_node_to_chunk(kb_id, embd_mdl, ent_name, meta, chunks):
         "available_int": 0
     }
     chunk["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(chunk["content_ltks"])
-    ebd = get_embed_cache(embd_mdl.llm_name, ent_name)
+    ebd = get_embed_cache(embd_mdl.cache_name, ent_name)
     if ebd is None:
         async with chat_limiter:
             with trio.fail_after(3 if enable_timeout_assertion else 30000000):
                 ebd, _ = await trio.to_thread.run_sync(lambda: embd_mdl.encode([ent_name]))
         ebd = ebd[0]
-        set_embed_cache(embd_mdl.llm_name, ent_name, ebd)
+        set_embed_cache(embd_mdl.cache_name, ent_name, ebd)
     assert ebd is not None
     chunk["q_%d_vec" % len(ebd)] = ebd
     chunks.append(chunk)
@@ -365,7 +368,7 @@ def get_relation(tenant_id, kb_id, from_ent_name, to_ent_name, size=1):
 async def graph_edge_to_chunk(kb_id, embd_mdl, from_ent_name, to_ent_name, meta, chunks):
     enable_timeout_assertion=os.environ.get("ENABLE_TIMEOUT_ASSERTION")
     chunk = {
-        "id": get_uuid(),
+        "id": graph_chunk_id(kb_id, "relation", *get_from_to(from_ent_name, to_ent_name)),
         "from_entity_kwd": from_ent_name,
         "to_entity_kwd": to_ent_name,
         "knowledge_graph_kwd": "relation",
@@ -379,13 +382,13 @@ async def graph_edge_to_chunk(kb_id, embd_mdl, from_ent_name, to_ent_name, meta,
     }
     chunk["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(chunk["content_ltks"])
     txt = f"{from_ent_name}->{to_ent_name}"
-    ebd = get_embed_cache(embd_mdl.llm_name, txt)
+    ebd = get_embed_cache(embd_mdl.cache_name, txt)
     if ebd is None:
         async with chat_limiter:
             with trio.fail_after(3 if enable_timeout_assertion else 300000000):
                 ebd, _ = await trio.to_thread.run_sync(lambda: embd_mdl.encode([txt+f": {meta['description']}"]))
         ebd = ebd[0]
-        set_embed_cache(embd_mdl.llm_name, txt, ebd)
+        set_embed_cache(embd_mdl.cache_name, txt, ebd)
     assert ebd is not None
     chunk["q_%d_vec" % len(ebd)] = ebd
     chunks.append(chunk)
@@ -422,70 +425,274 @@ async def get_graph_doc_ids(tenant_id, kb_id) -> list[str]:
     return doc_ids
 
 
-async def get_graph(tenant_id, kb_id, exclude_rebuild=None):
+async def get_graph_chunk(tenant_id, kb_id):
+    """Fields of the graph chunk of `kb_id`, None if there is none."""
     conds = {
         "fields": ["content_with_weight", "removed_kwd", "source_id"],
         "size": 1,
         "knowledge_graph_kwd": ["graph"]
     }
     res = await trio.to_thread.run_sync(lambda: settings.retrievaler.search(conds, search.index_name(tenant_id), [kb_id]))
-    if not res.total == 0:
-        for id in res.ids:
-            try:
-                if res.field[id]["removed_kwd"] == "N":
-                    g = json_graph.node_link_graph(json.loads(res.field[id]["content_with_weight"]), edges="edges")
-                    if "source_id" not in g.graph:
-                        g.graph["source_id"] = res.field[id]["source_id"]
-                else:
-                    g = await rebuild_graph(tenant_id, kb_id, exclude_rebuild)
-                return g
-            except Exception:
-                continue
-    result = None
-    return result
+    for id in res.ids:
+        return res.field[id]
+    return None
 
 
-async def set_graph(tenant_id: str, kb_id: str, embd_mdl, graph: nx.Graph, change: GraphChange, callback):
-    global chat_limiter
-    start = trio.current_time()
+def is_sharded(graph_chunk) -> bool:
+    """Whether the entity and relation chunks hold the whole graph, the graph chunk a snapshot only."""
+    if not graph_chunk or graph_chunk.get("removed_kwd") != "N":
+        return False
+    try:
+        return bool(json.loads(graph_chunk["content_with_weight"]).get("graph", {}).get("sharded"))
+    except Exception:
+        return False
+
+
+async def get_graph(tenant_id, kb_id, exclude_rebuild=None):
+    graph_chunk = await get_graph_chunk(tenant_id, kb_id)
+    if graph_chunk is None:
+        return None
+    # A graph that fails to load is an error, not a missing one: callers would overwrite it.
+    if graph_chunk["removed_kwd"] != "N":
+        return await rebuild_graph(tenant_id, kb_id, exclude_rebuild)
+    g = json_graph.node_link_graph(json.loads(graph_chunk["content_with_weight"]), edges="edges")
+    if g.graph.get("sharded"):
+        return await load_graph(tenant_id, kb_id, graph_chunk["source_id"])
+    if "source_id" not in g.graph:
+        g.graph["source_id"] = graph_chunk["source_id"]
+    return g
+
+
+async def search_graph_chunks(tenant_id, kb_id, condition, fields) -> list[dict]:
+    """All the chunks of `kb_id` matching `condition`, scanned GRAPH_LOAD_PAGE at a time."""
+    condition = {"kb_id": kb_id, **condition}
+
+    def scan():
+        chunks = []
+        for res in settings.docStoreConn.scan(fields, condition, search.index_name(tenant_id), [kb_id], GRAPH_LOAD_PAGE):
+            chunks.extend(settings.docStoreConn.getFields(res, fields).values())
+        return chunks
+
+    return await trio.to_thread.run_sync(scan)
+
+
+def _add_entities(graph: nx.Graph, entities: list[dict]):
+    for d in entities:
+        try:
+            graph.add_node(d["entity_kwd"], **json.loads(d["content_with_weight"]))
+        except Exception:
+            logging.warning(f"Skip broken entity chunk of {d.get('entity_kwd')}")
+
+
+def _add_relations(graph: nx.Graph, relations: list[dict]):
+    for d in relations:
+        # Relations left behind by a removed entity are not part of the graph.
+        if not graph.has_node(d["from_entity_kwd"]) or not graph.has_node(d["to_entity_kwd"]):
+            continue
+        try:
+            graph.add_edge(d["from_entity_kwd"], d["to_entity_kwd"], **json.loads(d["content_with_weight"]))
+        except Exception:
+            logging.warning(f"Skip broken relation chunk {d['from_entity_kwd']}->{d['to_entity_kwd']}")
+
+
+async def load_graph(tenant_id, kb_id, source_id) -> nx.Graph | None:
+    """The whole graph of `kb_id` from its entity and relation chunks."""
+    graph = nx.Graph()
+    _add_entities(graph, await search_graph_chunks(tenant_id, kb_id, {"knowledge_graph_kwd": ["entity"]}, ["entity_kwd", "content_with_weight"]))
+    if len(graph.nodes) == 0:
+        return None
+    _add_relations(graph, await search_graph_chunks(tenant_id, kb_id, {"knowledge_graph_kwd": ["relation"]}, ["from_entity_kwd", "to_entity_kwd", "content_with_weight"]))
+    graph.graph["source_id"] = list(source_id)
+    return graph
+
+
+async def load_neighborhood(tenant_id, kb_id, nodes) -> nx.Graph:
+    """
+    The stored entities among `nodes` with all their relations, plus the entities at the other end
+    of those. The graph is marked `partial`: only `nodes` have their whole neighbourhood.
+    """
+    nodes = sorted(nodes)
+    fields = ["from_entity_kwd", "to_entity_kwd", "content_with_weight"]
+    relations = {}
+
+    async def load_relations(end):
+        relations[end] = await search_graph_chunks(tenant_id, kb_id, {"knowledge_graph_kwd": ["relation"], end: nodes}, fields)
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(load_relations, "from_entity_kwd")
+        nursery.start_soon(load_relations, "to_entity_kwd")
+    relations = relations["from_entity_kwd"] + relations["to_entity_kwd"]
+
+    names = set(nodes)
+    for d in relations:
+        names.add(d["from_entity_kwd"])
+        names.add(d["to_entity_kwd"])
+    graph = nx.Graph()
+    _add_entities(graph, await search_graph_chunks(tenant_id, kb_id, {"knowledge_graph_kwd": ["entity"], "entity_kwd": sorted(names)}, ["entity_kwd", "content_with_weight"]))
+    _add_relations(graph, relations)
+    graph.graph["partial"] = True
+    return graph
 
-    await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"knowledge_graph_kwd": ["graph", "subgraph"]}, search.index_name(tenant_id), kb_id))
 
+def set_strength(graph: nx.Graph, nodes=None):
+    """Store the weighted degree of `nodes`, which lets their neighbours' pagerank be updated without loading them."""
+    for n in graph.nodes if nodes is None else nodes:
+        graph.nodes[n]["strength"] = graph.degree(n, weight="weight")
+
+
+def update_pagerank(graph: nx.Graph, nodes, node_count: int, alpha=0.85, max_iter=100, tol=1.0e-6):
+    """
+    Update the pagerank of `nodes` only, by Gauss-Seidel sweeps warm-started from their stored
+    values. Every other node of `graph` keeps its pagerank and stored strength. This is exact only
+    as long as the change does not shift rank beyond `nodes`; the graph is ranked as a whole again
+    whenever it is loaded fully, e.g. for entity resolution.
+    """
+    nodes = [n for n in nodes if graph.has_node(n)]
+    set_strength(graph, nodes)
+    base = (1 - alpha) / max(node_count, 1)
+    for n in nodes:
+        graph.nodes[n].setdefault("pagerank", base)
+    for _ in range(max_iter):
+        err = 0.0
+        for v in nodes:
+            rank = base
+            for u, attrs in graph[v].items():
+                node = graph.nodes[u]
+                strength = node.get("strength") or graph.degree(u, weight="weight")
+                if strength:
+                    rank += alpha * node.get("pagerank", base) * attrs.get("weight", 1) / strength
+            err += abs(rank - graph.nodes[v]["pagerank"])
+            graph.nodes[v]["pagerank"] = rank
+        if err < len(nodes) * tol:
+            break
+
+
+def rank_graph(graph: nx.Graph):
+    """PageRank of the whole graph, warm-started from the stored values."""
+    if len(graph.nodes) == 0:
+        return
+    nstart = {n: attrs.get("pagerank", 1.0 / len(graph.nodes)) for n, attrs in graph.nodes(data=True)}
+    pr = nx.pagerank(graph, nstart=nstart)
+    for node_name, pagerank in pr.items():
+        graph.nodes[node_name]["pagerank"] = pagerank
+    set_strength(graph)
+
+
+def graph_snapshot(graph: nx.Graph, previous: nx.Graph = None, size=GRAPH_SNAPSHOT_NODES) -> nx.Graph:
+    """
+    The `size` nodes of highest pagerank in `graph` and `previous`, with the edges between them,
+    which the graph chunk keeps for display. Nodes of `graph` override those of `previous`.
+    """
+    snapshot = nx.Graph()
+    if previous is not None:
+        snapshot.add_nodes_from(previous.nodes(data=True))
+        snapshot.add_edges_from(previous.edges(data=True))
+    snapshot.add_nodes_from(graph.nodes(data=True))
+    top = set(heapq.nlargest(size, snapshot.nodes, key=lambda n: snapshot.nodes[n].get("pagerank", 0)))
+    snapshot.add_edges_from((u, v, attrs) for u, v, attrs in graph.subgraph(top).edges(data=True))
+    snapshot = snapshot.subgraph(top).copy()
+    snapshot.graph = {}
+    return snapshot
+
+
+def changed_sources(graph: nx.Graph, change: GraphChange) -> set:
+    """Documents whose subgraph may differ after `change`; all of them once nodes or edges were removed."""
+    sources = set(graph.graph.get("source_id", []))
+    if change.removed_nodes or change.removed_edges:
+        return sources
+    changed = set()
+    for n in change.added_updated_nodes:
+        if graph.has_node(n):
+            changed.update(graph.nodes[n]["source_id"])
+    return changed & sources
+
+
+async def delete_chunk_ids(tenant_id: str, kb_id: str, ids):
+    """Delete the chunks `ids`, GRAPH_INSERT_BATCH at a time; never all of them for no id."""
+    ids = sorted(ids)
+    for b in range(0, len(ids), GRAPH_INSERT_BATCH):
+        batch = ids[b:b + GRAPH_INSERT_BATCH]
+        async with chat_limiter:
+            await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"id": batch}, search.index_name(tenant_id), kb_id))
+
+
+async def delete_stale_chunks(tenant_id: str, kb_id: str, condition: dict, keep: set):
+    """Delete the chunks matching `condition` but those in `keep`, just written under their stable ids."""
+    chunks = await search_graph_chunks(tenant_id, kb_id, condition, ["id"])
+    await delete_chunk_ids(tenant_id, kb_id, {c["id"] for c in chunks} - keep)
+
+
+async def delete_graph_edges(tenant_id: str, kb_id: str, change: GraphChange, keep: set = frozenset()):
+    """
+    Delete the relation chunks of `change.removed_edges` but those in `keep`: the ones of removed
+    nodes by their entities, the others by id. Those are looked up among the relations between
+    the entities of the edges, which finds the chunks written before ids were stable too.
+    """
+    conditions = []
     if change.removed_nodes:
-        await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"knowledge_graph_kwd": ["entity"], "entity_kwd": sorted(change.removed_nodes)}, search.index_name(tenant_id), kb_id))
+        removed_nodes = sorted(change.removed_nodes)
+        conditions.append({"knowledge_graph_kwd": ["relation"], "from_entity_kwd": removed_nodes})
+        conditions.append({"knowledge_graph_kwd": ["relation"], "to_entity_kwd": removed_nodes})
+    edges = {get_from_to(f, t) for f, t in change.removed_edges
+             if f not in change.removed_nodes and t not in change.removed_nodes}
+
+    async def delete(condition):
+        async with chat_limiter:
+            await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete(condition, search.index_name(tenant_id), kb_id))
 
+    async def delete_edges():
+        nodes = sorted({n for edge in edges for n in edge})
+        chunks = await search_graph_chunks(tenant_id, kb_id, {"knowledge_graph_kwd": ["relation"], "from_entity_kwd": nodes, "to_entity_kwd": nodes},
+                                           ["id", "from_entity_kwd", "to_entity_kwd"])
+        ids = {graph_chunk_id(kb_id, "relation", *edge) for edge in edges}
+        ids.update(c["id"] for c in chunks if get_from_to(c["from_entity_kwd"], c["to_entity_kwd"]) in edges)
+        await delete_chunk_ids(tenant_id, kb_id, ids - keep)
 
-    if change.removed_edges:
-        async def del_edges(from_node, to_node):
-            async with chat_limiter:
-                await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"knowledge_graph_kwd": ["relation"], "from_entity_kwd": from_node, "to_entity_kwd": to_node}, search.index_name(tenant_id), kb_id))
-        async with trio.open_nursery() as nursery:
-            for from_node, to_node in change.removed_edges:
-                 nursery.start_soon(del_edges, from_node, to_node)
+    async with trio.open_nursery() as nursery:
+        for condition in conditions:
+            nursery.start_soon(delete, condition)
+        if edges:
+            nursery.start_soon(delete_edges)
 
-    now = trio.current_time()
-    if callback:
-        callback(msg=f"set_graph removed {len(change.removed_nodes)} nodes and {len(change.removed_edges)} edges from index in {now - start:.2f}s.")
-    start = now
 
+async def set_graph(tenant_id: str, kb_id: str, embd_mdl, graph: nx.Graph, change: GraphChange, callback,
+                    snapshot: nx.Graph = None, rewrite: bool = False):
+    """
+    Persist `change` of `graph`. The entity and relation chunks, each under a stable id, hold the
+    graph: only the changed ones are written, or all of them with `rewrite`, which then deletes
+    every other one. The graph chunk is replaced by `snapshot`, by default the one of `graph`.
+    Subgraphs of the documents the change touches are rebuilt unless `graph` is a partial one.
+    """
+    global chat_limiter
+    timings = {}
+    start = trio.current_time()
+
+    sources = set() if graph.graph.get("partial") else changed_sources(graph, change)
+    if snapshot is None:
+        snapshot = graph_snapshot(graph)
+    snapshot.graph = {"sharded": True, "node_count": graph.graph.get("node_count", len(graph.nodes))}
     chunks = [{
-        "id": get_uuid(),
-        "content_with_weight": json.dumps(nx.node_link_data(graph, edges="edges"), ensure_ascii=False),
+        "id": graph_chunk_id(kb_id, "graph"),
+        "content_with_weight": json.dumps(nx.node_link_data(snapshot, edges="edges"), ensure_ascii=False),
         "knowledge_graph_kwd": "graph",
         "kb_id": kb_id,
         "source_id": graph.graph.get("source_id", []),
         "available_int": 0,
         "removed_kwd": "N"
     }]
-    
-    # generate updated subgraphs
-    for source in graph.graph["source_id"]:
-        subgraph = graph.subgraph([n for n in graph.nodes if source in graph.nodes[n]["source_id"]]).copy()
+
+    # generate the subgraphs of the documents the change touches
+    nodes_of = defaultdict(list)
+    for n, attrs in graph.nodes(data=True):
+        for source in set(attrs["source_id"]) & sources:
+            nodes_of[source].append(n)
+    for source in sorted(sources):
+        subgraph = graph.subgraph(nodes_of[source]).copy()
         subgraph.graph["source_id"] = [source]
         for n in subgraph.nodes:
             subgraph.nodes[n]["source_id"] = [source]
         chunks.append({
-            "id": get_uuid(),
+            "id": graph_chunk_id(kb_id, "subgraph", source),
             "content_with_weight": json.dumps(nx.node_link_data(subgraph, edges="edges"), ensure_ascii=False),
             "knowledge_graph_kwd": "subgraph",
             "kb_id": kb_id,
@@ -493,6 +700,9 @@ async def set_graph(tenant_id: str, kb_id: str, embd_mdl, graph: nx.Graph, chang
             "available_int": 0,
             "removed_kwd": "N"
         })
+    now = trio.current_time()
+    timings["subgraphs"] = now - start
+    start = now
 
     async with trio.open_nursery() as nursery:
         for ii, node in enumerate(change.added_updated_nodes):
@@ -512,23 +722,47 @@ async def set_graph(tenant_id: str, kb_id: str, embd_mdl, graph: nx.Graph, chang
                 callback(msg=f"Get embedding of edges: {ii}/{len(change.added_updated_edges)}")
 
     now = trio.current_time()
+    timings["embedding"] = now - start
     if callback:
         callback(msg=f"set_graph converted graph change to {len(chunks)} chunks in {now - start:.2f}s.")
     start = now
 
+    # The document stores split these into byte-sized bulk requests sent in parallel.
     enable_timeout_assertion=os.environ.get("ENABLE_TIMEOUT_ASSERTION")
-    es_bulk_size = 4
-    for b in range(0, len(chunks), es_bulk_size):
+    for b in range(0, len(chunks), GRAPH_INSERT_BATCH):
         with trio.fail_after(3 if enable_timeout_assertion else 30000000):
-            doc_store_result = await trio.to_thread.run_sync(lambda: settings.docStoreConn.insert(chunks[b:b + es_bulk_size], search.index_name(tenant_id), kb_id))
-        if b % 100 == es_bulk_size and callback:
-            callback(msg=f"Insert chunks: {b}/{len(chunks)}")
+            doc_store_result = await trio.to_thread.run_sync(lambda: settings.docStoreConn.insert(chunks[b:b + GRAPH_INSERT_BATCH], search.index_name(tenant_id), kb_id))
         if doc_store_result:
             error_message = f"Insert chunk error: {doc_store_result}, please check log file and Elasticsearch/Infinity status!"
             raise Exception(error_message)
+        if callback and b + GRAPH_INSERT_BATCH < len(chunks):
+            callback(msg=f"Insert chunks: {b + GRAPH_INSERT_BATCH}/{len(chunks)}")
     now = trio.current_time()
+    timings["insert"] = now - start
     if callback:
         callback(msg=f"set_graph added/updated {len(change.added_updated_nodes)} nodes and {len(change.added_updated_edges)} edges from index in {now - start:.2f}s.")
+    start = now
+
+    # Chunks are written before the stale ones are deleted, so the graph is never missing a part
+    # of it. Those rewritten keep their ids; the others go, which includes the ones written
+    # before ids were stable, for changed entities too.
+    keep = {c["id"] for c in chunks}
+    await delete_stale_chunks(tenant_id, kb_id, {"knowledge_graph_kwd": ["graph"]}, keep)
+    if sources:
+        await delete_stale_chunks(tenant_id, kb_id, {"knowledge_graph_kwd": ["subgraph"], "source_id": sorted(sources)}, keep)
+    if rewrite:
+        await delete_stale_chunks(tenant_id, kb_id, {"knowledge_graph_kwd": ["entity", "relation"]}, keep)
+    else:
+        entities = change.removed_nodes | change.added_updated_nodes
+        if entities:
+            await delete_stale_chunks(tenant_id, kb_id, {"knowledge_graph_kwd": ["entity"], "entity_kwd": sorted(entities)}, keep)
+        if change.removed_edges:
+            await delete_graph_edges(tenant_id, kb_id, change, keep)
+    now = trio.current_time()
+    timings["delete"] = now - start
+    if callback:
+        callback(msg=f"set_graph removed {len(change.removed_nodes)} nodes and {len(change.removed_edges)} edges from index in {now - start:.2f}s.")
+        callback(msg="set_graph timings: " + ", ".join(f"{k} {v:.2f}s" for k, v in timings.items()) + f", {len(sources)} subgraphs rewritten.")
 
 
 def is_continuous_subsequence(subseq, seq):
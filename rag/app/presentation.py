@@ -81,7 +81,7 @@ class Pdf(PdfParser):
         for i in range(len(self.boxes)):
             lines = "\n".join([b["text"] for b in self.boxes[i]
                               if not self.__garbage(b["text"])])
-            res.append((lines, self.page_images[i]))
+            res.append((lines, self.page_images[i].image()))
         callback(0.9, "Page {}~{}: Parsing finished".format(
             from_page, min(to_page, self.total_page)))
         return res
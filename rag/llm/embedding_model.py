@@ -37,6 +37,9 @@ from rag.utils import num_tokens_from_string, truncate
 
 
 class Base(ABC):
+    # The most texts one request to the provider may carry; encode() slices by it.
+    _BATCH_SIZE = 16
+
     def __init__(self, key, model_name, **kwargs):
         """
         Constructor for abstract base class.
@@ -111,7 +114,7 @@ class DefaultEmbedding(Base):
         self._model_name = DefaultEmbedding._model_name
 
     def encode(self, texts: list):
-        batch_size = 16
+        batch_size = self._BATCH_SIZE
         texts = [truncate(t, 2048) for t in texts]
         token_count = 0
         for t in texts:
@@ -140,7 +143,7 @@ class OpenAIEmbed(Base):
 
     def encode(self, texts: list):
         # OpenAI requires batch size <=16
-        batch_size = 16
+        batch_size = self._BATCH_SIZE
         texts = [truncate(t, 8191) for t in texts]
         ress = []
         total_tokens = 0
@@ -169,7 +172,7 @@ class LocalAIEmbed(Base):
         self.model_name = model_name.split("___")[0]
 
     def encode(self, texts: list):
-        batch_size = 16
+        batch_size = self._BATCH_SIZE
         ress = []
         for i in range(0, len(texts), batch_size):
             res = self.client.embeddings.create(input=texts[i : i + batch_size], model=self.model_name)
@@ -208,6 +211,7 @@ class BaiChuanEmbed(OpenAIEmbed):
 
 class QWenEmbed(Base):
     _FACTORY_NAME = "Tongyi-Qianwen"
+    _BATCH_SIZE = 4
 
     def __init__(self, key, model_name="text_embedding_v2", **kwargs):
         self.key = key
@@ -218,7 +222,7 @@ class QWenEmbed(Base):
 
         import dashscope
 
-        batch_size = 4
+        batch_size = self._BATCH_SIZE
         res = []
         token_count = 0
         texts = [truncate(t, 2048) for t in texts]
@@ -358,7 +362,7 @@ class FastEmbed(DefaultEmbedding):
         encodings = self._model.model.tokenizer.encode_batch(texts)
         total_tokens = sum(len(e) for e in encodings)
 
-        embeddings = [e.tolist() for e in self._model.embed(texts, batch_size=16)]
+        embeddings = [e.tolist() for e in self._model.embed(texts, batch_size=self._BATCH_SIZE)]
 
         return np.array(embeddings), total_tokens
 
@@ -379,7 +383,7 @@ class XinferenceEmbed(Base):
         self.model_name = model_name
 
     def encode(self, texts: list):
-        batch_size = 16
+        batch_size = self._BATCH_SIZE
         ress = []
         total_tokens = 0
         for i in range(0, len(texts), batch_size):
@@ -403,6 +407,7 @@ class XinferenceEmbed(Base):
 
 class YoudaoEmbed(Base):
     _FACTORY_NAME = "Youdao"
+    _BATCH_SIZE = 10
     _client = None
 
     def __init__(self, key=None, model_name="maidalun1020/bce-embedding-base_v1", **kwargs):
@@ -416,7 +421,7 @@ class YoudaoEmbed(Base):
                 YoudaoEmbed._client = qanthing(model_name_or_path=model_name.replace("maidalun1020", "InfiniFlow"))
 
     def encode(self, texts: list):
-        batch_size = 10
+        batch_size = self._BATCH_SIZE
         res = []
         token_count = 0
         for t in texts:
@@ -441,7 +446,7 @@ class JinaEmbed(Base):
 
     def encode(self, texts: list):
         texts = [truncate(t, 8196) for t in texts]
-        batch_size = 16
+        batch_size = self._BATCH_SIZE
         ress = []
         token_count = 0
         for i in range(0, len(texts), batch_size):
@@ -473,7 +478,7 @@ class MistralEmbed(Base):
         import time
         import random
         texts = [truncate(t, 8196) for t in texts]
-        batch_size = 16
+        batch_size = self._BATCH_SIZE
         ress = []
         token_count = 0
         for i in range(0, len(texts), batch_size):
@@ -576,7 +581,7 @@ class GeminiEmbed(Base):
         texts = [truncate(t, 2048) for t in texts]
         token_count = sum(num_tokens_from_string(text) for text in texts)
         genai.configure(api_key=self.key)
-        batch_size = 16
+        batch_size = self._BATCH_SIZE
         ress = []
         for i in range(0, len(texts), batch_size):
             result = genai.embed_content(model=self.model_name, content=texts[i : i + batch_size], task_type="retrieval_document", title="Embedding of single string")
@@ -617,7 +622,7 @@ class NvidiaEmbed(Base):
             self.base_url = "https://ai.api.nvidia.com/v1/retrieval/snowflake/arctic-embed-l/embeddings"
 
     def encode(self, texts: list):
-        batch_size = 16
+        batch_size = self._BATCH_SIZE
         ress = []
         token_count = 0
         for i in range(0, len(texts), batch_size):
@@ -674,7 +679,7 @@ class CoHereEmbed(Base):
         self.model_name = model_name
 
     def encode(self, texts: list):
-        batch_size = 16
+        batch_size = self._BATCH_SIZE
         ress = []
         token_count = 0
         for i in range(0, len(texts), batch_size):
@@ -746,7 +751,7 @@ class SILICONFLOWEmbed(Base):
         self.model_name = model_name
 
     def encode(self, texts: list):
-        batch_size = 16
+        batch_size = self._BATCH_SIZE
         ress = []
         token_count = 0
         for i in range(0, len(texts), batch_size):
@@ -790,7 +795,7 @@ class ReplicateEmbed(Base):
         self.client = Client(api_token=key)
 
     def encode(self, texts: list):
-        batch_size = 16
+        batch_size = self._BATCH_SIZE
         token_count = sum([num_tokens_from_string(text) for text in texts])
         ress = []
         for i in range(0, len(texts), batch_size):
@@ -846,7 +851,7 @@ class VoyageEmbed(Base):
         self.model_name = model_name
 
     def encode(self, texts: list):
-        batch_size = 16
+        batch_size = self._BATCH_SIZE
         ress = []
         token_count = 0
         for i in range(0, len(texts), batch_size):
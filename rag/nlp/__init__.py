@@ -20,6 +20,7 @@ from collections import Counter
 
 from rag.utils import num_tokens_from_string
 from . import rag_tokenizer
+from .tokenizer_pool import tokenize_texts
 import re
 import copy
 import roman_numbers as r
@@ -264,8 +265,21 @@ def tokenize(d, t, eng):
     d["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(d["content_ltks"])
 
 
+def tokenize_batch(ds, ts, eng):
+    """
+    Same as `tokenize` over pairs of docs and texts, repeated texts being tokenized once.
+    Large batches go to the tokenizer process pool when TOKENIZER_PROCESSES is set.
+    """
+    for d, t in zip(ds, ts):
+        d["content_with_weight"] = t
+    ts = [re.sub(r"</?(table|td|caption|tr|th)( [^<>]{0,12})?>", " ", t) for t in ts]
+    for d, (tks, sm_tks) in zip(ds, tokenize_texts(ts)):
+        d["content_ltks"] = tks
+        d["content_sm_ltks"] = sm_tks
+
+
 def tokenize_chunks(chunks, doc, eng, pdf_parser=None):
-    res = []
+    res, texts = [], []
     # wrap up as es documents
     for ii, ck in enumerate(chunks):
         if len(ck.strip()) == 0:
@@ -281,12 +295,13 @@ def tokenize_chunks(chunks, doc, eng, pdf_parser=None):
                 pass
         else:
             add_positions(d, [[ii]*5])
-        tokenize(d, ck, eng)
         res.append(d)
+        texts.append(ck)
+    tokenize_batch(res, texts, eng)
     return res
 
 def tokenize_chunks_with_images(chunks, doc, eng, images):
-    res = []
+    res, texts = [], []
     # wrap up as es documents
     for ii, (ck, image) in enumerate(zip(chunks, images)):
         if len(ck.strip()) == 0:
@@ -295,37 +310,37 @@ def tokenize_chunks_with_images(chunks, doc, eng, images):
         d = copy.deepcopy(doc)
         d["image"] = image
         add_positions(d, [[ii]*5])
-        tokenize(d, ck, eng)
         res.append(d)
+        texts.append(ck)
+    tokenize_batch(res, texts, eng)
     return res
 
 def tokenize_table(tbls, doc, eng, batch_size=10):
-    res = []
+    res, texts = [], []
     # add tables
     for (img, rows), poss in tbls:
         if not rows:
             continue
         if isinstance(rows, str):
             d = copy.deepcopy(doc)
-            tokenize(d, rows, eng)
-            d["content_with_weight"] = rows
             if img:
                 d["image"] = img
                 d["doc_type_kwd"] = "image"
             if poss:
                 add_positions(d, poss)
             res.append(d)
+            texts.append(rows)
             continue
         de = "; " if eng else "； "
         for i in range(0, len(rows), batch_size):
             d = copy.deepcopy(doc)
-            r = de.join(rows[i:i + batch_size])
-            tokenize(d, r, eng)
             if img:
                 d["image"] = img
                 d["doc_type_kwd"] = "image"
             add_positions(d, poss)
             res.append(d)
+            texts.append(de.join(rows[i:i + batch_size]))
+    tokenize_batch(res, texts, eng)
     return res
 
 
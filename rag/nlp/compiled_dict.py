@@ -0,0 +1,225 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Read-only dictionaries compiled from the text/JSON resources under rag/res.
+
+A compiled file holds an open-addressing hash table over the UTF-8 keys, so lookups
+probe it directly in a memory map: the file is never parsed into Python objects and
+its pages are shared through the page cache by every process on the node. Query
+analysis looks up every term of every question, so a lookup is one CRC32 and, mostly,
+a single key comparison.
+
+Layout (little-endian):
+    header      MAGIC, version, value kind, entry count, slot count, source size, source mtime_ns
+    key_offs    uint64[count + 1]
+    values      int64[count]                          (KIND_INT)
+                uint64[count + 1] offsets + JSON blob (KIND_JSON)
+    slots       uint32[slot count], entry index + 1 or 0 when free, linear probing from crc32(key)
+    keys        UTF-8 blob
+
+A compiled file is rebuilt when it is missing, has another version or does not
+match the size/mtime of its source.
+
+Startup and lookup benchmark:
+    python -m rag.nlp.compiled_dict
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+from collections.abc import Mapping
+from itertools import accumulate
+from timeit import default_timer as timer
+
+MAGIC = b"RFDICT"
+VERSION = 2
+KIND_INT, KIND_JSON = 1, 2
+_HEADER = struct.Struct("<6sHB7xQQQQ")
+
+
+class CompiledDict(Mapping):
+    """Memory-mapped, read-only str -> int / JSON value mapping."""
+
+    def __init__(self, path):
+        if sys.byteorder != "little":
+            raise ValueError("compiled dictionaries are read through native little-endian views")
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.kind, self._n, n_slots, self.src_size, self.src_mtime_ns = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} compiled dictionary")
+        # Typed views over the map: indexing them is much cheaper than struct.unpack_from.
+        mv = memoryview(self._mm)
+        pos = _HEADER.size
+        self._key_offs = mv[pos:pos + 8 * (self._n + 1)].cast("Q")
+        pos += 8 * (self._n + 1)
+        n_values = self._n + (1 if self.kind == KIND_JSON else 0)
+        self._values = mv[pos:pos + 8 * n_values].cast("q" if self.kind == KIND_INT else "Q")
+        pos += 8 * n_values
+        self._slots = mv[pos:pos + 4 * n_slots].cast("I")
+        self._mask = n_slots - 1
+        self._keys_pos = pos + 4 * n_slots
+
+    def _key(self, i):
+        return self._mm[self._keys_pos + self._key_offs[i]:self._keys_pos + self._key_offs[i + 1]]
+
+    def _find(self, key):
+        if not isinstance(key, str) or not self._n:
+            return -1
+        b = key.encode("utf-8", "surrogatepass")
+        mm, pos, offs, slots, mask = self._mm, self._keys_pos, self._key_offs, self._slots, self._mask
+        slot = zlib.crc32(b) & mask
+        while True:
+            i = slots[slot] - 1
+            if i < 0:
+                return -1
+            start = pos + offs[i]
+            # Compare lengths first: most probes that hit another key stop there.
+            if pos + offs[i + 1] - start == len(b) and mm[start:start + len(b)] == b:
+                return i
+            slot = (slot + 1) & mask
+
+    def _value(self, i):
+        if self.kind == KIND_INT:
+            return self._values[i]
+        return json.loads(self._mm[self._values[i]:self._values[i + 1]])
+
+    def __getitem__(self, key):
+        i = self._find(key)
+        if i < 0:
+            raise KeyError(key)
+        return self._value(i)
+
+    def get(self, key, default=None):
+        # Mapping.get goes through a KeyError for every miss.
+        i = self._find(key)
+        return self._value(i) if i >= 0 else default
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __len__(self):
+        return self._n
+
+    def __iter__(self):
+        for i in range(self._n):
+            yield self._key(i).decode("utf-8", "surrogatepass")
+
+
+def _le_bytes(typecode, values):
+    a = array(typecode, values)
+    if sys.byteorder != "little":
+        a.byteswap()
+    return a.tobytes()
+
+
+def _slot_table(keys):
+    """Linear probing table at most half full, so that misses stop at a free slot early."""
+    n_slots = 2
+    while n_slots < 2 * len(keys):
+        n_slots *= 2
+    mask = n_slots - 1
+    slots = [0] * n_slots
+    for i, k in enumerate(keys):
+        slot = zlib.crc32(k) & mask
+        while slots[slot]:
+            slot = (slot + 1) & mask
+        slots[slot] = i + 1
+    return slots
+
+
+def write_compiled(mapping: dict, path, kind, src_size=0, src_mtime_ns=0):
+    items = sorted(((k.encode("utf-8", "surrogatepass"), v) for k, v in mapping.items()), key=lambda kv: kv[0])
+    slots = _slot_table([k for k, _ in items])
+    keys = b"".join(k for k, _ in items)
+    parts = [_HEADER.pack(MAGIC, VERSION, kind, len(items), len(slots), src_size, src_mtime_ns),
+             _le_bytes("Q", accumulate((len(k) for k, _ in items), initial=0))]
+    if kind == KIND_INT:
+        parts += [_le_bytes("q", (int(v) for _, v in items)), _le_bytes("I", slots), keys]
+    else:
+        blobs = [json.dumps(v, ensure_ascii=False).encode("utf-8") for _, v in items]
+        # Value offsets are absolute: the JSON blob follows the offsets, the slots and the keys.
+        blob_pos = len(parts[0]) + len(parts[1]) + 8 * (len(items) + 1) + 4 * len(slots) + len(keys)
+        parts += [_le_bytes("Q", accumulate((len(b) for b in blobs), initial=blob_pos)), _le_bytes("I", slots),
+                  keys, b"".join(blobs)]
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        for p in parts:
+            f.write(p)
+    os.replace(tmp, path)
+
+
+def load_compiled(src, parse, kind, compiled=None):
+    """
+    Return the compiled dictionary of `src`, compiling it with `parse(src) -> dict` first if
+    needed. Falls back to the parsed dict when the compiled file can not be written.
+    """
+    compiled = compiled or src + ".bin"
+    st = os.stat(src)
+    try:
+        d = CompiledDict(compiled)
+        if d.kind == kind and d.src_size == st.st_size and d.src_mtime_ns == st.st_mtime_ns:
+            return d
+    except (OSError, ValueError):
+        pass
+
+    mapping = parse(src)
+    try:
+        write_compiled(mapping, compiled, kind, st.st_size, st.st_mtime_ns)
+        logging.info(f"Compiled {src} to {compiled}")
+        return CompiledDict(compiled)
+    except (OSError, ValueError):
+        logging.exception(f"Fail to compile {src}, use the parsed dictionary")
+        return mapping
+
+
+def load_json_dict(fnm):
+    with open(fnm, "r") as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    from api.utils.file_utils import get_project_base_directory
+    from rag.nlp.term_weight import load_term_freq
+    logging.basicConfig(level=logging.INFO)
+    res = os.path.join(get_project_base_directory(), "rag/res")
+    for fnm, parse, kind in [("term.freq", load_term_freq, KIND_INT),
+                             ("ner.json", load_json_dict, KIND_JSON),
+                             ("synonym.json", load_json_dict, KIND_JSON)]:
+        src = os.path.join(res, fnm)
+        if not os.path.exists(src):
+            continue
+        st = timer()
+        parsed = parse(src)
+        parse_tm = timer() - st
+        load_compiled(src, parse, kind)
+        st = timer()
+        compiled = load_compiled(src, parse, kind)
+        logging.info(f"{fnm}: parse {parse_tm * 1000:.1f}ms, compiled {(timer() - st) * 1000:.1f}ms")
+        # Half hits, half misses, as query terms are.
+        queries = list(parsed)[:50000]
+        queries += [q + "\u0001" for q in queries]
+        for name, d in [("dict", parsed), ("compiled", compiled)]:
+            st = timer()
+            for q in queries:
+                d.get(q)
+            logging.info(f"{fnm}: {name} {(timer() - st) / len(queries) * 1e9:.0f}ns per lookup")
@@ -19,6 +19,9 @@ import json
 import re
 from collections import defaultdict
 
+import numpy as np
+from scipy.sparse import csr_matrix
+
 from rag.utils.doc_store_conn import MatchTextExpr
 from rag.nlp import rag_tokenizer, term_weight, synonym
 
@@ -217,28 +220,47 @@ class FulltextQueryer:
         return None, keywords
 
     def hybrid_similarity(self, avec, bvecs, atks, btkss, tkweight=0.3, vtweight=0.7):
-        from sklearn.metrics.pairwise import cosine_similarity as CosineSimilarity
-        import numpy as np
-
-        sims = CosineSimilarity([avec], bvecs)
+        sims = self.vector_similarity(avec, bvecs)
         tksim = self.token_similarity(atks, btkss)
-        if np.sum(sims[0]) == 0:
-            return np.array(tksim), tksim, sims[0]
-        return np.array(sims[0]) * vtweight + np.array(tksim) * tkweight, tksim, sims[0]
+        if np.sum(sims) == 0:
+            return tksim, tksim, sims
+        return np.stack([sims, tksim], axis=1) @ np.array([vtweight, tkweight]), tksim, sims
+
+    @staticmethod
+    def vector_similarity(avec, bvecs):
+        """Cosine similarity between `avec` and every row of `bvecs`, stacked once into a float32 matrix."""
+        bvecs = np.asarray(bvecs, dtype=np.float32)
+        if bvecs.ndim != 2 or not len(bvecs):
+            return np.zeros(len(bvecs))
+        avec = np.asarray(avec, dtype=np.float32).ravel()
+        norms = np.linalg.norm(bvecs, axis=1) * np.linalg.norm(avec)
+        # Like sklearn's cosine_similarity, a zero vector is similar to nothing.
+        # Scores are float64 so that they stay JSON serializable, as np.float64 is a float.
+        return ((bvecs @ avec) / np.where(norms == 0, 1., norms)).astype(np.float64)
 
     def token_similarity(self, atks, btkss):
-        def toDict(tks):
+        """
+        Weighted share of the query terms found in each candidate, see `similarity`.
+        Only query terms are weighted: candidates are mapped onto the query vocabulary
+        as a sparse membership matrix, so the scores are a single matrix-vector product.
+        """
+        if isinstance(atks, str):
+            atks = atks.split()
+        qtwt = defaultdict(float)
+        for t, w in self.tw.weights(atks, preprocess=False):
+            qtwt[t] += w
+        vocab = {t: i for i, t in enumerate(qtwt.keys())}
+        weights = np.array(list(qtwt.values()), dtype=np.float64)
+
+        rows, cols = [], []
+        for r, tks in enumerate(btkss):
             if isinstance(tks, str):
                 tks = tks.split()
-            d = defaultdict(int)
-            wts = self.tw.weights(tks, preprocess=False)
-            for i, (t, c) in enumerate(wts):
-                d[t] += c
-            return d
-
-        atks = toDict(atks)
-        btkss = [toDict(tks) for tks in btkss]
-        return [self.similarity(atks, btks) for btks in btkss]
+            for c in set(vocab[t] for t in tks if t in vocab):
+                rows.append(r)
+                cols.append(c)
+        membership = csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(btkss), len(vocab)))
+        return (membership @ weights + 1e-9) / (weights.sum() + 1e-9)
 
     def similarity(self, qtwt, dtwt):
         if isinstance(dtwt, type("")):
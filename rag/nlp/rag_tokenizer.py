@@ -15,25 +15,39 @@
 #
 
 import logging
-import copy
 import datrie
 import math
 import os
 import re
 import string
 import sys
+import threading
+from functools import cached_property, lru_cache
+from timeit import default_timer as timer
 from hanziconv import HanziConv
 from nltk import word_tokenize
 from nltk.stem import PorterStemmer, WordNetLemmatizer
 from api.utils.file_utils import get_project_base_directory
 
+# Full-width ASCII variants and the ideographic space map to their half-width counterparts.
+_Q2B_TABLE = {c: c - 0xfee0 for c in range(0xff00, 0xff5f)}
+_Q2B_TABLE[0x3000] = 0x0020
+
+TOKENIZE_CACHE_SIZE = int(os.environ.get("TOKENIZE_CACHE_SIZE", 8192))
+TOKENIZE_CACHE_MAX_LEN = int(os.environ.get("TOKENIZE_CACHE_MAX_LEN", 512))
+
+
+@lru_cache(maxsize=1 << 18)
+def _trie_key(line):
+    return str(line.lower().encode("utf-8"))[2:-1]
+
 
 class RagTokenizer:
     def key_(self, line):
-        return str(line.lower().encode("utf-8"))[2:-1]
+        return _trie_key(line)
 
     def rkey_(self, line):
-        return str(("DD" + (line[::-1].lower())).encode("utf-8"))[2:-1]
+        return "DD" + _trie_key(line[::-1])
 
     def loadDict_(self, fnm):
         logging.info(f"[HUQIE]:Build trie from {fnm}")
@@ -61,6 +75,10 @@ class RagTokenizer:
     def __init__(self, debug=False):
         self.DEBUG = debug
         self.DENOMINATOR = 1000000
+        # Bounded LRUs over repeated sentences and ambiguous spans, dropped whenever the dictionary changes.
+        self._tokenize_cached = lru_cache(maxsize=TOKENIZE_CACHE_SIZE)(self._tokenize)
+        self._fine_grained_tokenize_cached = lru_cache(maxsize=TOKENIZE_CACHE_SIZE)(self._fine_grained_tokenize)
+        self._segment = lru_cache(maxsize=TOKENIZE_CACHE_SIZE * 8)(self._segment_)
         self.DIR_ = os.path.join(get_project_base_directory(), "rag/res", "huqie")
 
         self.stemmer = PorterStemmer()
@@ -68,26 +86,40 @@ class RagTokenizer:
 
         self.SPLIT_CHAR = r"([ ,\.<>/?;:'\[\]\\`!@#$%^&*\(\)\{\}\|_+=《》，。？、；‘’：“”【】~！￥%……（）——-]+|[a-zA-Z0-9,\.-]+)"
 
+    # cached_property stopped locking in Python 3.12: threads tokenizing their first text at
+    # the same time would each load, or worse, build the trie.
+    _trie_lock = threading.Lock()
+
+    @cached_property
+    def trie_(self):
+        """The huqie trie, loaded on first use from its prebuilt image or built from huqie.txt."""
+        with self._trie_lock:
+            # Loaded by the thread that held the lock before this one.
+            if "trie_" in self.__dict__:
+                return self.__dict__["trie_"]
+            return self._load_trie()
+
+    def _load_trie(self):
         trie_file_name = self.DIR_ + ".txt.trie"
         # check if trie file existence
         if os.path.exists(trie_file_name):
             try:
                 # load trie from file
-                self.trie_ = datrie.Trie.load(trie_file_name)
-                return
+                return datrie.Trie.load(trie_file_name)
             except Exception:
                 # fail to load trie from file, build default trie
                 logging.exception(f"[HUQIE]:Fail to load trie file {trie_file_name}, build the default trie file")
-                self.trie_ = datrie.Trie(string.printable)
         else:
             # file not exist, build default trie
             logging.info(f"[HUQIE]:Trie file {trie_file_name} not found, build the default trie file")
-            self.trie_ = datrie.Trie(string.printable)
+        self.trie_ = datrie.Trie(string.printable)
 
         # load data from dict file and save to trie file
         self.loadDict_(self.DIR_ + ".txt")
+        return self.trie_
 
     def loadUserDict(self, fnm):
+        self.clear_cache()
         try:
             self.trie_ = datrie.Trie.load(fnm + ".trie")
             return
@@ -96,22 +128,17 @@ class RagTokenizer:
         self.loadDict_(fnm)
 
     def addUserDict(self, fnm):
+        self.clear_cache()
         self.loadDict_(fnm)
 
+    def clear_cache(self):
+        self._tokenize_cached.cache_clear()
+        self._fine_grained_tokenize_cached.cache_clear()
+        self._segment.cache_clear()
+
     def _strQ2B(self, ustring):
         """Convert full-width characters to half-width characters"""
-        rstring = ""
-        for uchar in ustring:
-            inside_code = ord(uchar)
-            if inside_code == 0x3000:
-                inside_code = 0x0020
-            else:
-                inside_code -= 0xfee0
-            if inside_code < 0x0020 or inside_code > 0x7e:  # After the conversion, if it's not a half-width character, return the original character.
-                rstring += uchar
-            else:
-                rstring += chr(inside_code)
-        return rstring
+        return ustring.translate(_Q2B_TABLE)
 
     def _tradi2simp(self, line):
         return HanziConv.toSimplified(line)
@@ -122,10 +149,8 @@ class RagTokenizer:
         MAX_DEPTH = 10
         if _depth > MAX_DEPTH:
             if s < len(chars):
-                copy_pretks = copy.deepcopy(preTks)
                 remaining = "".join(chars[s:])
-                copy_pretks.append((remaining, (-12, '')))
-                tkslist.append(copy_pretks)
+                tkslist.append(preTks + [(remaining, (-12, ''))])
             return s
     
         state_key = (s, tuple(tk[0] for tk in preTks)) if preTks else (s, None)
@@ -151,11 +176,7 @@ class RagTokenizer:
                 mid = s + min(10, end - s)
                 t = "".join(chars[s:mid])
                 k = self.key_(t)
-                copy_pretks = copy.deepcopy(preTks)
-                if k in self.trie_:
-                    copy_pretks.append((t, self.trie_[k]))
-                else:
-                    copy_pretks.append((t, (-12, '')))
+                copy_pretks = preTks + [(t, self.trie_[k] if k in self.trie_ else (-12, ''))]
                 next_res = self.dfs_(chars, mid, copy_pretks, tkslist, _depth + 1, _memo)
                 res = max(res, next_res)
                 _memo[state_key] = res
@@ -178,8 +199,7 @@ class RagTokenizer:
             if e > s + 1 and not self.trie_.has_keys_with_prefix(k):
                 break
             if k in self.trie_:
-                pretks = copy.deepcopy(preTks)
-                pretks.append((t, self.trie_[k]))
+                pretks = preTks + [(t, self.trie_[k])]
                 res = max(res, self.dfs_(chars, e, pretks, tkslist, _depth + 1, _memo))
         
         if res > s:
@@ -188,11 +208,7 @@ class RagTokenizer:
     
         t = "".join(chars[s:s + 1])
         k = self.key_(t)
-        copy_pretks = copy.deepcopy(preTks)
-        if k in self.trie_:
-            copy_pretks.append((t, self.trie_[k]))
-        else:
-            copy_pretks.append((t, (-12, '')))
+        copy_pretks = preTks + [(t, self.trie_[k] if k in self.trie_ else (-12, ''))]
         result = self.dfs_(chars, s + 1, copy_pretks, tkslist, _depth + 1, _memo)
         _memo[state_key] = result
         return result
@@ -228,6 +244,17 @@ class RagTokenizer:
             res.append((tks, s))
         return sorted(res, key=lambda x: x[1], reverse=True)
 
+    def _segment_(self, chars):
+        """
+        Candidate segmentations of an ambiguous span, as (number of candidates, best, second best).
+        The exhaustive search is kept, rather than a Viterbi pass, because the score is not
+        additive over tokens and fine-grained tokenization picks the second best candidate.
+        """
+        tkslist = []
+        self.dfs_(chars, 0, [], tkslist)
+        ranked = self.sortTks_(tkslist)
+        return len(ranked), ranked[0][0] if ranked else [], ranked[1][0] if len(ranked) > 1 else []
+
     def merge_(self, tks):
         # if split chars is part of token
         res = []
@@ -320,6 +347,20 @@ class RagTokenizer:
         return txt_lang_pairs
 
     def tokenize(self, line):
+        if len(line) > TOKENIZE_CACHE_MAX_LEN:
+            return self._tokenize(line)
+        return self._tokenize_cached(line)
+
+    def tokenize_many(self, lines: list) -> list:
+        """Tokenize a batch of texts, each distinct text only once."""
+        seen = {}
+        return [seen[line] if line in seen else seen.setdefault(line, self.tokenize(line)) for line in lines]
+
+    def fine_grained_tokenize_many(self, tkss: list) -> list:
+        seen = {}
+        return [seen[tks] if tks in seen else seen.setdefault(tks, self.fine_grained_tokenize(tks)) for tks in tkss]
+
+    def _tokenize(self, line):
         line = re.sub(r"\W+", " ", line)
         line = self._strQ2B(line).lower()
         line = self._tradi2simp(line)
@@ -367,9 +408,7 @@ class RagTokenizer:
                     j += 1
                     continue
                 # backward tokens from_i to i are different from forward tokens from _j to j.
-                tkslist = []
-                self.dfs_("".join(tks[_j:j]), 0, [], tkslist)
-                res.append(" ".join(self.sortTks_(tkslist)[0][0]))
+                res.append(" ".join(self._segment("".join(tks[_j:j]))[1]))
 
                 same = 1
                 while i + same < len(tks1) and j + same < len(tks) and tks1[i + same] == tks[j + same]:
@@ -383,15 +422,18 @@ class RagTokenizer:
             if _i < len(tks1):
                 assert _j < len(tks)
                 assert "".join(tks1[_i:]) == "".join(tks[_j:])
-                tkslist = []
-                self.dfs_("".join(tks[_j:]), 0, [], tkslist)
-                res.append(" ".join(self.sortTks_(tkslist)[0][0]))
+                res.append(" ".join(self._segment("".join(tks[_j:]))[1]))
 
         res = " ".join(res)
         logging.debug("[TKS] {}".format(self.merge_(res)))
         return self.merge_(res)
 
     def fine_grained_tokenize(self, tks):
+        if len(tks) > TOKENIZE_CACHE_MAX_LEN:
+            return self._fine_grained_tokenize(tks)
+        return self._fine_grained_tokenize_cached(tks)
+
+    def _fine_grained_tokenize(self, tks):
         tks = tks.split()
         zh_num = len([1 for c in tks if c and is_chinese(c[0])])
         if zh_num < len(tks) * 0.2:
@@ -405,15 +447,13 @@ class RagTokenizer:
             if len(tk) < 3 or re.match(r"[0-9,\.-]+$", tk):
                 res.append(tk)
                 continue
-            tkslist = []
             if len(tk) > 10:
-                tkslist.append(tk)
-            else:
-                self.dfs_(tk, 0, [], tkslist)
-            if len(tkslist) < 2:
                 res.append(tk)
                 continue
-            stk = self.sortTks_(tkslist)[1][0]
+            n, _, stk = self._segment(tk)
+            if n < 2:
+                res.append(tk)
+                continue
             if len(stk) == len(tk):
                 stk = tk
             else:
@@ -467,6 +507,8 @@ def naiveQie(txt):
 tokenizer = RagTokenizer()
 tokenize = tokenizer.tokenize
 fine_grained_tokenize = tokenizer.fine_grained_tokenize
+tokenize_many = tokenizer.tokenize_many
+fine_grained_tokenize_many = tokenizer.fine_grained_tokenize_many
 tag = tokenizer.tag
 freq = tokenizer.freq
 loadUserDict = tokenizer.loadUserDict
@@ -507,10 +549,14 @@ if __name__ == '__main__':
         sys.exit()
     tknzr.DEBUG = False
     tknzr.loadUserDict(sys.argv[1])
-    of = open(sys.argv[2], "r")
-    while True:
-        line = of.readline()
-        if not line:
-            break
+    with open(sys.argv[2], "r") as of:
+        lines = of.readlines()
+    for line in lines:
         logging.info(tknzr.tokenize(line))
-    of.close()
+    # Cold pass with empty caches, then a warm one over the same lines.
+    tknzr.clear_cache()
+    for name in ["cold", "warm"]:
+        st = timer()
+        for tks in tknzr.tokenize_many(lines):
+            tknzr.fine_grained_tokenize(tks)
+        logging.info(f"{name}: {len(lines)} lines in {timer() - st:.3f}s")
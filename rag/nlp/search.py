@@ -16,14 +16,16 @@
 import logging
 import re
 import math
-from collections import OrderedDict
 from dataclasses import dataclass
 
 from rag.settings import TAG_FLD, PAGERANK_FLD
 from rag.utils import rmSpace, get_float
 from rag.nlp import rag_tokenizer, query
 import numpy as np
+from scipy.sparse import csr_matrix
 from rag.utils.doc_store_conn import DocStoreConnection, MatchDenseExpr, FusionExpr, OrderByExpr
+from rag.utils.embedding_cache import EMBED_CACHE
+from rag.utils.retrieval_cache import retrieval_cache_key, get_retrieval_cache, set_retrieval_cache
 
 
 def index_name(uid): return f"ragflow_{uid}"
@@ -46,7 +48,13 @@ class Dealer:
         group_docs: list[list] | None = None
 
     def get_vector(self, txt, emb_mdl, topk=10, similarity=0.1):
-        qv, _ = emb_mdl.encode_queries(txt)
+        # Query embeddings may differ from document ones (e.g. an instruction prefix), hence their own namespace.
+        cache_nm = f"{emb_mdl.cache_name}#query" if getattr(emb_mdl, "cache_name", None) else None
+        qv = EMBED_CACHE.get(cache_nm, txt) if cache_nm else None
+        if qv is None:
+            qv, _ = emb_mdl.encode_queries(txt)
+            if cache_nm and len(np.array(qv).shape) == 1:
+                EMBED_CACHE.set(cache_nm, txt, qv)
         shape = np.array(qv).shape
         if len(shape) > 1:
             raise Exception(
@@ -160,11 +168,9 @@ class Dealer:
     def trans2floats(txt):
         return [get_float(t) for t in txt.split("\t")]
 
-    def insert_citations(self, answer, chunks, chunk_v,
-                         embd_mdl, tkweight=0.1, vtweight=0.9):
-        assert len(chunks) == len(chunk_v)
-        if not chunks:
-            return answer, set([])
+    @staticmethod
+    def split_answer(answer) -> list[str]:
+        """The sentences of `answer`, code blocks kept whole, which `insert_citations` may cite after."""
         pieces = re.split(r"(```)", answer)
         if len(pieces) >= 3:
             i = 0
@@ -191,18 +197,14 @@ class Dealer:
             if re.match(r"([^\|][；。？!！\n]|[a-z][.?;!][ \n])", pieces[i]):
                 pieces[i - 1] += pieces[i][0]
                 pieces[i] = pieces[i][1:]
-        idx = []
-        pieces_ = []
-        for i, t in enumerate(pieces):
-            if len(t) < 5:
-                continue
-            idx.append(i)
-            pieces_.append(t)
-        logging.debug("{} => {}".format(answer, pieces_))
-        if not pieces_:
-            return answer, set([])
+        return pieces
 
-        ans_v, _ = embd_mdl.encode(pieces_)
+    def citation_tokens(self, chunks) -> list[list[str]]:
+        """Tokens of the chunks `content_ltks`, as `insert_citations` matches them."""
+        return [rag_tokenizer.tokenize(self.qryr.rmWWW(ck)).split() for ck in chunks]
+
+    def citation_similarities(self, pieces, ans_v, chunk_v, chunks_tks, tkweight, vtweight) -> dict:
+        """Sentence -> its hybrid similarity to every chunk, given the sentences' embeddings `ans_v`."""
         for i in range(len(chunk_v)):
             if len(ans_v[0]) != len(chunk_v[i]):
                 chunk_v[i] = [0.0]*len(ans_v[0])
@@ -211,36 +213,41 @@ class Dealer:
         assert len(ans_v[0]) == len(chunk_v[0]), "The dimension of query and chunk do not match: {} vs. {}".format(
             len(ans_v[0]), len(chunk_v[0]))
 
-        chunks_tks = [rag_tokenizer.tokenize(self.qryr.rmWWW(ck)).split()
-                      for ck in chunks]
+        sims = {}
+        for i, a in enumerate(pieces):
+            sims[a], _, _ = self.qryr.hybrid_similarity(ans_v[i],
+                                                        chunk_v,
+                                                        rag_tokenizer.tokenize(
+                                                            self.qryr.rmWWW(a)).split(),
+                                                        chunks_tks,
+                                                        tkweight, vtweight)
+        return sims
+
+    @staticmethod
+    def assemble_citations(pieces, sims: dict):
+        """`pieces` joined with the [ID:n] of the chunks most similar to each, by `sims` of the sentences."""
+        idx = [i for i, t in enumerate(pieces) if len(t) >= 5]
         cites = {}
         thr = 0.63
-        while thr > 0.3 and len(cites.keys()) == 0 and pieces_ and chunks_tks:
-            for i, a in enumerate(pieces_):
-                sim, tksim, vtsim = self.qryr.hybrid_similarity(ans_v[i],
-                                                                chunk_v,
-                                                                rag_tokenizer.tokenize(
-                                                                    self.qryr.rmWWW(pieces_[i])).split(),
-                                                                chunks_tks,
-                                                                tkweight, vtweight)
+        while thr > 0.3 and len(cites.keys()) == 0 and idx:
+            for i in idx:
+                sim = sims[pieces[i]]
                 mx = np.max(sim) * 0.99
-                logging.debug("{} SIM: {}".format(pieces_[i], mx))
+                logging.debug("{} SIM: {}".format(pieces[i], mx))
                 if mx < thr:
                     continue
-                cites[idx[i]] = list(
-                    set([str(ii) for ii in range(len(chunk_v)) if sim[ii] > mx]))[:4]
+                cites[i] = list(
+                    set([str(ii) for ii in range(len(sim)) if sim[ii] > mx]))[:4]
             thr *= 0.8
 
         res = ""
         seted = set([])
         for i, p in enumerate(pieces):
             res += p
-            if i not in idx:
-                continue
             if i not in cites:
                 continue
             for c in cites[i]:
-                assert int(c) < len(chunk_v)
+                assert int(c) < len(sims[p])
             for c in cites[i]:
                 if c in seted:
                     continue
@@ -249,60 +256,87 @@ class Dealer:
 
         return res, seted
 
+    def insert_citations(self, answer, chunks, chunk_v,
+                         embd_mdl, tkweight=0.1, vtweight=0.9):
+        assert len(chunks) == len(chunk_v)
+        if not chunks:
+            return answer, set([])
+        pieces = self.split_answer(answer)
+        pieces_ = [t for t in pieces if len(t) >= 5]
+        logging.debug("{} => {}".format(answer, pieces_))
+        if not pieces_:
+            return answer, set([])
+
+        ans_v, _ = embd_mdl.encode(pieces_)
+        sims = self.citation_similarities(pieces_, ans_v, chunk_v, self.citation_tokens(chunks), tkweight, vtweight)
+        return self.assemble_citations(pieces, sims)
+
+    def citation_stream(self, chunks, chunk_v, embd_mdl, pool, tkweight=0.1, vtweight=0.9):
+        """A `CitationStream` giving the same citations as `insert_citations`."""
+        return CitationStream(self, chunks, chunk_v, embd_mdl, pool, tkweight, vtweight)
+
     def _rank_feature_scores(self, query_rfea, search_res):
         ## For rank feature(tag_fea) scores.
-        rank_fea = []
-        pageranks = []
-        for chunk_id in search_res.ids:
-            pageranks.append(search_res.field[chunk_id].get(PAGERANK_FLD, 0))
-        pageranks = np.array(pageranks, dtype=float)
-
+        pageranks = np.array([search_res.field[chunk_id].get(PAGERANK_FLD, 0) for chunk_id in search_res.ids], dtype=float)
         if not query_rfea:
-            return np.array([0 for _ in range(len(search_res.ids))]) + pageranks
-
-        q_denor = np.sqrt(np.sum([s*s for t,s in query_rfea.items() if t != PAGERANK_FLD]))
-        for i in search_res.ids:
-            nor, denor = 0, 0
-            if not search_res.field[i].get(TAG_FLD):
-                rank_fea.append(0)
+            return pageranks
+
+        q_tags = {t: i for i, t in enumerate(query_rfea.keys())}
+        q_weights = np.array(list(query_rfea.values()), dtype=float)
+        q_denor = np.sqrt(np.sum([s*s for t, s in query_rfea.items() if t != PAGERANK_FLD]))
+        if q_denor == 0:
+            return pageranks
+
+        rows, cols, scores = [], [], []
+        denor = np.zeros(len(search_res.ids))
+        for r, i in enumerate(search_res.ids):
+            tags = search_res.field[i].get(TAG_FLD)
+            if not tags:
                 continue
-            for t, sc in eval(search_res.field[i].get(TAG_FLD, "{}")).items():
-                if t in query_rfea:
-                    nor += query_rfea[t] * sc
-                denor += sc * sc
-            if denor == 0:
-                rank_fea.append(0)
-            else:
-                rank_fea.append(nor/np.sqrt(denor)/q_denor)
-        return np.array(rank_fea)*10. + pageranks
+            if isinstance(tags, str):
+                tags = eval(tags)
+            for t, sc in tags.items():
+                denor[r] += sc * sc
+                if t in q_tags:
+                    rows.append(r)
+                    cols.append(q_tags[t])
+                    scores.append(sc)
+        nor = csr_matrix((scores, (rows, cols)), shape=(len(search_res.ids), len(q_tags))) @ q_weights
+        rank_fea = np.divide(nor, np.sqrt(denor) * q_denor, out=np.zeros_like(nor), where=denor > 0)
+        return rank_fea*10. + pageranks
 
     def rerank(self, sres, query, tkweight=0.3,
                vtweight=0.7, cfield="content_ltks",
                rank_feature: dict | None = None
                ):
         _, keywords = self.qryr.question(query)
+        if not sres.ids:
+            return [], [], []
         vector_size = len(sres.query_vector)
         vector_column = f"q_{vector_size}_vec"
-        zero_vector = [0.0] * vector_size
-        ins_embd = []
-        for chunk_id in sres.ids:
-            vector = sres.field[chunk_id].get(vector_column, zero_vector)
+        # Candidate vectors are stacked into one contiguous float32 matrix, missing ones stay zero.
+        ins_embd = np.zeros((len(sres.ids), vector_size), dtype=np.float32)
+        for r, chunk_id in enumerate(sres.ids):
+            vector = sres.field[chunk_id].get(vector_column)
+            if vector is None:
+                continue
             if isinstance(vector, str):
-                vector = [get_float(v) for v in vector.split("\t")]
-            ins_embd.append(vector)
-        if not ins_embd:
-            return [], [], []
+                try:
+                    vector = np.array(vector.split("\t"), dtype=np.float32)
+                except ValueError:
+                    vector = [get_float(v) for v in vector.split("\t")]
+            ins_embd[r] = vector
 
         for i in sres.ids:
             if isinstance(sres.field[i].get("important_kwd", []), str):
                 sres.field[i]["important_kwd"] = [sres.field[i]["important_kwd"]]
+        # Only the presence of a query term in a chunk counts, see FulltextQueryer.token_similarity.
         ins_tw = []
         for i in sres.ids:
-            content_ltks = list(OrderedDict.fromkeys(sres.field[i][cfield].split()))
-            title_tks = [t for t in sres.field[i].get("title_tks", "").split() if t]
-            question_tks = [t for t in sres.field[i].get("question_tks", "").split() if t]
-            important_kwd = sres.field[i].get("important_kwd", [])
-            tks = content_ltks + title_tks * 2 + important_kwd * 5 + question_tks * 6
+            tks = set(sres.field[i][cfield].split())
+            tks.update(sres.field[i].get("title_tks", "").split())
+            tks.update(sres.field[i].get("question_tks", "").split())
+            tks.update(sres.field[i].get("important_kwd", []))
             ins_tw.append(tks)
 
         ## For rank feature(tag_fea) scores.
@@ -365,6 +399,14 @@ class Dealer:
         if isinstance(tenant_ids, str):
             tenant_ids = tenant_ids.split(",")
 
+        cache_key = retrieval_cache_key(question, tenant_ids, kb_ids, doc_ids, embd_mdl, rerank_mdl,
+                                        page=page, page_size=page_size, similarity_threshold=similarity_threshold,
+                                        vector_similarity_weight=vector_similarity_weight, top=top, aggs=aggs,
+                                        highlight=highlight, rank_feature=rank_feature)
+        cached = get_retrieval_cache(cache_key)
+        if cached is not None:
+            return cached
+
         sres = self.search(req, [index_name(tid) for tid in tenant_ids],
                            kb_ids, embd_mdl, highlight, rank_feature=rank_feature)
 
@@ -434,6 +476,7 @@ class Dealer:
                                                        v in sorted(ranks["doc_aggs"].items(),
                                                                    key=lambda x: x[1]["count"] * -1)]
         ranks["chunks"] = ranks["chunks"][:page_size]
+        set_retrieval_cache(cache_key, ranks)
 
         return ranks
 
@@ -499,3 +542,76 @@ class Dealer:
         tag_fea = sorted([(a, round(0.1*(c + 1) / (cnt + S) / max(1e-6, all_tags.get(a, 0.0001)))) for a, c in aggs],
                          key=lambda x: x[1] * -1)[:topn_tags]
         return {a.replace(".", "_"): max(1, c) for a, c in tag_fea}
+
+
+class CitationStream:
+    """
+    Citations of an answer worked out while it is generated. `feed` it the answer so far: each
+    sentence it completes is embedded and scored against the chunks on `pool`, in batches of up to
+    BATCH sentences while an earlier batch is in flight. Chunk tokens are computed once, on `pool`
+    too, and sentences are only scored once they are. `finish` waits for them and is left with
+    the last sentences only, then places the citations as `insert_citations`.
+    """
+    BATCH = 8
+
+    def __init__(self, dealer: Dealer, chunks, chunk_v, embd_mdl, pool, tkweight=0.1, vtweight=0.9):
+        assert len(chunks) == len(chunk_v)
+        self.dealer = dealer
+        self.chunk_v = chunk_v
+        self._chunks_tks = pool.submit(dealer.citation_tokens, chunks)
+        self.embd_mdl = embd_mdl
+        self.pool = pool
+        self.tkweight = tkweight
+        self.vtweight = vtweight
+        self.sims = {}
+        self.seen = set()
+        self.pending = []
+        self.futures = []
+
+    @property
+    def chunks_tks(self):
+        return self._chunks_tks.result()
+
+    def _score(self, pieces):
+        ans_v, _ = self.embd_mdl.encode(pieces)
+        self.sims.update(self.dealer.citation_similarities(pieces, ans_v, self.chunk_v, self.chunks_tks, self.tkweight, self.vtweight))
+
+    @staticmethod
+    def _answer(text):
+        # Reasoning is not cited: only what follows </think> counts, nothing before it is closed.
+        if "</think>" in text:
+            return text.split("</think>")[-1]
+        return "" if "<think>" in text else text
+
+    def feed(self, text):
+        # A failure to tokenize the chunks is left to `finish` to raise.
+        if not self._chunks_tks.done() or self._chunks_tks.exception():
+            return
+        answer = self._answer(text)
+        # Answers citing by themselves are left as they are.
+        if not self.chunks_tks or re.search(r"\[ID:([0-9]+)\]", answer):
+            return
+        # The last piece may still grow.
+        for t in self.dealer.split_answer(answer)[:-1]:
+            if len(t) >= 5 and t not in self.seen:
+                self.seen.add(t)
+                self.pending.append(t)
+        if self.pending and (len(self.pending) >= self.BATCH or all(f.done() for f in self.futures)):
+            self.futures.append(self.pool.submit(self._score, self.pending))
+            self.pending = []
+
+    def finish(self, answer):
+        if not self.chunks_tks:
+            return answer, set([])
+        pieces = self.dealer.split_answer(answer)
+        for f in self.futures:
+            try:
+                f.result()
+            except Exception as e:
+                logging.warning(f"CitationStream batch failed, its sentences are embedded again: {e}")
+        if not any(len(t) >= 5 for t in pieces):
+            return answer, set([])
+        missing = [t for t in dict.fromkeys(pieces) if len(t) >= 5 and t not in self.sims]
+        if missing:
+            self._score(missing)
+        return self.dealer.assemble_citations(pieces, self.sims)
@@ -19,8 +19,10 @@ import json
 import os
 import time
 import re
+from functools import cached_property
 from nltk.corpus import wordnet
 from api.utils.file_utils import get_project_base_directory
+from rag.nlp.compiled_dict import KIND_JSON, load_compiled, load_json_dict
 
 
 class Dealer:
@@ -28,23 +30,26 @@ class Dealer:
 
         self.lookup_num = 100000000
         self.load_tm = time.time() - 1000000
-        self.dictionary = None
-        path = os.path.join(get_project_base_directory(), "rag/res", "synonym.json")
-        try:
-            self.dictionary = json.load(open(path, 'r'))
-        except Exception:
-            logging.warning("Missing synonym.json")
-            self.dictionary = {}
 
         if not redis:
             logging.warning(
                 "Realtime synonym is disabled, since no redis connection.")
-        if not len(self.dictionary.keys()):
-            logging.warning("Fail to load synonym")
 
         self.redis = redis
         self.load()
 
+    @cached_property
+    def dictionary(self):
+        path = os.path.join(get_project_base_directory(), "rag/res", "synonym.json")
+        try:
+            dictionary = load_compiled(path, load_json_dict, KIND_JSON)
+        except Exception:
+            logging.warning("Missing synonym.json")
+            dictionary = {}
+        if not len(dictionary):
+            logging.warning("Fail to load synonym")
+        return dictionary
+
     def load(self):
         if not self.redis:
             return
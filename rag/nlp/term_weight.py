@@ -16,14 +16,27 @@
 
 import logging
 import math
-import json
 import re
 import os
 import numpy as np
+from functools import cached_property
 from rag.nlp import rag_tokenizer
+from rag.nlp.compiled_dict import KIND_INT, KIND_JSON, load_compiled, load_json_dict
 from api.utils.file_utils import get_project_base_directory
 
 
+def load_term_freq(fnm):
+    res = {}
+    with open(fnm, "r") as f:
+        for line in f:
+            arr = line.replace("\n", "").split("\t")
+            if len(arr) < 2:
+                res[arr[0]] = 0
+            else:
+                res[arr[0]] = int(arr[1])
+    return res
+
+
 class Dealer:
     def __init__(self):
         self.stop_words = set(["请问",
@@ -58,36 +71,23 @@ class Dealer:
                                "啥",
                                "相关"])
 
-        def load_dict(fnm):
-            res = {}
-            f = open(fnm, "r")
-            while True:
-                line = f.readline()
-                if not line:
-                    break
-                arr = line.replace("\n", "").split("\t")
-                if len(arr) < 2:
-                    res[arr[0]] = 0
-                else:
-                    res[arr[0]] = int(arr[1])
-
-            c = 0
-            for _, v in res.items():
-                c += v
-            if c == 0:
-                return set(res.keys())
-            return res
+        self._res_dir = os.path.join(get_project_base_directory(), "rag/res")
 
-        fnm = os.path.join(get_project_base_directory(), "rag/res")
-        self.ne, self.df = {}, {}
+    @cached_property
+    def ne(self):
         try:
-            self.ne = json.load(open(os.path.join(fnm, "ner.json"), "r"))
+            return load_compiled(os.path.join(self._res_dir, "ner.json"), load_json_dict, KIND_JSON)
         except Exception:
             logging.warning("Load ner.json FAIL!")
+            return {}
+
+    @cached_property
+    def df(self):
         try:
-            self.df = load_dict(os.path.join(fnm, "term.freq"))
+            return load_compiled(os.path.join(self._res_dir, "term.freq"), load_term_freq, KIND_INT)
         except Exception:
             logging.warning("Load term.freq FAIL!")
+            return {}
 
     def pretoken(self, txt, num=False, stpwd=True):
         patt = [
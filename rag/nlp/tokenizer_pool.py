@@ -0,0 +1,107 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Process pool running `rag_tokenizer.tokenize` + `fine_grained_tokenize` for documents
+producing many chunks, so segmentation is not bound to the one core holding the GIL.
+
+Disabled unless TOKENIZER_PROCESSES > 0. Workers are spawned (not forked from a
+threaded parent) and load the huqie trie once, in their initializer.
+
+Benchmark:
+    python -m rag.nlp.tokenizer_pool <text file> [processes]
+"""
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from timeit import default_timer as timer
+
+from . import rag_tokenizer
+
+TOKENIZER_PROCESSES = int(os.environ.get("TOKENIZER_PROCESSES", 0))
+# Documents with fewer chunks are tokenized in the calling thread.
+TOKENIZER_PARALLEL_MIN_CHUNKS = int(os.environ.get("TOKENIZER_PARALLEL_MIN_CHUNKS", 256))
+# Texts sent to a worker at once.
+TOKENIZER_POOL_SLICE = int(os.environ.get("TOKENIZER_POOL_SLICE", 64))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _init_worker():
+    # Load the trie before the first slice arrives.
+    rag_tokenizer.tokenizer.trie_
+
+
+def _tokenize_slice(texts):
+    ltks = rag_tokenizer.tokenize_many(texts)
+    return list(zip(ltks, rag_tokenizer.fine_grained_tokenize_many(ltks)))
+
+
+def get_pool(processes=None):
+    global _pool
+    processes = TOKENIZER_PROCESSES if processes is None else processes
+    if processes <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=_init_worker)
+            logging.info(f"Tokenizer pool started with {processes} processes")
+        return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(cancel_futures=True)
+            _pool = None
+
+
+def tokenize_texts(texts: list, processes=None) -> list:
+    """Return (content_ltks, content_sm_ltks) for every text, in order."""
+    pool = get_pool(processes) if len(texts) >= TOKENIZER_PARALLEL_MIN_CHUNKS else None
+    if pool is None:
+        return _tokenize_slice(texts)
+    slices = [texts[i:i + TOKENIZER_POOL_SLICE] for i in range(0, len(texts), TOKENIZER_POOL_SLICE)]
+    try:
+        return [r for rs in pool.map(_tokenize_slice, slices) for r in rs]
+    except Exception:
+        logging.exception("Tokenizer pool failed, tokenize in process")
+        shutdown_pool()
+        return _tokenize_slice(texts)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    with open(sys.argv[1], "r") as f:
+        lines = [line for line in f.read().splitlines() if line.strip()]
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    TOKENIZER_PARALLEL_MIN_CHUNKS = 0
+
+    for name, n in [("serial", 0), ("pool", processes)]:
+        rag_tokenizer.tokenizer.clear_cache()
+        if n:
+            # Exclude worker start-up from the measurement.
+            list(get_pool(n).map(_tokenize_slice, [[""]] * n))
+        st = timer()
+        tokenize_texts(lines, n)
+        el = timer() - st
+        logging.info(f"{name}: {len(lines)} chunks in {el:.2f}s, {len(lines) / el:.1f} chunks/s")
+    shutdown_pool()
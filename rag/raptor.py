@@ -13,29 +13,98 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import json
 import logging
 import re
-import umap
 import numpy as np
-from sklearn.mixture import GaussianMixture
 import trio
+import xxhash
+from timeit import default_timer as timer
 
 from api.utils.api_utils import timeout
 from graphrag.utils import (
     get_llm_cache,
-    get_embed_cache,
-    set_embed_cache,
     set_llm_cache,
     chat_limiter,
 )
+from rag.raptor_clustering import cluster_labels
+from rag.settings import EMBEDDING_BATCH_SIZE
 from rag.utils import truncate
+from rag.utils.embedding_cache import EMBED_CACHE
+from rag.utils.redis_conn import REDIS_CONN
+
+RAPTOR_CHECKPOINT_TTL = 24 * 3600
+
+
+def checkpoint_key(doc_id, raptor_conf, llm_model, embd_model, chunks) -> str:
+    """Key of the checkpoint of a RAPTOR run, which a re-parsed document with other chunks does not resume."""
+    chunks_digest = xxhash.xxh64()
+    for content, _ in chunks:
+        chunks_digest.update(content.encode("utf-8"))
+    return "raptor_ckpt:{}:{}".format(doc_id, xxhash.xxh64(json.dumps([
+        raptor_conf, llm_model.llm_name, embd_model.llm_name, len(chunks), chunks_digest.hexdigest()
+    ], sort_keys=True, default=str).encode("utf-8")).hexdigest())
+
+
+class AdaptiveConcurrency:
+    """
+    Concurrency of the summary calls of one RAPTOR run: grows by one after a run of
+    fast successes, halves on rate limiting, timeouts and slow calls. Calls still go
+    through the process-wide `chat_limiter` as well.
+    """
+
+    RETRYABLE = re.compile(r"(429|rate.?limit|too many requests|timed? ?out|throttl)", re.IGNORECASE)
+
+    def __init__(self, initial=4, maximum=None, target_latency=60.):
+        self.maximum = max(maximum or chat_limiter.total_tokens, 1)
+        self.limiter = trio.CapacityLimiter(max(min(initial, self.maximum), 1))
+        self.target_latency = target_latency
+        self._successes = 0
+
+    def _resize(self, n):
+        self.limiter.total_tokens = max(min(n, self.maximum), 1)
+
+    def succeeded(self, latency):
+        if latency > self.target_latency:
+            self._successes = 0
+            self._resize(int(self.limiter.total_tokens * 0.75))
+            return
+        self._successes += 1
+        if self._successes >= self.limiter.total_tokens:
+            self._successes = 0
+            self._resize(self.limiter.total_tokens + 1)
+
+    def failed(self, e) -> bool:
+        """Shrink on an overload error and tell whether the call is worth retrying."""
+        self._successes = 0
+        if isinstance(e, (TimeoutError, trio.TooSlowError)) or self.RETRYABLE.search(str(e)):
+            self._resize(self.limiter.total_tokens // 2)
+            return True
+        return False
+
+    async def run(self, fn, max_attempts=3):
+        for attempt in range(max_attempts):
+            async with self.limiter:
+                async with chat_limiter:
+                    st = timer()
+                    try:
+                        res = await fn()
+                    except Exception as e:
+                        if not self.failed(e) or attempt + 1 >= max_attempts:
+                            raise
+                        logging.warning(f"RAPTOR summary got {e}, retry with concurrency {self.limiter.total_tokens}")
+                    else:
+                        self.succeeded(timer() - st)
+                        return res
+            await trio.sleep(min(2 ** attempt, 30))
 
 
 class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
     def __init__(
-        self, max_cluster, llm_model, embd_model, prompt, max_token=512, threshold=0.1
+        self, max_cluster, llm_model, embd_model, prompt, max_token=512, threshold=0.1, clustering="gmm"
     ):
         self._max_cluster = max_cluster
+        self._clustering = clustering
         self._llm_model = llm_model
         self._embd_model = embd_model
         self._threshold = threshold
@@ -61,41 +130,73 @@ class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
         )
         return response
 
-    @timeout(20)
-    async def _embedding_encode(self, txt):
-        response = await trio.to_thread.run_sync(
-            lambda: get_embed_cache(self._embd_model.llm_name, txt)
-        )
-        if response is not None:
-            return response
-        embds, _ = await trio.to_thread.run_sync(lambda: self._embd_model.encode([txt]))
-        if len(embds) < 1 or len(embds[0]) < 1:
-            raise Exception("Embedding error: ")
-        embds = embds[0]
-        await trio.to_thread.run_sync(lambda: set_embed_cache(self._embd_model.llm_name, txt, embds))
+    async def _embedding_encode_batch(self, txts: list) -> list:
+        """Embed all the summaries of a layer: cached ones from the cache, the rest in batches."""
+        cache_nm = self._embd_model.cache_name
+        embds = await trio.to_thread.run_sync(lambda: EMBED_CACHE.get_many(cache_nm, txts))
+        missed = [i for i, v in enumerate(embds) if v is None]
+        for b in range(0, len(missed), EMBEDDING_BATCH_SIZE):
+            idx = missed[b:b + EMBEDDING_BATCH_SIZE]
+            batch = [txts[i] for i in idx]
+
+            @timeout(20 + 2 * len(batch))
+            async def encode():
+                return await trio.to_thread.run_sync(lambda: self._embd_model.encode(batch))
+
+            vts, _ = await encode()
+            if len(vts) != len(batch) or any(len(v) < 1 for v in vts):
+                raise Exception("Embedding error: ")
+            await trio.to_thread.run_sync(lambda: EMBED_CACHE.set_many(cache_nm, batch, vts))
+            for i, v in zip(idx, vts):
+                embds[i] = v
         return embds
 
-    def _get_optimal_clusters(self, embeddings: np.ndarray, random_state: int):
-        max_clusters = min(self._max_cluster, len(embeddings))
-        n_clusters = np.arange(1, max_clusters)
-        bics = []
-        for n in n_clusters:
-            gm = GaussianMixture(n_components=n, random_state=random_state)
-            gm.fit(embeddings)
-            bics.append(gm.bic(embeddings))
-        optimal_clusters = n_clusters[np.argmin(bics)]
-        return optimal_clusters
-
-    async def __call__(self, chunks, random_state, callback=None):
+    @staticmethod
+    def _load_checkpoint(key, original_length):
+        if not key:
+            return None
+        try:
+            ckpt = json.loads(REDIS_CONN.get(key) or "null")
+        except Exception:
+            return None
+        if not ckpt or ckpt.get("original_length") != original_length:
+            return None
+        return ckpt
+
+    @staticmethod
+    def _save_checkpoint(key, chunks, original_length, layers, labels):
+        if not key:
+            return
+        REDIS_CONN.set(key, json.dumps({
+            "original_length": original_length,
+            "summaries": [(cnt, np.asarray(embd).tolist()) for cnt, embd in chunks[original_length:]],
+            "layers": layers,
+            "labels": [int(lbl) for lbl in labels],
+        }, ensure_ascii=False), RAPTOR_CHECKPOINT_TTL)
+
+    async def __call__(self, chunks, random_state, callback=None, checkpoint_key=None):
+        """
+        With a `checkpoint_key`, the summaries of every finished layer are kept in Redis
+        so that a rerun of the same task resumes after the last finished layer.
+        """
         if len(chunks) <= 1:
             return []
         chunks = [(s, a) for s, a in chunks if s and len(a) > 0]
+        original_length = len(chunks)
         layers = [(0, len(chunks))]
-        start, end = 0, len(chunks)
+        labels = []
+        ckpt = self._load_checkpoint(checkpoint_key, original_length)
+        if ckpt:
+            chunks.extend((cnt, np.array(embd)) for cnt, embd in ckpt["summaries"])
+            layers = [tuple(layer) for layer in ckpt["layers"]]
+            labels = ckpt["labels"]
+            if callback:
+                callback(msg="Resume from layer {} ({} summaries)".format(len(layers) - 1, len(ckpt["summaries"])))
+        start, end = layers[-1]
+        concurrency = AdaptiveConcurrency()
 
         @timeout(60*20)
         async def summarize(ck_idx: list[int]):
-            nonlocal chunks
             texts = [chunks[i][0] for i in ck_idx]
             len_per_chunk = int(
                 (self._llm_model.max_length - self._max_token) / len(texts)
@@ -103,72 +204,60 @@ class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
             cluster_content = "\n".join(
                 [truncate(t, max(1, len_per_chunk)) for t in texts]
             )
-            async with chat_limiter:
-                cnt = await self._chat(
-                    "You're a helpful assistant.",
-                    [
-                        {
-                            "role": "user",
-                            "content": self._prompt.format(
-                                cluster_content=cluster_content
-                            ),
-                        }
-                    ],
-                    {"max_tokens": self._max_token},
-                )
-                cnt = re.sub(
-                    "(······\n由于长度的原因，回答被截断了，要继续吗？|For the content length reason, it stopped, continue?)",
-                    "",
-                    cnt,
-                )
-                logging.debug(f"SUM: {cnt}")
-                embds = await self._embedding_encode(cnt)
-                chunks.append((cnt, embds))
+            cnt = await concurrency.run(lambda: self._chat(
+                "You're a helpful assistant.",
+                [
+                    {
+                        "role": "user",
+                        "content": self._prompt.format(
+                            cluster_content=cluster_content
+                        ),
+                    }
+                ],
+                {"max_tokens": self._max_token},
+            ))
+            cnt = re.sub(
+                "(······\n由于长度的原因，回答被截断了，要继续吗？|For the content length reason, it stopped, continue?)",
+                "",
+                cnt,
+            )
+            logging.debug(f"SUM: {cnt}")
+            return cnt
+
+        async def summarize_layer(clusters: list[list[int]]):
+            summaries = [None] * len(clusters)
+
+            async def summarize_cluster(c):
+                summaries[c] = await summarize(clusters[c])
+
+            async with trio.open_nursery() as nursery:
+                for c in range(len(clusters)):
+                    nursery.start_soon(summarize_cluster, c)
+            embds = await self._embedding_encode_batch(summaries)
+            chunks.extend(zip(summaries, embds))
 
-        labels = []
         while end - start > 1:
             embeddings = [embd for _, embd in chunks[start:end]]
             if len(embeddings) == 2:
-                await summarize([start, start + 1])
-                if callback:
-                    callback(
-                        msg="Cluster one layer: {} -> {}".format(
-                            end - start, len(chunks) - end
-                        )
-                    )
-                labels.extend([0, 0])
-                layers.append((end, len(chunks)))
-                start = end
-                end = len(chunks)
-                continue
-
-            n_neighbors = int((len(embeddings) - 1) ** 0.8)
-            reduced_embeddings = umap.UMAP(
-                n_neighbors=max(2, n_neighbors),
-                n_components=min(12, len(embeddings) - 2),
-                metric="cosine",
-            ).fit_transform(embeddings)
-            n_clusters = self._get_optimal_clusters(reduced_embeddings, random_state)
-            if n_clusters == 1:
-                lbls = [0 for _ in range(len(reduced_embeddings))]
+                lbls = [0, 0]
             else:
-                gm = GaussianMixture(n_components=n_clusters, random_state=random_state)
-                gm.fit(reduced_embeddings)
-                probs = gm.predict_proba(reduced_embeddings)
-                lbls = [np.where(prob > self._threshold)[0] for prob in probs]
-                lbls = [lbl[0] if isinstance(lbl, np.ndarray) else lbl for lbl in lbls]
+                lbls = await trio.to_thread.run_sync(
+                    lambda: cluster_labels(self._clustering, embeddings, self._max_cluster, self._threshold, random_state)
+                )
+            n_clusters = max(lbls) + 1
 
-            async with trio.open_nursery() as nursery:
-                for c in range(n_clusters):
-                    ck_idx = [i + start for i in range(len(lbls)) if lbls[i] == c]
-                    assert len(ck_idx) > 0
-                    nursery.start_soon(summarize, ck_idx)
+            clusters = [[i + start for i in range(len(lbls)) if lbls[i] == c] for c in range(n_clusters)]
+            assert all(clusters)
+            await summarize_layer(clusters)
 
             assert len(chunks) - end == n_clusters, "{} vs. {}".format(
                 len(chunks) - end, n_clusters
             )
             labels.extend(lbls)
             layers.append((end, len(chunks)))
+            await trio.to_thread.run_sync(
+                lambda: self._save_checkpoint(checkpoint_key, chunks, original_length, layers, labels)
+            )
             if callback:
                 callback(
                     msg="Cluster one layer: {} -> {}".format(
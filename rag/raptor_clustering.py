@@ -0,0 +1,189 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Clustering backends of RAPTOR layers, selected by `parser_config.raptor.clustering`:
+
+    gmm       UMAP, then a GaussianMixture BIC sweep over 1..max_cluster (the original method).
+    kmeans    PCA over L2-normalized float32 vectors, then MiniBatchKMeans over a bounded
+              set of cluster counts, evaluated in parallel and picked by silhouette score.
+    hdbscan   PCA as above, then HDBSCAN, which chooses the number of clusters itself.
+
+All of them run in a process pool so the trio loop of the task executor stays free.
+Every backend returns labels in 0..n-1 with no empty cluster.
+
+Benchmark (wall time versus chunk count):
+    python -m rag.raptor_clustering
+"""
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from timeit import default_timer as timer
+
+import numpy as np
+
+RAPTOR_CLUSTER_PROCESSES = int(os.environ.get("RAPTOR_CLUSTER_PROCESSES", min(4, os.cpu_count() or 1)))
+# Cluster counts tried by the kmeans backend.
+RAPTOR_CLUSTER_CANDIDATES = int(os.environ.get("RAPTOR_CLUSTER_CANDIDATES", 8))
+RAPTOR_PCA_COMPONENTS = 32
+CLUSTERING_METHODS = ("gmm", "kmeans", "hdbscan")
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=max(RAPTOR_CLUSTER_PROCESSES, 1),
+                                        mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def _compact(labels):
+    """Renumber labels to 0..n-1 in order of appearance."""
+    mapping = {}
+    return [mapping.setdefault(lbl, len(mapping)) for lbl in labels]
+
+
+def reduce_dimensions(embeddings, n_components=RAPTOR_PCA_COMPONENTS):
+    from sklearn.decomposition import PCA
+    X = np.asarray(embeddings, dtype=np.float32)
+    X /= np.maximum(np.linalg.norm(X, axis=1, keepdims=True), 1e-12)
+    n_components = min(n_components, X.shape[0] - 1, X.shape[1])
+    if n_components < 2:
+        return X
+    return PCA(n_components=n_components, svd_solver="randomized", random_state=0).fit_transform(X).astype(np.float32)
+
+
+def gmm_labels(embeddings, max_cluster, threshold, random_state):
+    import umap
+    from sklearn.mixture import GaussianMixture
+
+    n_neighbors = int((len(embeddings) - 1) ** 0.8)
+    reduced_embeddings = umap.UMAP(
+        n_neighbors=max(2, n_neighbors),
+        n_components=min(12, len(embeddings) - 2),
+        metric="cosine",
+    ).fit_transform(embeddings)
+
+    max_clusters = min(max_cluster, len(reduced_embeddings))
+    n_clusters = np.arange(1, max_clusters)
+    bics = []
+    for n in n_clusters:
+        gm = GaussianMixture(n_components=n, random_state=random_state)
+        gm.fit(reduced_embeddings)
+        bics.append(gm.bic(reduced_embeddings))
+    n_clusters = n_clusters[np.argmin(bics)]
+    if n_clusters == 1:
+        return [0 for _ in range(len(reduced_embeddings))]
+
+    gm = GaussianMixture(n_components=n_clusters, random_state=random_state)
+    gm.fit(reduced_embeddings)
+    probs = gm.predict_proba(reduced_embeddings)
+    lbls = [np.where(prob > threshold)[0] for prob in probs]
+    lbls = [lbl[0] if isinstance(lbl, np.ndarray) else lbl for lbl in lbls]
+    return _compact(int(lbl) for lbl in lbls)
+
+
+def _kmeans_candidate(X, k, random_state):
+    from sklearn.cluster import MiniBatchKMeans
+    from sklearn.metrics import silhouette_score
+
+    km = MiniBatchKMeans(n_clusters=k, random_state=random_state, batch_size=1024, n_init=3)
+    labels = km.fit_predict(X)
+    if len(set(labels)) < 2:
+        return -1., labels
+    return float(silhouette_score(X, labels, sample_size=min(len(X), 2000), random_state=random_state)), labels
+
+
+def cluster_counts(n, max_cluster, candidates=RAPTOR_CLUSTER_CANDIDATES):
+    """Up to `candidates` cluster counts spread geometrically over 2..min(max_cluster, n - 1)."""
+    hi = min(max_cluster, n - 1)
+    if hi < 2:
+        return []
+    return sorted(set(int(round(k)) for k in np.geomspace(2, hi, num=min(candidates, hi - 1))))
+
+
+def kmeans_labels(X, max_cluster, random_state, pool=None):
+    ks = cluster_counts(len(X), max_cluster)
+    if not ks:
+        return [0] * len(X)
+    if pool:
+        results = list(pool.map(_kmeans_candidate, [X] * len(ks), ks, [random_state] * len(ks)))
+    else:
+        results = [_kmeans_candidate(X, k, random_state) for k in ks]
+    score, labels = max(results, key=lambda r: r[0])
+    if score < 0:
+        return [0] * len(X)
+    return _compact(int(lbl) for lbl in labels)
+
+
+def hdbscan_labels(X, max_cluster):
+    from sklearn.cluster import HDBSCAN
+
+    labels = HDBSCAN(min_cluster_size=2, copy=True).fit_predict(X)
+    clusters = sorted(set(labels) - {-1})
+    if not clusters:
+        return [0] * len(X)
+    centroids = np.stack([X[labels == c].mean(axis=0) for c in clusters])
+    # Merge the smallest clusters into their nearest neighbour until max_cluster is met.
+    while len(clusters) > max(max_cluster, 1):
+        sizes = [int((labels == c).sum()) for c in clusters]
+        i = int(np.argmin(sizes))
+        d = np.linalg.norm(centroids - centroids[i], axis=1)
+        d[i] = np.inf
+        j = int(np.argmin(d))
+        labels[labels == clusters[i]] = clusters[j]
+        del clusters[i]
+        centroids = np.delete(centroids, i, axis=0)
+    # Noise points join their nearest cluster.
+    noise = labels == -1
+    if noise.any():
+        nearest = np.argmin(np.linalg.norm(X[noise][:, None, :] - centroids[None, :, :], axis=2), axis=1)
+        labels[noise] = np.asarray(clusters)[nearest]
+    return _compact(int(lbl) for lbl in labels)
+
+
+def cluster_labels(method, embeddings, max_cluster, threshold, random_state):
+    """Blocking entry point; `kmeans` fans its candidate counts out over the process pool."""
+    if method not in CLUSTERING_METHODS:
+        logging.warning(f"Unknown RAPTOR clustering method {method}, use gmm")
+        method = "gmm"
+    pool = get_pool()
+    if method == "gmm":
+        return pool.submit(gmm_labels, np.asarray(embeddings), max_cluster, threshold, random_state).result()
+    X = reduce_dimensions(embeddings)
+    if method == "kmeans":
+        return kmeans_labels(X, max_cluster, random_state, pool)
+    return pool.submit(hdbscan_labels, X, max_cluster).result()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    rng = np.random.default_rng(0)
+    for n in [100, 500, 1000, 2000, 5000]:
+        centers = rng.normal(size=(max(n // 50, 2), 1024))
+        vectors = centers[rng.integers(0, len(centers), n)] + rng.normal(scale=0.3, size=(n, 1024))
+        for method in CLUSTERING_METHODS:
+            if method == "gmm" and n > 2000:
+                continue
+            st = timer()
+            labels = cluster_labels(method, vectors, 64, 0.1, 0)
+            logging.info(f"{method}: {n} chunks, {len(set(labels))} clusters in {timer() - st:.2f}s")
+    get_pool().shutdown()
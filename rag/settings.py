@@ -58,6 +58,9 @@ except Exception:
 DOC_MAXIMUM_SIZE = int(os.environ.get("MAX_CONTENT_LENGTH", 128 * 1024 * 1024))
 DOC_BULK_SIZE = int(os.environ.get("DOC_BULK_SIZE", 4))
 EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 16))
+EMBEDDING_MAX_BATCH_SIZE = int(os.environ.get("EMBEDDING_MAX_BATCH_SIZE", 256))
+EMBEDDING_TOKEN_BUDGET = int(os.environ.get("EMBEDDING_TOKEN_BUDGET", 8192))
+EMBEDDING_BATCH_LINGER = float(os.environ.get("EMBEDDING_BATCH_LINGER", 0.05))
 SVR_QUEUE_NAME = "rag_flow_svr_queue"
 SVR_CONSUMER_GROUP_NAME = "rag_flow_svr_task_broker"
 PAGERANK_FLD = "pagerank_fea"
@@ -71,6 +74,10 @@ try:
 except Exception:
     logging.info("can't import package 'torch'")
 
+# Pages OCRed together by RAGFlowPdfParser, which is also how many rendered pages may wait for OCR.
+OCR_PAGE_BATCH = int(os.environ.get("OCR_PAGE_BATCH", 4))
+
+
 def print_rag_settings():
     logging.info(f"MAX_CONTENT_LENGTH: {DOC_MAXIMUM_SIZE}")
     logging.info(f"MAX_FILE_COUNT_PER_USER: {int(os.environ.get('MAX_FILE_NUM_PER_USER', 0))}")
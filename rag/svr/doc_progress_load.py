@@ -0,0 +1,98 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Load test of `DocumentService.update_progress` against a synthetic backlog.
+
+Inserts `--docs` unfinished documents with `--tasks` tasks each under a throwaway
+knowledge base id. Every tick, the tasks of `--changed` random documents make
+progress and are reported changed, as the task executors do, then one
+`update_progress` runs and is timed. The synthetic rows are deleted at the end.
+
+Run it against a test deployment: the full sweeps also refresh its real documents.
+
+    python -m rag.svr.doc_progress_load --docs 50000 --changed 200 --ticks 20
+"""
+import argparse
+import logging
+import random
+from datetime import datetime
+from timeit import default_timer as timer
+
+from api import settings
+from api.db import TaskStatus
+from api.db.db_models import DB, Document, Task
+from api.db.db_utils import bulk_insert_into_db
+from api.db.services.document_service import DOC_PROGRESS_FULL_SWEEP_TICKS, DocumentService, mark_docs_progress_changed
+from api.utils import get_uuid
+
+
+def create_backlog(kb_id, n_docs, n_tasks):
+    now = datetime.now()
+    docs, tasks = [], []
+    for _ in range(n_docs):
+        doc_id = get_uuid()
+        docs.append({"id": doc_id, "kb_id": kb_id, "parser_id": "naive", "parser_config": {"pages": [[1, 1000000]]},
+                     "type": "pdf", "suffix": "pdf", "created_by": "doc_progress_load", "name": f"{doc_id}.pdf",
+                     "progress": random.uniform(0.01, 0.5), "process_begin_at": now, "run": TaskStatus.RUNNING.value})
+        for i in range(n_tasks):
+            tasks.append({"id": get_uuid(), "doc_id": doc_id, "from_page": 12 * i, "to_page": 12 * (i + 1),
+                          "progress": random.uniform(0, 0.5), "progress_msg": "Synthetic task of doc_progress_load"})
+    bulk_insert_into_db(Document, docs, True)
+    bulk_insert_into_db(Task, tasks, True)
+    return [d["id"] for d in docs]
+
+
+def remove_backlog(kb_id, doc_ids):
+    for i in range(0, len(doc_ids), 1000):
+        Task.delete().where(Task.doc_id.in_(doc_ids[i:i + 1000])).execute()
+    Document.delete().where(Document.kb_id == kb_id).execute()
+
+
+def run(n_docs, n_tasks, n_changed, ticks):
+    kb_id = get_uuid()
+    st = timer()
+    doc_ids = create_backlog(kb_id, n_docs, n_tasks)
+    logging.info(f"Inserted {n_docs} documents and {n_docs * n_tasks} tasks in {timer() - st:.2f}s")
+    elapsed = {"full": [], "incremental": []}
+    try:
+        for _ in range(ticks):
+            changed = random.sample(doc_ids, min(n_changed, len(doc_ids)))
+            with DB.connection_context():
+                Task.update(progress=Task.progress + 0.01).where(Task.doc_id.in_(changed)).execute()
+            mark_docs_progress_changed(changed)
+
+            kind = "full" if DocumentService._progress_ticks % max(DOC_PROGRESS_FULL_SWEEP_TICKS, 1) == 0 else "incremental"
+            st = timer()
+            DocumentService.update_progress()
+            elapsed[kind].append(timer() - st)
+            logging.info(f"{kind} tick: {elapsed[kind][-1] * 1000:.1f}ms")
+    finally:
+        remove_backlog(kb_id, doc_ids)
+    for kind, els in elapsed.items():
+        if els:
+            logging.info(f"{kind}: {len(els)} ticks, avg {sum(els) / len(els) * 1000:.1f}ms, max {max(els) * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=50000)
+    parser.add_argument("--tasks", type=int, default=2, help="tasks per document")
+    parser.add_argument("--changed", type=int, default=200, help="documents with progress per tick")
+    parser.add_argument("--ticks", type=int, default=20)
+    args = parser.parse_args()
+    settings.init_settings()
+    run(args.docs, args.tasks, args.changed, args.ticks)
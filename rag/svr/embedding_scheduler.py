@@ -0,0 +1,276 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import logging
+import re
+from collections import deque
+from timeit import default_timer as timer
+
+import numpy as np
+import trio
+
+from api.utils.api_utils import timeout
+from rag.settings import EMBEDDING_BATCH_SIZE, EMBEDDING_MAX_BATCH_SIZE, EMBEDDING_TOKEN_BUDGET, EMBEDDING_BATCH_LINGER
+from rag.utils import num_tokens_from_string
+from rag.utils.embedding_cache import EMBED_CACHE
+
+
+class _Request:
+    def __init__(self, mdl, texts):
+        self.mdl = mdl
+        self.vectors = [None] * len(texts)
+        self.token_count = 0.
+        self.remaining = len(texts)
+        self.queued = 0
+        self.error = None
+        self.done = trio.Event()
+
+    def fail(self, error):
+        if self.done.is_set():
+            return
+        self.error = error
+        self.done.set()
+
+
+class _Item:
+    __slots__ = ("req", "idx", "text", "tokens", "attempts")
+
+    def __init__(self, req, idx, text):
+        self.req = req
+        self.idx = idx
+        self.text = text
+        self.tokens = max(num_tokens_from_string(text), 1)
+        self.attempts = 0
+
+
+class _Lane:
+    """Pending texts and the adaptive batch size of one (tenant, embedding model)."""
+
+    def __init__(self, request_size, max_batch_size=EMBEDDING_MAX_BATCH_SIZE):
+        self.items = deque()
+        self.tokens = 0
+        # Texts per request to the provider: encode() cuts a larger batch into several requests.
+        self.request_size = max(request_size, 1)
+        self.max_batch_size = max(max_batch_size, 1)
+        self.batch_size = max(min(EMBEDDING_BATCH_SIZE, self.max_batch_size), 1)
+        # trio time before which no batch is sent, set when the provider asks to back off.
+        self.resume_at = 0.
+
+    def budget(self, token_budget):
+        """The token budget applies to each provider request of a batch."""
+        return token_budget * -(-self.batch_size // self.request_size)
+
+    def take(self, token_budget):
+        batch, tokens = [], 0
+        token_budget = self.budget(token_budget)
+        while self.items and len(batch) < self.batch_size:
+            if batch and tokens + self.items[0].tokens > token_budget:
+                break
+            it = self.items.popleft()
+            self.tokens -= it.tokens
+            it.req.queued -= 1
+            if it.req.done.is_set():
+                # Its request has already failed.
+                continue
+            tokens += it.tokens
+            batch.append(it)
+        return batch
+
+    def append(self, it):
+        self.items.append(it)
+        self.tokens += it.tokens
+        it.req.queued += 1
+
+    def requeue(self, batch):
+        for it in reversed(batch):
+            self.items.appendleft(it)
+            self.tokens += it.tokens
+            it.req.queued += 1
+
+    def full(self, token_budget):
+        return len(self.items) >= self.batch_size or self.tokens >= self.budget(token_budget)
+
+    def paused(self):
+        return self.resume_at > trio.current_time()
+
+
+class EmbeddingScheduler:
+    """
+    Per-process embedding batcher shared by all the tasks running in a trio loop.
+
+    Texts submitted through `encode` by concurrent callers using the same tenant and
+    embedding model are merged into batches. The batch size starts at EMBEDDING_BATCH_SIZE,
+    grows up to EMBEDDING_MAX_BATCH_SIZE while calls stay fast and shrinks on slow calls,
+    rate limiting (429) and timeouts, in which case the batch is retried after a backoff.
+    The model class cuts a batch into requests of at most its `_BATCH_SIZE` texts, the
+    provider's limit, and each of these requests carries at most the token budget.
+    """
+
+    RETRYABLE = re.compile(r"(429|rate.?limit|too many requests|timed? ?out|throttl)", re.IGNORECASE)
+
+    def __init__(self, limiter: trio.CapacityLimiter, token_budget=EMBEDDING_TOKEN_BUDGET,
+                 linger=EMBEDDING_BATCH_LINGER, target_latency=5.0, max_attempts=3):
+        self.limiter = limiter
+        self.token_budget = token_budget
+        self.linger = linger
+        self.target_latency = target_latency
+        self.max_attempts = max_attempts
+        self._lanes = {}
+        self.stats = {"batches": 0, "texts": 0, "retries": 0}
+
+    @staticmethod
+    def _lane_key(mdl):
+        return getattr(mdl, "tenant_id", None), getattr(mdl, "llm_name", None) or id(mdl)
+
+    @staticmethod
+    def _request_size(mdl):
+        return getattr(getattr(mdl, "mdl", mdl), "_BATCH_SIZE", EMBEDDING_BATCH_SIZE)
+
+    async def encode(self, mdl, texts: list):
+        """
+        Same contract as `mdl.encode(texts)`: returns the vectors and the token count,
+        the latter being this call's share of the tokens reported for merged batches.
+        Texts found in the embedding cache are not sent to the model at all.
+        """
+        if not texts:
+            return np.array([]), 0
+        cache_nm = getattr(mdl, "cache_name", None)
+        if not cache_nm:
+            return await self._encode(mdl, texts)
+
+        vects = await trio.to_thread.run_sync(lambda: EMBED_CACHE.get_many(cache_nm, texts))
+        missed = [i for i, v in enumerate(vects) if v is None]
+        if not missed:
+            return np.array(vects), 0
+        missed_texts = [texts[i] for i in missed]
+        vts, tk_count = await self._encode(mdl, missed_texts)
+        for i, v in zip(missed, vts):
+            vects[i] = v
+        await trio.to_thread.run_sync(lambda: EMBED_CACHE.set_many(cache_nm, missed_texts, vts))
+        return np.array(vects), tk_count
+
+    async def _encode(self, mdl, texts: list):
+        key = self._lane_key(mdl)
+        if key not in self._lanes:
+            self._lanes[key] = _Lane(self._request_size(mdl))
+        lane = self._lanes[key]
+
+        req = _Request(mdl, texts)
+        for i, t in enumerate(texts):
+            lane.append(_Item(req, i, t))
+
+        while not req.done.is_set():
+            if not req.queued:
+                # Every text of this request has been picked up by other callers.
+                # Wake up now and then in case a failed batch was put back in the queue.
+                with trio.move_on_after(1):
+                    await req.done.wait()
+                continue
+            if lane.paused():
+                # Back off without holding the limiter, which the other lanes need.
+                await trio.sleep_until(lane.resume_at)
+                continue
+            if not lane.full(self.token_budget):
+                # Give concurrent tasks a chance to fill the batch.
+                await trio.sleep(self.linger)
+            async with self.limiter:
+                if lane.paused():
+                    continue
+                batch = lane.take(self.token_budget)
+                if not batch:
+                    continue
+                try:
+                    await self._run(lane, batch)
+                except BaseException:
+                    # This caller is cancelled: its request is abandoned, and the texts of the
+                    # others it took are put back for their own callers.
+                    req.fail(trio.Cancelled)
+                    lane.requeue([it for it in batch if not it.req.done.is_set() and it.req.vectors[it.idx] is None])
+                    raise
+
+        if req.error:
+            raise req.error
+        return np.array(req.vectors), int(round(req.token_count))
+
+    async def _encode_batch(self, batch):
+        mdl = batch[0].req.mdl
+
+        @timeout(60)
+        def batch_encode(txts):
+            return mdl.encode(txts)
+
+        return await trio.to_thread.run_sync(lambda: batch_encode([it.text for it in batch]))
+
+    async def _run(self, lane, batch):
+        st = timer()
+        try:
+            vts, c = await self._encode_batch(batch)
+        except Exception as e:
+            retryable = isinstance(e, (TimeoutError, trio.TooSlowError)) or self.RETRYABLE.search(str(e))
+            for it in batch:
+                it.attempts += 1
+            if retryable and all(it.attempts < self.max_attempts for it in batch):
+                lane.batch_size = max(lane.batch_size // 2, 1)
+                self.stats["retries"] += 1
+                logging.warning(f"EmbeddingScheduler: batch of {len(batch)} got {e}, retry with batch size {lane.batch_size}")
+                lane.requeue(batch)
+                lane.resume_at = trio.current_time() + min(2 ** batch[0].attempts, 30)
+                return
+            await self._run_alone(batch, e)
+            return
+
+        el = timer() - st
+        if el > self.target_latency:
+            lane.batch_size = max(int(lane.batch_size * 0.75), 1)
+        elif len(batch) >= lane.batch_size:
+            lane.batch_size = min(lane.batch_size + max(lane.batch_size // 4, 1), lane.max_batch_size)
+        self._deliver(batch, vts, c)
+
+    async def _run_alone(self, batch, error):
+        """
+        A failed batch merging several requests may have failed for the texts of one of them only:
+        the texts of each request are tried on their own before that request fails.
+        """
+        requests = {}
+        for it in batch:
+            requests.setdefault(id(it.req), []).append(it)
+        if len(requests) == 1:
+            batch[0].req.fail(error)
+            return
+        logging.warning(f"EmbeddingScheduler: batch of {len(requests)} requests got {error}, trying each on its own")
+        for items in requests.values():
+            if items[0].req.done.is_set():
+                continue
+            try:
+                vts, c = await self._encode_batch(items)
+            except Exception as e:
+                items[0].req.fail(e)
+                continue
+            self._deliver(items, vts, c)
+
+    def _deliver(self, batch, vts, c):
+        self.stats["batches"] += 1
+        self.stats["texts"] += len(batch)
+
+        total_tokens = sum(it.tokens for it in batch)
+        for it, v in zip(batch, vts):
+            req = it.req
+            if req.done.is_set():
+                continue
+            req.vectors[it.idx] = v
+            req.token_count += c * it.tokens / total_tokens
+            req.remaining -= 1
+            if req.remaining == 0:
+                req.done.set()
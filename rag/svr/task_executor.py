@@ -24,7 +24,7 @@ import time
 from api.utils.api_utils import timeout
 from api.utils.log_utils import init_root_logger, get_project_base_directory
 from graphrag.general.index import run_graphrag
-from graphrag.utils import get_llm_cache, set_llm_cache, get_tags_from_cache, set_tags_to_cache
+from graphrag.utils import get_llm_cache_many, set_llm_cache_many, get_tags_from_cache, set_tags_to_cache
 from rag.prompts import keyword_extraction, question_proposal, content_tagging
 
 import logging
@@ -50,18 +50,20 @@ from peewee import DoesNotExist
 from api.db import LLMType, ParserType
 from api.db.services.document_service import DocumentService
 from api.db.services.llm_service import LLMBundle
-from api.db.services.task_service import TaskService, has_canceled
+from api.db.services.tenant_llm_service import TOKEN_USAGE
+from api.db.services.task_service import TaskService, ProgressAggregator, has_canceled, async_has_canceled
 from api.db.services.file2document_service import File2DocumentService
 from api import settings
 from api.versions import get_ragflow_version
-from api.db.db_models import close_connection
+from deepdoc.vision.session_pool import session_pool_stats
 from rag.app import laws, paper, presentation, manual, qa, table, book, resume, picture, naive, one, audio, \
     email, tag
 from rag.nlp import search, rag_tokenizer
-from rag.raptor import RecursiveAbstractiveProcessing4TreeOrganizedRetrieval as Raptor
-from rag.settings import DOC_MAXIMUM_SIZE, DOC_BULK_SIZE, EMBEDDING_BATCH_SIZE, SVR_CONSUMER_GROUP_NAME, get_svr_queue_name, get_svr_queue_names, print_rag_settings, TAG_FLD, PAGERANK_FLD
+from rag.raptor import RecursiveAbstractiveProcessing4TreeOrganizedRetrieval as Raptor, checkpoint_key as raptor_checkpoint_key
+from rag.svr.embedding_scheduler import EmbeddingScheduler
+from rag.settings import DOC_MAXIMUM_SIZE, SVR_CONSUMER_GROUP_NAME, get_svr_queue_name, get_svr_queue_names, print_rag_settings, TAG_FLD, PAGERANK_FLD
 from rag.utils import num_tokens_from_string, truncate
-from rag.utils.redis_conn import REDIS_CONN, RedisDistributedLock
+from rag.utils.redis_conn import REDIS_CONN, RedisDistributedLock, RedisStreamConsumer
 from rag.utils.storage_factory import STORAGE_IMPL
 from graphrag.utils import chat_limiter
 
@@ -104,9 +106,16 @@ MAX_CONCURRENT_MINIO = int(os.environ.get('MAX_CONCURRENT_MINIO', '10'))
 task_limiter = trio.Semaphore(MAX_CONCURRENT_TASKS)
 chunk_limiter = trio.CapacityLimiter(MAX_CONCURRENT_CHUNK_BUILDERS)
 embed_limiter = trio.CapacityLimiter(MAX_CONCURRENT_CHUNK_BUILDERS)
+EMBEDDING_SCHEDULER = EmbeddingScheduler(embed_limiter)
 minio_limiter = trio.CapacityLimiter(MAX_CONCURRENT_MINIO)
 kg_limiter = trio.CapacityLimiter(2)
+PIPELINE_BATCH_SIZE = int(os.environ.get('PIPELINE_BATCH_SIZE', "64"))
+PIPELINE_QUEUE_DEPTH = int(os.environ.get('PIPELINE_QUEUE_DEPTH', "2"))
+PIPELINE_STATS = {}
+PROGRESS = ProgressAggregator()
 WORKER_HEARTBEAT_TIMEOUT = int(os.environ.get('WORKER_HEARTBEAT_TIMEOUT', '120'))
+TASK_CONSUMER = RedisStreamConsumer(REDIS_CONN, get_svr_queue_names(), SVR_CONSUMER_GROUP_NAME, CONSUMER_NAME,
+                                    reclaim_idle_ms=int(os.environ.get('TASK_RECLAIM_IDLE_SECONDS', 30 * 60)) * 1000)
 stop_event = threading.Event()
 
 
@@ -174,9 +183,7 @@ def set_progress(task_id, from_page=0, to_page=-1, prog=None, msg="Processing...
         if prog is not None:
             d["progress"] = prog
 
-        TaskService.update_progress(task_id, d)
-
-        close_connection()
+        PROGRESS.add(task_id, d)
         if cancel:
             raise TaskCanceledException(msg)
         logging.info(f"set_progress({task_id}), progress: {prog}, progress_msg: {msg}")
@@ -197,12 +204,11 @@ async def collect():
         try:
             redis_msg = next(UNACKED_ITERATOR)
         except StopIteration:
-            for svr_queue_name in svr_queue_names:
-                redis_msg = REDIS_CONN.queue_consumer(svr_queue_name, SVR_CONSUMER_GROUP_NAME, CONSUMER_NAME)
-                if redis_msg:
-                    break
+            # Prefetch as many tasks as this executor has free slots, this one included.
+            redis_msg = await TASK_CONSUMER.get(task_limiter.value + 1)
     except Exception:
         logging.exception("collect got exception")
+        await trio.sleep(1)
         return None, None
 
     if not redis_msg:
@@ -216,7 +222,7 @@ async def collect():
     canceled = False
     task = TaskService.get_task(msg["id"])
     if task:
-        canceled = has_canceled(task["id"])
+        canceled = await async_has_canceled(task["id"])
     if not task or canceled:
         state = "is unknown" if not task else "has been cancelled"
         FAILED_TASKS += 1
@@ -232,7 +238,7 @@ async def get_storage_binary(bucket, name):
 
 
 @timeout(60*80, 1)
-async def build_chunks(task, progress_callback):
+async def parse_chunks(task, progress_callback):
     if task["size"] > DOC_MAXIMUM_SIZE:
         set_progress(task["id"], prog=-1, msg="File size exceeds( <= %dMb )" %
                                               (int(DOC_MAXIMUM_SIZE / 1024 / 1024)))
@@ -269,134 +275,163 @@ async def build_chunks(task, progress_callback):
         progress_callback(-1, "Internal server error while chunking: %s" % str(e).replace("'", ""))
         logging.exception("Chunking {}/{} got exception".format(task["location"], task["name"]))
         raise
+    return cks
 
-    docs = []
+
+@timeout(60)
+async def upload_to_minio(task, document, chunk, docs):
+    try:
+        d = copy.deepcopy(document)
+        d.update(chunk)
+        d["id"] = xxhash.xxh64((chunk["content_with_weight"] + str(d["doc_id"])).encode("utf-8", "surrogatepass")).hexdigest()
+        d["create_time"] = str(datetime.now()).replace("T", " ")[:19]
+        d["create_timestamp_flt"] = datetime.now().timestamp()
+        if not d.get("image"):
+            _ = d.pop("image", None)
+            d["img_id"] = ""
+            docs.append(d)
+            return
+
+        with BytesIO() as output_buffer:
+            if isinstance(d["image"], bytes):
+                output_buffer.write(d["image"])
+                output_buffer.seek(0)
+            else:
+                # If the image is in RGBA mode, convert it to RGB mode before saving it in JPEG format.
+                if d["image"].mode in ("RGBA", "P"):
+                    converted_image = d["image"].convert("RGB")
+                    #d["image"].close()  # Close original image
+                    d["image"] = converted_image
+                try:
+                    d["image"].save(output_buffer, format='JPEG')
+                except OSError as e:
+                    logging.warning(
+                        "Saving image of chunk {}/{}/{} got exception, ignore: {}".format(task["location"], task["name"], d["id"], str(e)))
+
+            async with minio_limiter:
+                await trio.to_thread.run_sync(lambda: STORAGE_IMPL.put(task["kb_id"], d["id"], output_buffer.getvalue()))
+            d["img_id"] = "{}-{}".format(task["kb_id"], d["id"])
+            if not isinstance(d["image"], bytes):
+                d["image"].close()
+            del d["image"]  # Remove image reference
+            chunk.pop("image", None)
+            docs.append(d)
+    except Exception:
+        logging.exception(
+            "Saving image of chunk {}/{}/{} got exception".format(task["location"], task["name"], d["id"]))
+        raise
+
+
+async def upload_chunk_images(task, cks):
     doc = {
         "doc_id": task["doc_id"],
         "kb_id": str(task["kb_id"])
     }
     if task["pagerank"]:
         doc[PAGERANK_FLD] = int(task["pagerank"])
-    st = timer()
-
-    @timeout(60)
-    async def upload_to_minio(document, chunk):
-        try:
-            d = copy.deepcopy(document)
-            d.update(chunk)
-            d["id"] = xxhash.xxh64((chunk["content_with_weight"] + str(d["doc_id"])).encode("utf-8", "surrogatepass")).hexdigest()
-            d["create_time"] = str(datetime.now()).replace("T", " ")[:19]
-            d["create_timestamp_flt"] = datetime.now().timestamp()
-            if not d.get("image"):
-                _ = d.pop("image", None)
-                d["img_id"] = ""
-                docs.append(d)
-                return
-
-            with BytesIO() as output_buffer:
-                if isinstance(d["image"], bytes):
-                    output_buffer.write(d["image"])
-                    output_buffer.seek(0)
-                else:
-                    # If the image is in RGBA mode, convert it to RGB mode before saving it in JPEG format.
-                    if d["image"].mode in ("RGBA", "P"):
-                        converted_image = d["image"].convert("RGB")
-                        #d["image"].close()  # Close original image
-                        d["image"] = converted_image
-                    try:
-                        d["image"].save(output_buffer, format='JPEG')
-                    except OSError as e:
-                        logging.warning(
-                            "Saving image of chunk {}/{}/{} got exception, ignore: {}".format(task["location"], task["name"], d["id"], str(e)))
-
-                async with minio_limiter:
-                    await trio.to_thread.run_sync(lambda: STORAGE_IMPL.put(task["kb_id"], d["id"], output_buffer.getvalue()))
-                d["img_id"] = "{}-{}".format(task["kb_id"], d["id"])
-                if not isinstance(d["image"], bytes):
-                    d["image"].close()
-                del d["image"]  # Remove image reference
-                docs.append(d)
-        except Exception:
-            logging.exception(
-                "Saving image of chunk {}/{}/{} got exception".format(task["location"], task["name"], d["id"]))
-            raise
 
+    docs = []
     async with trio.open_nursery() as nursery:
         for ck in cks:
-            nursery.start_soon(upload_to_minio, doc, ck)
+            nursery.start_soon(upload_to_minio, task, doc, ck, docs)
+    return docs
 
-    el = timer() - st
-    logging.info("MINIO PUT({}) cost {:.3f} s".format(task["name"], el))
 
-    if task["parser_config"].get("auto_keywords", 0):
-        st = timer()
+def init_enrichment(task, progress_callback):
+    """
+    Prepare what the LLM enrichment stage needs once per task, so that every batch
+    flowing through the pipeline reuses the same chat model, tag set and examples.
+    """
+    ctx = {}
+    parser_config = task["parser_config"]
+    kb_parser_config = task["kb_parser_config"]
+    if not parser_config.get("auto_keywords", 0) and not parser_config.get("auto_questions", 0) \
+            and not kb_parser_config.get("tag_kb_ids", []):
+        return ctx
+
+    ctx["chat_mdl"] = LLMBundle(task["tenant_id"], LLMType.CHAT, llm_name=task["llm_id"], lang=task["language"])
+    if parser_config.get("auto_keywords", 0):
         progress_callback(msg="Start to generate keywords for every chunk ...")
-        chat_mdl = LLMBundle(task["tenant_id"], LLMType.CHAT, llm_name=task["llm_id"], lang=task["language"])
+    if parser_config.get("auto_questions", 0):
+        progress_callback(msg="Start to generate questions for every chunk ...")
+    if kb_parser_config.get("tag_kb_ids", []):
+        progress_callback(msg="Start to tag for every chunk ...")
+        kb_ids = kb_parser_config["tag_kb_ids"]
+        ctx["S"] = 1000
+        all_tags = get_tags_from_cache(kb_ids)
+        if not all_tags:
+            all_tags = settings.retrievaler.all_tags_in_portion(task["tenant_id"], kb_ids, ctx["S"])
+            set_tags_to_cache(kb_ids, all_tags)
+        else:
+            all_tags = json.loads(all_tags)
+        ctx["all_tags"] = all_tags
+        ctx["examples"] = []
+    return ctx
+
+
+async def enrich_chunks(task, docs, ctx):
+    if not ctx:
+        return docs
+    chat_mdl = ctx["chat_mdl"]
 
-        async def doc_keyword_extraction(chat_mdl, d, topn):
-            cached = get_llm_cache(chat_mdl.llm_name, d["content_with_weight"], "keywords", {"topn": topn})
+    if task["parser_config"].get("auto_keywords", 0):
+        topn = task["parser_config"]["auto_keywords"]
+        cached_all = await trio.to_thread.run_sync(lambda: get_llm_cache_many(chat_mdl.llm_name, [d["content_with_weight"] for d in docs], "keywords", {"topn": topn}))
+        generated = {}
+
+        async def doc_keyword_extraction(chat_mdl, d, cached, topn):
             if not cached:
                 async with chat_limiter:
                     cached = await trio.to_thread.run_sync(lambda: keyword_extraction(chat_mdl, d["content_with_weight"], topn))
-                set_llm_cache(chat_mdl.llm_name, d["content_with_weight"], cached, "keywords", {"topn": topn})
+                generated[d["content_with_weight"]] = cached
             if cached:
                 d["important_kwd"] = cached.split(",")
                 d["important_tks"] = rag_tokenizer.tokenize(" ".join(d["important_kwd"]))
             return
         async with trio.open_nursery() as nursery:
-            for d in docs:
-                nursery.start_soon(doc_keyword_extraction, chat_mdl, d, task["parser_config"]["auto_keywords"])
-        progress_callback(msg="Keywords generation {} chunks completed in {:.2f}s".format(len(docs), timer() - st))
+            for d, cached in zip(docs, cached_all):
+                nursery.start_soon(doc_keyword_extraction, chat_mdl, d, cached, topn)
+        await trio.to_thread.run_sync(lambda: set_llm_cache_many(chat_mdl.llm_name, generated, "keywords", {"topn": topn}))
 
     if task["parser_config"].get("auto_questions", 0):
-        st = timer()
-        progress_callback(msg="Start to generate questions for every chunk ...")
-        chat_mdl = LLMBundle(task["tenant_id"], LLMType.CHAT, llm_name=task["llm_id"], lang=task["language"])
+        topn = task["parser_config"]["auto_questions"]
+        cached_all = await trio.to_thread.run_sync(lambda: get_llm_cache_many(chat_mdl.llm_name, [d["content_with_weight"] for d in docs], "question", {"topn": topn}))
+        generated = {}
 
-        async def doc_question_proposal(chat_mdl, d, topn):
-            cached = get_llm_cache(chat_mdl.llm_name, d["content_with_weight"], "question", {"topn": topn})
+        async def doc_question_proposal(chat_mdl, d, cached, topn):
             if not cached:
                 async with chat_limiter:
                     cached = await trio.to_thread.run_sync(lambda: question_proposal(chat_mdl, d["content_with_weight"], topn))
-                set_llm_cache(chat_mdl.llm_name, d["content_with_weight"], cached, "question", {"topn": topn})
+                generated[d["content_with_weight"]] = cached
             if cached:
                 d["question_kwd"] = cached.split("\n")
                 d["question_tks"] = rag_tokenizer.tokenize("\n".join(d["question_kwd"]))
         async with trio.open_nursery() as nursery:
-            for d in docs:
-                nursery.start_soon(doc_question_proposal, chat_mdl, d, task["parser_config"]["auto_questions"])
-        progress_callback(msg="Question generation {} chunks completed in {:.2f}s".format(len(docs), timer() - st))
+            for d, cached in zip(docs, cached_all):
+                nursery.start_soon(doc_question_proposal, chat_mdl, d, cached, topn)
+        await trio.to_thread.run_sync(lambda: set_llm_cache_many(chat_mdl.llm_name, generated, "question", {"topn": topn}))
 
     if task["kb_parser_config"].get("tag_kb_ids", []):
-        progress_callback(msg="Start to tag for every chunk ...")
         kb_ids = task["kb_parser_config"]["tag_kb_ids"]
         tenant_id = task["tenant_id"]
         topn_tags = task["kb_parser_config"].get("topn_tags", 3)
-        S = 1000
-        st = timer()
-        examples = []
-        all_tags = get_tags_from_cache(kb_ids)
-        if not all_tags:
-            all_tags = settings.retrievaler.all_tags_in_portion(tenant_id, kb_ids, S)
-            set_tags_to_cache(kb_ids, all_tags)
-        else:
-            all_tags = json.loads(all_tags)
-
-        chat_mdl = LLMBundle(task["tenant_id"], LLMType.CHAT, llm_name=task["llm_id"], lang=task["language"])
+        S = ctx["S"]
+        all_tags = ctx["all_tags"]
+        examples = ctx["examples"]
 
         docs_to_tag = []
         for d in docs:
-            task_canceled = has_canceled(task["id"])
-            if task_canceled:
-                progress_callback(-1, msg="Task has been canceled.")
+            if await async_has_canceled(task["id"]):
                 return
             if settings.retrievaler.tag_content(tenant_id, kb_ids, d, all_tags, topn_tags=topn_tags, S=S) and len(d[TAG_FLD]) > 0:
                 examples.append({"content": d["content_with_weight"], TAG_FLD: d[TAG_FLD]})
             else:
                 docs_to_tag.append(d)
 
-        async def doc_content_tagging(chat_mdl, d, topn_tags):
-            cached = get_llm_cache(chat_mdl.llm_name, d["content_with_weight"], all_tags, {"topn": topn_tags})
+        cached_all = await trio.to_thread.run_sync(lambda: get_llm_cache_many(chat_mdl.llm_name, [d["content_with_weight"] for d in docs_to_tag], all_tags, {"topn": topn_tags}))
+        generated = {}
+
+        async def doc_content_tagging(chat_mdl, d, cached, topn_tags):
             if not cached:
                 picked_examples = random.choices(examples, k=2) if len(examples)>2 else examples
                 if not picked_examples:
@@ -405,17 +440,80 @@ async def build_chunks(task, progress_callback):
                     cached = await trio.to_thread.run_sync(lambda: content_tagging(chat_mdl, d["content_with_weight"], all_tags, picked_examples, topn=topn_tags))
                 if cached:
                     cached = json.dumps(cached)
+                    generated[d["content_with_weight"]] = cached
             if cached:
-                set_llm_cache(chat_mdl.llm_name, d["content_with_weight"], cached, all_tags, {"topn": topn_tags})
                 d[TAG_FLD] = json.loads(cached)
         async with trio.open_nursery() as nursery:
-            for d in docs_to_tag:
-                nursery.start_soon(doc_content_tagging, chat_mdl, d, topn_tags)
-        progress_callback(msg="Tagging {} chunks completed in {:.2f}s".format(len(docs), timer() - st))
+            for d, cached in zip(docs_to_tag, cached_all):
+                nursery.start_soon(doc_content_tagging, chat_mdl, d, cached, topn_tags)
+        await trio.to_thread.run_sync(lambda: set_llm_cache_many(chat_mdl.llm_name, generated, all_tags, {"topn": topn_tags}))
 
     return docs
 
 
+def pipeline_batches(items, batch_size=PIPELINE_BATCH_SIZE):
+    """
+    Yield batches while dropping them from `items`, so that chunks (and their images)
+    are only referenced by the pipeline stage currently holding them.
+    """
+    while items:
+        batch = items[:batch_size]
+        del items[:batch_size]
+        yield batch
+
+
+async def run_pipeline(batches, stages, stats=None):
+    """
+    Run `batches` through `stages`, a list of (name, async fn(batch) -> batch).
+    Stages are connected by channels holding at most PIPELINE_QUEUE_DEPTH batches,
+    so a slow stage applies back pressure on the ones before it while all of them
+    work concurrently. A stage returning None aborts the whole pipeline.
+    Returns True if every batch went through every stage.
+    """
+    if stats is None:
+        stats = {}
+    completed = True
+
+    async def source(send_channel):
+        async with send_channel:
+            for batch in batches:
+                await send_channel.send(batch)
+
+    async def stage(name, fn, receive_channel, send_channel, cancel_scope):
+        nonlocal completed
+        async with receive_channel, send_channel:
+            async for batch in receive_channel:
+                st = timer()
+                size = len(batch)
+                batch = await fn(batch)
+                el = timer() - st
+                for s in [stats, PIPELINE_STATS]:
+                    s.setdefault(name, {"batches": 0, "chunks": 0, "elapsed": 0.})
+                    s[name]["batches"] += 1
+                    s[name]["chunks"] += size
+                    s[name]["elapsed"] += el
+                if batch is None:
+                    completed = False
+                    cancel_scope.cancel()
+                    return
+                await send_channel.send(batch)
+
+    async def sink(receive_channel):
+        async with receive_channel:
+            async for _ in receive_channel:
+                pass
+
+    async with trio.open_nursery() as nursery:
+        send_channel, receive_channel = trio.open_memory_channel(PIPELINE_QUEUE_DEPTH)
+        nursery.start_soon(source, send_channel)
+        for name, fn in stages:
+            next_send_channel, next_receive_channel = trio.open_memory_channel(PIPELINE_QUEUE_DEPTH)
+            nursery.start_soon(stage, name, fn, receive_channel, next_send_channel, nursery.cancel_scope)
+            receive_channel = next_receive_channel
+        nursery.start_soon(sink, receive_channel)
+    return completed
+
+
 def init_kb(row, vector_size: int):
     idxnm = search.index_name(row["tenant_id"])
     return settings.docStoreConn.createIdx(idxnm, row.get("kb_id", ""), vector_size)
@@ -437,26 +535,14 @@ async def embedding(docs, mdl, parser_config=None, callback=None):
 
     tk_count = 0
     if len(tts) == len(cnts):
-        vts, c = await trio.to_thread.run_sync(lambda: mdl.encode(tts[0: 1]))
+        vts, c = await EMBEDDING_SCHEDULER.encode(mdl, tts[0: 1])
         tts = np.concatenate([vts for _ in range(len(tts))], axis=0)
         tk_count += c
 
-    @timeout(60)
-    def batch_encode(txts):
-        nonlocal mdl
-        return mdl.encode([truncate(c, mdl.max_length-10) for c in txts])
-
-    cnts_ = np.array([])
-    for i in range(0, len(cnts), EMBEDDING_BATCH_SIZE):
-        async with embed_limiter:
-            vts, c = await trio.to_thread.run_sync(lambda: batch_encode(cnts[i: i + EMBEDDING_BATCH_SIZE]))
-        if len(cnts_) == 0:
-            cnts_ = vts
-        else:
-            cnts_ = np.concatenate((cnts_, vts), axis=0)
-        tk_count += c
-        callback(prog=0.7 + 0.2 * (i + 1) / len(cnts), msg="")
-    cnts = cnts_
+    cnts, c = await EMBEDDING_SCHEDULER.encode(mdl, [truncate(c, mdl.max_length-10) for c in cnts])
+    tk_count += c
+    if callback:
+        callback(prog=0.9, msg="")
     filename_embd_weight = parser_config.get("filename_embd_weight", 0.1) # due to the db support none value
     if not filename_embd_weight:
         filename_embd_weight = 0.1
@@ -487,10 +573,13 @@ async def run_raptor(row, chat_mdl, embd_mdl, vector_size, callback=None):
         embd_mdl,
         row["parser_config"]["raptor"]["prompt"],
         row["parser_config"]["raptor"]["max_token"],
-        row["parser_config"]["raptor"]["threshold"]
+        row["parser_config"]["raptor"]["threshold"],
+        row["parser_config"]["raptor"].get("clustering", "gmm")
     )
     original_length = len(chunks)
-    chunks = await raptor(chunks, row["parser_config"]["raptor"]["random_seed"], callback)
+    checkpoint_key = raptor_checkpoint_key(row["doc_id"], row["parser_config"]["raptor"], chat_mdl, embd_mdl, chunks)
+    chunks = await raptor(chunks, row["parser_config"]["raptor"]["random_seed"], callback, checkpoint_key)
+    REDIS_CONN.delete(checkpoint_key)
     doc = {
         "doc_id": row["doc_id"],
         "kb_id": [str(row["kb_id"])],
@@ -540,7 +629,7 @@ async def do_handle_task(task):
         progress_callback(-1, msg=error_message)
         raise Exception(error_message)
 
-    task_canceled = has_canceled(task_id)
+    task_canceled = await async_has_canceled(task_id)
     if task_canceled:
         progress_callback(-1, msg="Task has been canceled.")
         return
@@ -558,6 +647,67 @@ async def do_handle_task(task):
 
     init_kb(task, vector_size)
 
+    async def delete_image(kb_id, chunk_id):
+        try:
+            async with minio_limiter:
+                STORAGE_IMPL.delete(kb_id, chunk_id)
+        except Exception:
+            logging.exception(
+                "Deleting image of chunk {}/{}/{} got exception".format(task["location"], task["name"], chunk_id))
+            raise
+
+    chunk_ids = []
+    total_chunks = 0
+    token_count = 0
+    stage_stats = {}
+
+    async def remove_inserted_chunks():
+        doc_store_result = await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"id": chunk_ids}, search.index_name(task_tenant_id), task_dataset_id))
+        async with trio.open_nursery() as nursery:
+            for chunk_id in chunk_ids:
+                nursery.start_soon(delete_image, task_dataset_id, chunk_id)
+        return doc_store_result
+
+    async def run_insert_pipeline(batches, stages):
+        # The batches are inserted one after another: if a later one fails, remove the ones
+        # already in the index, so that a failed task leaves no partial document behind.
+        try:
+            return await run_pipeline(batches, stages, stage_stats)
+        except Exception:
+            if chunk_ids:
+                logging.warning(f"Removing {len(chunk_ids)} chunks inserted by failed task {task_id}")
+                try:
+                    await remove_inserted_chunks()
+                except Exception:
+                    logging.exception(f"Removing the chunks inserted by failed task {task_id} got exception")
+            raise
+
+    # The document stores split a pipeline batch into bulk requests themselves.
+    bulk_size = PIPELINE_BATCH_SIZE
+
+    async def insert_batch(chunks):
+        for b in range(0, len(chunks), bulk_size):
+            doc_store_result = await trio.to_thread.run_sync(lambda: settings.docStoreConn.insert(chunks[b:b + bulk_size], search.index_name(task_tenant_id), task_dataset_id))
+            task_canceled = await async_has_canceled(task_id)
+            if task_canceled:
+                progress_callback(-1, msg="Task has been canceled.")
+                return
+            if doc_store_result:
+                error_message = f"Insert chunk error: {doc_store_result}, please check log file and Elasticsearch/Infinity status!"
+                progress_callback(-1, msg=error_message)
+                raise Exception(error_message)
+            chunk_ids.extend([chunk["id"] for chunk in chunks[b:b + bulk_size]])
+            chunk_ids_str = " ".join(chunk_ids)
+            try:
+                TaskService.update_chunk_ids(task["id"], chunk_ids_str)
+            except DoesNotExist:
+                logging.warning(f"do_handle_task update_chunk_ids failed since task {task['id']} is unknown.")
+                await remove_inserted_chunks()
+                progress_callback(-1, msg=f"Chunk updates failed since task {task['id']} is unknown.")
+                return
+        progress_callback(prog=0.7 + 0.2 * len(chunk_ids) / max(total_chunks, 1), msg="")
+        return chunks
+
     # Either using RAPTOR or Standard chunking methods
     if task.get("task_type", "") == "raptor":
         # bind LLM for raptor
@@ -565,6 +715,10 @@ async def do_handle_task(task):
         # run RAPTOR
         async with kg_limiter:
             chunks, token_count = await run_raptor(task, chat_model, embedding_model, vector_size, progress_callback)
+        total_chunks = len(chunks)
+        start_ts = timer()
+        if not await run_insert_pipeline(pipeline_batches(chunks), [("insert", insert_batch)]):
+            return
     # Either using graphrag or Standard chunking methods
     elif task.get("task_type", "") == "graphrag":
         if not task_parser_config.get("graphrag", {}).get("use_graphrag", False):
@@ -582,67 +736,52 @@ async def do_handle_task(task):
     else:
         # Standard chunking methods
         start_ts = timer()
-        chunks = await build_chunks(task, progress_callback)
+        chunks = await parse_chunks(task, progress_callback)
         logging.info("Build document {}: {:.2f}s".format(task_document_name, timer() - start_ts))
         if not chunks:
             progress_callback(1., msg=f"No chunk built from {task_document_name}")
             return
-        # TODO: exception handler
-        ## set_progress(task["did"], -1, "ERROR: ")
-        progress_callback(msg="Generate {} chunks".format(len(chunks)))
+        total_chunks = len(chunks)
+        progress_callback(msg="Generate {} chunks".format(total_chunks))
+        enrichment = init_enrichment(task, progress_callback)
+
+        async def enrich_batch(docs):
+            docs = await enrich_chunks(task, docs, enrichment)
+            if docs is None:
+                progress_callback(-1, msg="Task has been canceled.")
+            return docs
+
+        async def embed_batch(docs):
+            nonlocal token_count
+            try:
+                tk_count, _ = await embedding(docs, embedding_model, task_parser_config)
+            except Exception as e:
+                error_message = "Generate embedding error:{}".format(str(e))
+                progress_callback(-1, error_message)
+                logging.exception(error_message)
+                raise
+            token_count += tk_count
+            return docs
+
+        # parse → image upload → LLM enrichment → embed → bulk insert, batch by batch
         start_ts = timer()
-        try:
-            token_count, vector_size = await embedding(chunks, embedding_model, task_parser_config, progress_callback)
-        except Exception as e:
-            error_message = "Generate embedding error:{}".format(str(e))
-            progress_callback(-1, error_message)
-            logging.exception(error_message)
-            token_count = 0
-            raise
-        progress_message = "Embedding chunks ({:.2f}s)".format(timer() - start_ts)
+        completed = await run_insert_pipeline(pipeline_batches(chunks), [
+            ("upload", lambda cks: upload_chunk_images(task, cks)),
+            ("enrich", enrich_batch),
+            ("embed", embed_batch),
+            ("insert", insert_batch),
+        ])
+        progress_message = "Chunk pipeline ({:.2f}s): {}".format(
+            timer() - start_ts,
+            ", ".join(["{} {:.2f}s".format(name, st["elapsed"]) for name, st in stage_stats.items()]))
         logging.info(progress_message)
         progress_callback(msg=progress_message)
-
-    chunk_count = len(set([chunk["id"] for chunk in chunks]))
-    start_ts = timer()
-    doc_store_result = ""
-
-    async def delete_image(kb_id, chunk_id):
-        try:
-            async with minio_limiter:
-                STORAGE_IMPL.delete(kb_id, chunk_id)
-        except Exception:
-            logging.exception(
-                "Deleting image of chunk {}/{}/{} got exception".format(task["location"], task["name"], chunk_id))
-            raise
-
-    for b in range(0, len(chunks), DOC_BULK_SIZE):
-        doc_store_result = await trio.to_thread.run_sync(lambda: settings.docStoreConn.insert(chunks[b:b + DOC_BULK_SIZE], search.index_name(task_tenant_id), task_dataset_id))
-        task_canceled = has_canceled(task_id)
-        if task_canceled:
-            progress_callback(-1, msg="Task has been canceled.")
-            return
-        if b % 128 == 0:
-            progress_callback(prog=0.8 + 0.1 * (b + 1) / len(chunks), msg="")
-        if doc_store_result:
-            error_message = f"Insert chunk error: {doc_store_result}, please check log file and Elasticsearch/Infinity status!"
-            progress_callback(-1, msg=error_message)
-            raise Exception(error_message)
-        chunk_ids = [chunk["id"] for chunk in chunks[:b + DOC_BULK_SIZE]]
-        chunk_ids_str = " ".join(chunk_ids)
-        try:
-            TaskService.update_chunk_ids(task["id"], chunk_ids_str)
-        except DoesNotExist:
-            logging.warning(f"do_handle_task update_chunk_ids failed since task {task['id']} is unknown.")
-            doc_store_result = await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"id": chunk_ids}, search.index_name(task_tenant_id), task_dataset_id))
-            async with trio.open_nursery() as nursery:
-                for chunk_id in chunk_ids:
-                    nursery.start_soon(delete_image, task_dataset_id, chunk_id)
-            progress_callback(-1, msg=f"Chunk updates failed since task {task['id']} is unknown.")
+        if not completed:
             return
 
+    chunk_count = len(set(chunk_ids))
     logging.info("Indexing doc({}), page({}-{}), chunks({}), elapsed: {:.2f}".format(task_document_name, task_from_page,
-                                                                                     task_to_page, len(chunks),
+                                                                                     task_to_page, total_chunks,
                                                                                      timer() - start_ts))
 
     DocumentService.increment_chunk_num(task_doc_id, task_dataset_id, token_count, chunk_count, 0)
@@ -652,7 +791,7 @@ async def do_handle_task(task):
     progress_callback(prog=1.0, msg="Indexing done ({:.2f}s). Task done ({:.2f}s)".format(time_cost, task_time_cost))
     logging.info(
         "Chunk doc({}), page({}-{}), chunks({}), token({}), elapsed:{:.2f}".format(task_document_name, task_from_page,
-                                                                                   task_to_page, len(chunks),
+                                                                                   task_to_page, total_chunks,
                                                                                    token_count, task_time_cost))
 
 
@@ -660,7 +799,7 @@ async def handle_task():
     global DONE_TASKS, FAILED_TASKS
     redis_msg, task = await collect()
     if not task:
-        await trio.sleep(5)
+        # collect() has already waited on a blocking read of the queues.
         return
     try:
         logging.info(f"handle_task begin for task {json.dumps(task)}")
@@ -681,9 +820,18 @@ async def handle_task():
         except Exception:
             pass
         logging.exception(f"handle_task got exception for task {json.dumps(task)}")
+    # The final progress of the task is in the database before its message is gone.
+    await trio.to_thread.run_sync(PROGRESS.flush, [task["id"]])
     redis_msg.ack()
 
 
+async def progress_flusher():
+    while True:
+        await trio.sleep(1)
+        if PROGRESS.due():
+            await trio.to_thread.run_sync(PROGRESS.flush)
+
+
 async def report_status():
     global CONSUMER_NAME, BOOT_AT, PENDING_TASKS, LAG_TASKS, DONE_TASKS, FAILED_TASKS
     REDIS_CONN.sadd("TASKEXE", CONSUMER_NAME)
@@ -706,9 +854,19 @@ async def report_status():
                 "done": DONE_TASKS,
                 "failed": FAILED_TASKS,
                 "current": current,
+                "embedding": EMBEDDING_SCHEDULER.stats,
+                "onnx": session_pool_stats(),
+                "progress": PROGRESS.stats,
+                "token_usage": TOKEN_USAGE.stats,
+                "pipeline": {
+                    name: {**st, "chunks_per_sec": round(st["chunks"] / st["elapsed"], 2) if st["elapsed"] else 0.}
+                    for name, st in PIPELINE_STATS.items()
+                },
             })
             REDIS_CONN.zadd(CONSUMER_NAME, heartbeat, now.timestamp())
             logging.info(f"{CONSUMER_NAME} reported heartbeat: {heartbeat}")
+            # Keep the tasks this executor holds from being reclaimed, however long they run.
+            await TASK_CONSUMER.refresh()
 
             expired = REDIS_CONN.zcount(CONSUMER_NAME, 0, now.timestamp() - 60 * 30)
             if expired > 0:
@@ -764,6 +922,7 @@ async def main():
 
     async with trio.open_nursery() as nursery:
         nursery.start_soon(report_status)
+        nursery.start_soon(progress_flusher)
         while not stop_event.is_set():
             await task_limiter.acquire()
             nursery.start_soon(task_manager)
@@ -0,0 +1,128 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Bulk indexing of chunks into Elasticsearch and OpenSearch.
+
+Chunks are serialized straight to NDJSON with orjson, numpy vectors included,
+and are never deep-copied. Requests are cut at DOC_BULK_BYTES rather than at a
+number of chunks, and up to DOC_BULK_CONCURRENCY of them are in flight at once
+across the process. Only the items rejected with a transient status (429, 5xx)
+or belonging to a request which failed as a whole are sent again.
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import orjson
+
+DOC_BULK_BYTES = int(os.environ.get("DOC_BULK_BYTES", 8 * 1024 * 1024))
+DOC_BULK_CONCURRENCY = int(os.environ.get("DOC_BULK_CONCURRENCY", 4))
+DOC_BULK_ATTEMPTS = 3
+_RETRY_STATUS = {429, 500, 502, 503, 504}
+_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=max(DOC_BULK_CONCURRENCY, 1), thread_name_prefix="bulk_indexer")
+        return _pool
+
+
+def _default(o):
+    if hasattr(o, "tolist"):
+        return o.tolist()
+    if isinstance(o, (set, frozenset)):
+        return list(o)
+    raise TypeError(f"Type is not JSON serializable: {type(o).__name__}")
+
+
+def bulk_line(d: dict, index_name: str, extra: dict | None = None) -> bytes:
+    """The `index` action and source lines of a chunk; its `id` becomes the `_id`."""
+    assert "_id" not in d
+    assert "id" in d
+    src = {k: v for k, v in d.items() if k != "id"}
+    if extra:
+        src.update(extra)
+    return b"".join([orjson.dumps({"index": {"_index": index_name, "_id": d["id"]}}), b"\n",
+                     orjson.dumps(src, default=_default, option=_OPTIONS), b"\n"])
+
+
+def split_by_bytes(lines: list, indexes: list, max_bytes=DOC_BULK_BYTES) -> list:
+    """Group `indexes` into runs whose lines add up to at most `max_bytes`, one line at least."""
+    batches, batch, size = [], [], 0
+    for i in indexes:
+        if batch and size + len(lines[i]) > max_bytes:
+            batches.append(batch)
+            batch, size = [], 0
+        batch.append(i)
+        size += len(lines[i])
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _send(send, lines, batch):
+    """Returns (index -> error of the failed items, indexes to retry)."""
+    try:
+        r = send(b"".join(lines[i] for i in batch))
+    except Exception as e:
+        logging.warning(f"Bulk request of {len(batch)} chunks got exception: {e}")
+        return {i: str(e) for i in batch}, batch
+    if not r.get("errors"):
+        return {}, []
+    errors, retry = {}, []
+    for i, item in zip(batch, r["items"]):
+        res = next(iter(item.values()))
+        if "error" not in res:
+            continue
+        errors[i] = str(res["error"])
+        if res.get("status") in _RETRY_STATUS:
+            retry.append(i)
+    return errors, retry
+
+
+def bulk_index(send, documents: list[dict], index_name: str, extra: dict | None = None) -> list[str]:
+    """
+    Index `documents` through `send(body: bytes) -> bulk response`, called from the pool.
+    Returns "id:error" of the documents which could not be indexed.
+    """
+    if not documents:
+        return []
+    lines = [bulk_line(d, index_name, extra) for d in documents]
+    pending = list(range(len(documents)))
+    errors = {}
+    for attempt in range(DOC_BULK_ATTEMPTS):
+        if attempt:
+            logging.warning(f"Bulk indexing into {index_name} retries {len(pending)} of {len(documents)} chunks")
+            time.sleep(2 ** attempt)
+        for i in pending:
+            errors.pop(i, None)
+        futures = [get_pool().submit(_send, send, lines, batch) for batch in split_by_bytes(lines, pending)]
+        pending = []
+        for f in futures:
+            errs, retry = f.result()
+            errors.update(errs)
+            pending.extend(retry)
+        if not pending:
+            break
+    return [f"{documents[i]['id']}:{e}" for i, e in sorted(errors.items())]
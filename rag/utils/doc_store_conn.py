@@ -208,6 +208,19 @@ class DocStoreConnection(ABC):
         """
         raise NotImplementedError("Not implemented")
 
+    def scan(self, selectFields: list[str], condition: dict, indexName: str, knowledgebaseIds: list[str], pageSize: int = 1000):
+        """
+        Every row matching `condition`, as search results of `pageSize` rows ordered by id
+        """
+        orderBy = OrderByExpr().asc("id")
+        offset = 0
+        while True:
+            res = self.search(selectFields, [], dict(condition), [], orderBy, offset, pageSize, indexName, knowledgebaseIds)
+            yield res
+            if len(self.getChunkIds(res)) < pageSize:
+                break
+            offset += pageSize
+
     @abstractmethod
     def get(self, chunkId: str, indexName: str, knowledgebaseIds: list[str]) -> dict | None:
         """
@@ -0,0 +1,155 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import logging
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import xxhash
+
+from rag.utils import singleton
+from rag.utils.redis_conn import REDIS_CONN
+
+EMBEDDING_CACHE_DTYPE = os.environ.get("EMBEDDING_CACHE_DTYPE", "float32").lower()
+EMBEDDING_CACHE_L1_MB = int(os.environ.get("EMBEDDING_CACHE_L1_MB", 64))
+EMBEDDING_CACHE_TTL = int(os.environ.get("EMBEDDING_CACHE_TTL", 24 * 3600))
+
+_FLOAT32, _FLOAT16, _INT8 = 1, 2, 3
+_DTYPE_CODES = {"float32": _FLOAT32, "float16": _FLOAT16, "int8": _INT8}
+
+
+def encode_vector(v, dtype=EMBEDDING_CACHE_DTYPE) -> bytes:
+    """
+    Serialize a vector as one dtype byte followed by the raw little-endian values.
+    `int8` is symmetric per-vector quantization and also stores the float32 scale.
+    """
+    v = np.asarray(v, dtype=np.float32).ravel()
+    code = _DTYPE_CODES.get(dtype, _FLOAT32)
+    if code == _FLOAT16:
+        return bytes([code]) + v.astype("<f2").tobytes()
+    if code == _INT8:
+        scale = float(np.abs(v).max()) / 127. if len(v) else 0.
+        q = np.round(v / scale) if scale else np.zeros_like(v)
+        return bytes([code]) + struct.pack("<f", scale) + q.astype(np.int8).tobytes()
+    return bytes([code]) + v.astype("<f4").tobytes()
+
+
+def decode_vector(b: bytes) -> np.ndarray:
+    code = b[0]
+    if code == _FLOAT16:
+        return np.frombuffer(b, dtype="<f2", offset=1).astype(np.float32)
+    if code == _INT8:
+        scale = struct.unpack_from("<f", b, 1)[0]
+        return np.frombuffer(b, dtype=np.int8, offset=5).astype(np.float32) * scale
+    return np.frombuffer(b, dtype="<f4", offset=1).copy()
+
+
+def cache_model_name(tenant_id, model_config: dict) -> str:
+    """
+    The name of an embedding model in the cache. One model name may stand for different
+    models on different providers or endpoints, and tenants never share their vectors.
+    """
+    return "{}/{}/{}/{}".format(tenant_id, model_config.get("llm_factory", ""),
+                                model_config.get("llm_name", ""), model_config.get("api_base", ""))
+
+
+@singleton
+class EmbeddingCache:
+    """
+    Embedding cache keyed by (model, text hash), the model being named by `cache_model_name`.
+
+    Vectors are kept decoded in an in-process LRU (L1) bounded by EMBEDDING_CACHE_L1_MB
+    and stored in Redis (L2) as raw float32/float16/int8 bytes, which are read and
+    written with one pipelined round-trip per batch.
+    """
+
+    def __init__(self):
+        self._l1 = OrderedDict()
+        self._l1_bytes = 0
+        self._l1_capacity = EMBEDDING_CACHE_L1_MB * 1024 * 1024
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(llmnm, txt):
+        return "embd:{}:{}".format(
+            xxhash.xxh64(str(llmnm).encode("utf-8")).hexdigest(),
+            xxhash.xxh128(str(txt).encode("utf-8", "surrogatepass")).hexdigest())
+
+    def _l1_get(self, k):
+        with self._lock:
+            v = self._l1.get(k)
+            if v is not None:
+                self._l1.move_to_end(k)
+            return v
+
+    def _l1_put(self, k, v):
+        with self._lock:
+            old = self._l1.pop(k, None)
+            if old is not None:
+                self._l1_bytes -= old.nbytes
+            self._l1[k] = v
+            self._l1_bytes += v.nbytes
+            while self._l1_bytes > self._l1_capacity and self._l1:
+                _, evicted = self._l1.popitem(last=False)
+                self._l1_bytes -= evicted.nbytes
+
+    def get_many(self, llmnm, txts: list) -> list:
+        """Return a vector or None for every text, in order."""
+        keys = [self.key(llmnm, t) for t in txts]
+        res = [self._l1_get(k) for k in keys]
+        missed = [i for i, v in enumerate(res) if v is None]
+        if missed:
+            try:
+                bins = REDIS_CONN.mget_bytes([keys[i] for i in missed])
+            except Exception as e:
+                logging.warning(f"EmbeddingCache.get_many got exception: {e}")
+                bins = [None] * len(missed)
+            for i, b in zip(missed, bins):
+                if not b:
+                    continue
+                try:
+                    v = decode_vector(b)
+                except Exception:
+                    continue
+                self._l1_put(keys[i], v)
+                res[i] = v
+        hit = sum(1 for v in res if v is not None)
+        self.hits += hit
+        self.misses += len(res) - hit
+        return res
+
+    def set_many(self, llmnm, txts: list, vectors):
+        mapping = {}
+        for t, v in zip(txts, vectors):
+            k = self.key(llmnm, t)
+            v = np.asarray(v, dtype=np.float32).ravel()
+            self._l1_put(k, v)
+            mapping[k] = encode_vector(v)
+        if mapping:
+            REDIS_CONN.mset_bytes(mapping, EMBEDDING_CACHE_TTL)
+
+    def get(self, llmnm, txt):
+        return self.get_many(llmnm, [txt])[0]
+
+    def set(self, llmnm, txt, v):
+        self.set_many(llmnm, [txt], [v])
+
+
+EMBED_CACHE = EmbeddingCache()
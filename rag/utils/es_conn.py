@@ -17,17 +17,20 @@
 import logging
 import re
 import json
+import threading
 import time
 import os
 
 import copy
-from elasticsearch import Elasticsearch, NotFoundError
+from elasticsearch import Elasticsearch, NotFoundError, helpers
 from elasticsearch_dsl import UpdateByQuery, Q, Search, Index
 from elastic_transport import ConnectionTimeout
 from rag import settings
 from rag.settings import TAG_FLD, PAGERANK_FLD
 from rag.utils import singleton, get_float
 from api.utils.file_utils import get_project_base_directory
+from rag.utils.bulk_indexer import bulk_index
+from rag.utils.retrieval_cache import invalidates_kb
 from rag.utils.doc_store_conn import DocStoreConnection, MatchExpr, OrderByExpr, MatchTextExpr, MatchDenseExpr, \
     FusionExpr
 from rag.nlp import is_english, rag_tokenizer
@@ -41,6 +44,8 @@ logger = logging.getLogger('ragflow.es_conn')
 class ESConnection(DocStoreConnection):
     def __init__(self):
         self.info = {}
+        # Bulk requests fail together when the cluster stalls: only one of them reconnects.
+        self._reconnect_lock = threading.Lock()
         logger.info(f"Use Elasticsearch {settings.ES['hosts']} as the doc engine.")
         for _ in range(ATTEMPT_TIME):
             try:
@@ -159,25 +164,7 @@ class ESConnection(DocStoreConnection):
         assert isinstance(indexNames, list) and len(indexNames) > 0
         assert "_id" not in condition
 
-        bqry = Q("bool", must=[])
-        condition["kb_id"] = knowledgebaseIds
-        for k, v in condition.items():
-            if k == "available_int":
-                if v == 0:
-                    bqry.filter.append(Q("range", available_int={"lt": 1}))
-                else:
-                    bqry.filter.append(
-                        Q("bool", must_not=Q("range", available_int={"lt": 1})))
-                continue
-            if not v:
-                continue
-            if isinstance(v, list):
-                bqry.filter.append(Q("terms", **{k: v}))
-            elif isinstance(v, str) or isinstance(v, int):
-                bqry.filter.append(Q("term", **{k: v}))
-            else:
-                raise Exception(
-                    f"Condition `{str(k)}={str(v)}` value type is {str(type(v))}, expected to be int, str or list.")
+        bqry = self._filter(condition, knowledgebaseIds)
 
         s = Search()
         vector_similarity_weight = 0.5
@@ -269,6 +256,43 @@ class ESConnection(DocStoreConnection):
         logger.error(f"ESConnection.search timeout for {ATTEMPT_TIME} times!")
         raise Exception("ESConnection.search timeout.")
 
+    def _filter(self, condition: dict, knowledgebaseIds: list[str]):
+        bqry = Q("bool", must=[])
+        condition["kb_id"] = knowledgebaseIds
+        for k, v in condition.items():
+            if k == "available_int":
+                if v == 0:
+                    bqry.filter.append(Q("range", available_int={"lt": 1}))
+                else:
+                    bqry.filter.append(
+                        Q("bool", must_not=Q("range", available_int={"lt": 1})))
+                continue
+            if not v:
+                continue
+            if isinstance(v, list):
+                bqry.filter.append(Q("terms", **{k: v}))
+            elif isinstance(v, str) or isinstance(v, int):
+                bqry.filter.append(Q("term", **{k: v}))
+            else:
+                raise Exception(
+                    f"Condition `{str(k)}={str(v)}` value type is {str(type(v))}, expected to be int, str or list.")
+        return bqry
+
+    def scan(self, selectFields: list[str], condition: dict, indexName: str, knowledgebaseIds: list[str], pageSize: int = 1000):
+        """
+        Every row matching `condition`, a page of hits at a time. It scrolls rather than pages with
+        from/size, which Elasticsearch refuses beyond index.max_result_window.
+        """
+        q = {"query": self._filter(condition, knowledgebaseIds).to_dict(), "_source": selectFields}
+        page = []
+        for hit in helpers.scan(self.es, query=q, index=indexName, size=pageSize, scroll="5m"):
+            page.append(hit)
+            if len(page) == pageSize:
+                yield {"hits": {"hits": page}}
+                page = []
+        if page:
+            yield {"hits": {"hits": page}}
+
     def get(self, chunkId: str, indexName: str, knowledgebaseIds: list[str]) -> dict | None:
         for i in range(ATTEMPT_TIME):
             try:
@@ -287,44 +311,23 @@ class ESConnection(DocStoreConnection):
         logger.error(f"ESConnection.get timeout for {ATTEMPT_TIME} times!")
         raise Exception("ESConnection.get timeout.")
 
+    @invalidates_kb
     def insert(self, documents: list[dict], indexName: str, knowledgebaseId: str = None) -> list[str]:
         # Refers to https://www.elastic.co/guide/en/elasticsearch/reference/current/docs-bulk.html
-        operations = []
-        for d in documents:
-            assert "_id" not in d
-            assert "id" in d
-            d_copy = copy.deepcopy(d)
-            d_copy["kb_id"] = knowledgebaseId
-            meta_id = d_copy.pop("id", "")
-            operations.append(
-                {"index": {"_index": indexName, "_id": meta_id}})
-            operations.append(d_copy)
-
-        res = []
-        for _ in range(ATTEMPT_TIME):
-            try:
-                res = []
-                r = self.es.bulk(index=(indexName), operations=operations,
-                                 refresh=False, timeout="60s")
-                if re.search(r"False", str(r["errors"]), re.IGNORECASE):
-                    return res
-
-                for item in r["items"]:
-                    for action in ["create", "delete", "index", "update"]:
-                        if action in item and "error" in item[action]:
-                            res.append(str(item[action]["_id"]) + ":" + str(item[action]["error"]))
-                return res
-            except ConnectionTimeout:
-                logger.exception("ES request timeout")
-                time.sleep(3)
-                self._connect()
-                continue
-            except Exception as e:
-                res.append(str(e))
-                logger.warning("ESConnection.insert got exception: " + str(e))
-
-        return res
+        return bulk_index(self._bulk, documents, indexName, {"kb_id": knowledgebaseId})
 
+    def _bulk(self, body: bytes) -> dict:
+        es = self.es
+        try:
+            return es.bulk(operations=body, refresh=False, timeout="60s")
+        except ConnectionTimeout:
+            logger.exception("ES request timeout")
+            with self._reconnect_lock:
+                if self.es is es:
+                    self._connect()
+            raise
+
+    @invalidates_kb
     def update(self, condition: dict, newValue: dict, indexName: str, knowledgebaseId: str) -> bool:
         doc = copy.deepcopy(newValue)
         doc.pop("id", None)
@@ -417,6 +420,7 @@ class ESConnection(DocStoreConnection):
                 break
         return False
 
+    @invalidates_kb
     def delete(self, condition: dict, indexName: str, knowledgebaseId: str) -> int:
         qry = None
         assert "_id" not in condition
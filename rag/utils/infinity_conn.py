@@ -19,7 +19,8 @@ import os
 import re
 import json
 import time
-import copy
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import infinity
 from infinity.common import ConflictType, InfinityException, SortType
 from infinity.index import IndexInfo, IndexType
@@ -31,6 +32,7 @@ from rag.utils import singleton
 import pandas as pd
 from api.utils.file_utils import get_project_base_directory
 
+from rag.utils.retrieval_cache import invalidates_kb
 from rag.utils.doc_store_conn import (
     DocStoreConnection,
     MatchExpr,
@@ -42,12 +44,70 @@ from rag.utils.doc_store_conn import (
 
 logger = logging.getLogger('ragflow.infinity_conn')
 
+# Rows sent by one insert call, and the calls of one `insert` run at once on their own connections.
+INFINITY_INSERT_BATCH = int(os.environ.get("INFINITY_INSERT_BATCH", 4096))
+INFINITY_INSERT_WRITERS = int(os.environ.get("INFINITY_INSERT_WRITERS", 4))
+INFINITY_DELETE_BATCH = 1000
+
+_writer_pool = None
+_writer_pool_lock = threading.Lock()
+
+
+def get_writer_pool():
+    global _writer_pool
+    with _writer_pool_lock:
+        if _writer_pool is None:
+            _writer_pool = ThreadPoolExecutor(max_workers=max(INFINITY_INSERT_WRITERS, 1), thread_name_prefix="infinity_writer")
+        return _writer_pool
+
 def field_keyword(field_name: str):
         # The "docnm_kwd" field is always a string, not list.
         if field_name == "source_id" or (field_name.endswith("_kwd") and field_name != "docnm_kwd" and field_name != "knowledge_graph_kwd"):
             return True
         return False
 
+def _column_converter(k: str):
+    if field_keyword(k):
+        return lambda v: "###".join(v) if isinstance(v, list) else v
+    if re.search(r"_feas$", k):
+        return json.dumps
+    if k == "kb_id":
+        # kb_id may be a list, but we need a str
+        return lambda v: v[0] if isinstance(v, list) else v
+    if k == "position_int":
+        return lambda v: "_".join(f"{num:08x}" for row in v for num in row)
+    if k in ["page_num_int", "top_int"]:
+        return lambda v: "_".join(f"{num:08x}" for num in v)
+    return None
+
+
+def to_rows(documents: list[dict], embedding_clmns: list[tuple[str, int]]) -> list[dict]:
+    """
+    Infinity rows of `documents`. Every field is converted a column at a time, with the
+    converter picked once per column, and the documents themselves are left untouched.
+    """
+    columns = {}
+    for i, d in enumerate(documents):
+        assert "_id" not in d
+        assert "id" in d
+        for k, v in d.items():
+            columns.setdefault(k, ([], []))
+            columns[k][0].append(i)
+            columns[k][1].append(v)
+    rows = [{} for _ in documents]
+    for k, (idxs, values) in columns.items():
+        conv = _column_converter(k)
+        if conv:
+            values = [conv(v) for v in values]
+        for i, v in zip(idxs, values):
+            rows[i][k] = v
+    for n, vs in embedding_clmns:
+        zeros = [0] * vs
+        for r in rows:
+            r.setdefault(n, zeros)
+    return rows
+
+
 def equivalent_condition_to_str(condition: dict, table_instance=None) -> str | None:
     assert "_id" not in condition
     clmns = {}
@@ -487,6 +547,7 @@ class InfinityConnection(DocStoreConnection):
         res_fields = self.getFields(res, res.columns.tolist())
         return res_fields.get(chunkId, None)
 
+    @invalidates_kb
     def insert(
             self, documents: list[dict], indexName: str, knowledgebaseId: str = None
     ) -> list[str]:
@@ -519,48 +580,40 @@ class InfinityConnection(DocStoreConnection):
             if not r:
                 continue
             embedding_clmns.append((n, int(r.group(1))))
-
-        docs = copy.deepcopy(documents)
-        for d in docs:
-            assert "_id" not in d
-            assert "id" in d
-            for k, v in d.items():
-                if field_keyword(k):
-                    if isinstance(v, list):
-                        d[k] = "###".join(v)
-                    else:
-                        d[k] = v
-                elif re.search(r"_feas$", k):
-                    d[k] = json.dumps(v)
-                elif k == 'kb_id':
-                    if isinstance(d[k], list):
-                        d[k] = d[k][0]  # since d[k] is a list, but we need a str
-                elif k == "position_int":
-                    assert isinstance(v, list)
-                    arr = [num for row in v for num in row]
-                    d[k] = "_".join(f"{num:08x}" for num in arr)
-                elif k in ["page_num_int", "top_int"]:
-                    assert isinstance(v, list)
-                    d[k] = "_".join(f"{num:08x}" for num in v)
-                else:
-                    d[k] = v
-
-            for n, vs in embedding_clmns:
-                if n in d:
-                    continue
-                d[n] = [0] * vs
-        ids = ["'{}'".format(d["id"]) for d in docs]
-        str_ids = ", ".join(ids)
-        str_filter = f"id IN ({str_ids})"
-        table_instance.delete(str_filter)
-        # for doc in documents:
-        #     logger.info(f"insert position_int: {doc['position_int']}")
-        # logger.info(f"InfinityConnection.insert {json.dumps(documents)}")
-        table_instance.insert(docs)
         self.connPool.release_conn(inf_conn)
-        logger.debug(f"INFINITY inserted into {table_name} {str_ids}.")
+
+        rows = to_rows(documents, embedding_clmns)
+        ids = [d["id"] for d in documents]
+        self.delete_ids(ids, table_name)
+        slices = [rows[i:i + INFINITY_INSERT_BATCH] for i in range(0, len(rows), INFINITY_INSERT_BATCH)]
+        if len(slices) == 1:
+            self._insert_rows(table_name, slices[0])
+        else:
+            list(get_writer_pool().map(lambda rs: self._insert_rows(table_name, rs), slices))
+        logger.debug(f"INFINITY inserted into {table_name} {len(ids)} rows.")
         return []
 
+    def _insert_rows(self, table_name: str, rows: list[dict]):
+        inf_conn = self.connPool.get_conn()
+        try:
+            inf_conn.get_database(self.dbName).get_table(table_name).insert(rows)
+        finally:
+            self.connPool.release_conn(inf_conn)
+
+    def delete_ids(self, ids: list[str], table_name: str) -> int:
+        """Delete rows by id with one `id IN (...)` filter per INFINITY_DELETE_BATCH ids."""
+        inf_conn = self.connPool.get_conn()
+        try:
+            table_instance = inf_conn.get_database(self.dbName).get_table(table_name)
+            deleted = 0
+            for i in range(0, len(ids), INFINITY_DELETE_BATCH):
+                str_ids = ", ".join("'{}'".format(id.replace("'", "''")) for id in ids[i:i + INFINITY_DELETE_BATCH])
+                deleted += table_instance.delete(f"id IN ({str_ids})").deleted_rows
+            return deleted
+        finally:
+            self.connPool.release_conn(inf_conn)
+
+    @invalidates_kb
     def update(
             self, condition: dict, newValue: dict, indexName: str, knowledgebaseId: str
     ) -> bool:
@@ -638,6 +691,7 @@ class InfinityConnection(DocStoreConnection):
         self.connPool.release_conn(inf_conn)
         return True
 
+    @invalidates_kb
     def delete(self, condition: dict, indexName: str, knowledgebaseId: str) -> int:
         inf_conn = self.connPool.get_conn()
         db_instance = inf_conn.get_database(self.dbName)
@@ -649,6 +703,9 @@ class InfinityConnection(DocStoreConnection):
                 f"Skipped deleting from table {table_name} since the table doesn't exist."
             )
             return 0
+        if list(condition.keys()) == ["id"] and isinstance(condition["id"], list):
+            self.connPool.release_conn(inf_conn)
+            return self.delete_ids(condition["id"], table_name)
         filter = equivalent_condition_to_str(condition, table_instance)
         logger.debug(f"INFINITY delete table {table_name}, filter {filter}.")
         res = table_instance.delete(filter)
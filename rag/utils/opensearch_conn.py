@@ -21,13 +21,15 @@ import time
 import os
 
 import copy
-from opensearchpy import OpenSearch, NotFoundError
+from opensearchpy import OpenSearch, NotFoundError, helpers
 from opensearchpy import UpdateByQuery, Q, Search, Index
 from opensearchpy import ConnectionTimeout
 from rag import settings
 from rag.settings import TAG_FLD, PAGERANK_FLD
 from rag.utils import singleton
 from api.utils.file_utils import get_project_base_directory
+from rag.utils.bulk_indexer import bulk_index
+from rag.utils.retrieval_cache import invalidates_kb
 from rag.utils.doc_store_conn import DocStoreConnection, MatchExpr, OrderByExpr, MatchTextExpr, MatchDenseExpr, \
     FusionExpr
 from rag.nlp import is_english, rag_tokenizer
@@ -150,25 +152,7 @@ class OSConnection(DocStoreConnection):
         assert isinstance(indexNames, list) and len(indexNames) > 0
         assert "_id" not in condition
 
-        bqry = Q("bool", must=[])
-        condition["kb_id"] = knowledgebaseIds
-        for k, v in condition.items():
-            if k == "available_int":
-                if v == 0:
-                    bqry.filter.append(Q("range", available_int={"lt": 1}))
-                else:
-                    bqry.filter.append(
-                        Q("bool", must_not=Q("range", available_int={"lt": 1})))
-                continue
-            if not v:
-                continue
-            if isinstance(v, list):
-                bqry.filter.append(Q("terms", **{k: v}))
-            elif isinstance(v, str) or isinstance(v, int):
-                bqry.filter.append(Q("term", **{k: v}))
-            else:
-                raise Exception(
-                    f"Condition `{str(k)}={str(v)}` value type is {str(type(v))}, expected to be int, str or list.")
+        bqry = self._filter(condition, knowledgebaseIds)
 
         s = Search()
         vector_similarity_weight = 0.5
@@ -265,6 +249,43 @@ class OSConnection(DocStoreConnection):
         logger.error(f"OSConnection.search timeout for {ATTEMPT_TIME} times!")
         raise Exception("OSConnection.search timeout.")
 
+    def _filter(self, condition: dict, knowledgebaseIds: list[str]):
+        bqry = Q("bool", must=[])
+        condition["kb_id"] = knowledgebaseIds
+        for k, v in condition.items():
+            if k == "available_int":
+                if v == 0:
+                    bqry.filter.append(Q("range", available_int={"lt": 1}))
+                else:
+                    bqry.filter.append(
+                        Q("bool", must_not=Q("range", available_int={"lt": 1})))
+                continue
+            if not v:
+                continue
+            if isinstance(v, list):
+                bqry.filter.append(Q("terms", **{k: v}))
+            elif isinstance(v, str) or isinstance(v, int):
+                bqry.filter.append(Q("term", **{k: v}))
+            else:
+                raise Exception(
+                    f"Condition `{str(k)}={str(v)}` value type is {str(type(v))}, expected to be int, str or list.")
+        return bqry
+
+    def scan(self, selectFields: list[str], condition: dict, indexName: str, knowledgebaseIds: list[str], pageSize: int = 1000):
+        """
+        Every row matching `condition`, a page of hits at a time. It scrolls rather than pages with
+        from/size, which OpenSearch refuses beyond index.max_result_window.
+        """
+        q = {"query": self._filter(condition, knowledgebaseIds).to_dict(), "_source": selectFields}
+        page = []
+        for hit in helpers.scan(self.os, query=q, index=indexName, size=pageSize, scroll="5m"):
+            page.append(hit)
+            if len(page) == pageSize:
+                yield {"hits": {"hits": page}}
+                page = []
+        if page:
+            yield {"hits": {"hits": page}}
+
     def get(self, chunkId: str, indexName: str, knowledgebaseIds: list[str]) -> dict | None:
         for i in range(ATTEMPT_TIME):
             try:
@@ -285,42 +306,15 @@ class OSConnection(DocStoreConnection):
         logger.error(f"OSConnection.get timeout for {ATTEMPT_TIME} times!")
         raise Exception("OSConnection.get timeout.")
 
+    @invalidates_kb
     def insert(self, documents: list[dict], indexName: str, knowledgebaseId: str = None) -> list[str]:
         # Refers to https://opensearch.org/docs/latest/api-reference/document-apis/bulk/
-        operations = []
-        for d in documents:
-            assert "_id" not in d
-            assert "id" in d
-            d_copy = copy.deepcopy(d)
-            meta_id = d_copy.pop("id", "")
-            operations.append(
-                {"index": {"_index": indexName, "_id": meta_id}})
-            operations.append(d_copy)
-
-        res = []
-        for _ in range(ATTEMPT_TIME):
-            try:
-                res = []
-                r = self.os.bulk(index=(indexName), body=operations,
-                                 refresh=False, timeout=60)
-                if re.search(r"False", str(r["errors"]), re.IGNORECASE):
-                    return res
-
-                for item in r["items"]:
-                    for action in ["create", "delete", "index", "update"]:
-                        if action in item and "error" in item[action]:
-                            res.append(str(item[action]["_id"]) + ":" + str(item[action]["error"]))
-                return res
-            except Exception as e:
-                res.append(str(e))
-                logger.warning("OSConnection.insert got exception: " + str(e))
-                res = []
-                if re.search(r"(Timeout|time out)", str(e), re.IGNORECASE):
-                    res.append(str(e))
-                    time.sleep(3)
-                    continue
-        return res
+        return bulk_index(self._bulk, documents, indexName)
+
+    def _bulk(self, body: bytes) -> dict:
+        return self.os.bulk(body=body, refresh=False, timeout=60)
 
+    @invalidates_kb
     def update(self, condition: dict, newValue: dict, indexName: str, knowledgebaseId: str) -> bool:
         doc = copy.deepcopy(newValue)
         doc.pop("id", None)
@@ -404,6 +398,7 @@ class OSConnection(DocStoreConnection):
                 break
         return False
 
+    @invalidates_kb
     def delete(self, condition: dict, indexName: str, knowledgebaseId: str) -> int:
         qry = None
         assert "_id" not in condition
@@ -16,6 +16,9 @@
 
 import logging
 import json
+import os
+import threading
+import time
 import uuid
 
 import valkey as redis
@@ -61,6 +64,8 @@ class RedisDB:
 
     def __init__(self):
         self.REDIS = None
+        self.REDIS_BIN = None
+        self._groups = set()
         self.config = settings.REDIS
         self.__open__()
 
@@ -78,6 +83,14 @@ class RedisDB:
                 password=self.config.get("password"),
                 decode_responses=True,
             )
+            # Shares nothing with self.REDIS but the server: values such as cached vectors are raw bytes.
+            self.REDIS_BIN = redis.StrictRedis(
+                host=self.config["host"].split(":")[0],
+                port=int(self.config.get("host", ":6379").split(":")[1]),
+                db=int(self.config.get("db", 1)),
+                password=self.config.get("password"),
+                decode_responses=False,
+            )
             self.register_scripts()
         except Exception:
             logging.warning("Redis can't be connected.")
@@ -130,6 +143,98 @@ class RedisDB:
             self.__open__()
         return False
 
+    def mget(self, keys: list) -> list:
+        if not self.REDIS or not keys:
+            return [None] * len(keys)
+        try:
+            return self.REDIS.mget(keys)
+        except Exception as e:
+            logging.warning("RedisDB.mget got exception: " + str(e))
+            self.__open__()
+        return [None] * len(keys)
+
+    def mset(self, mapping: dict, exp=3600):
+        """SET every key of `mapping` with one pipelined round-trip."""
+        if not self.REDIS or not mapping:
+            return False
+        try:
+            pipeline = self.REDIS.pipeline(transaction=False)
+            for k, v in mapping.items():
+                pipeline.set(k, v, exp)
+            pipeline.execute()
+            return True
+        except Exception as e:
+            logging.warning("RedisDB.mset got exception: " + str(e))
+            self.__open__()
+        return False
+
+    def exists_many(self, keys: list) -> list:
+        """Whether each of `keys` exists, with one pipelined round-trip."""
+        if not self.REDIS or not keys:
+            return [False] * len(keys)
+        try:
+            pipeline = self.REDIS.pipeline(transaction=False)
+            for k in keys:
+                pipeline.exists(k)
+            return [bool(r) for r in pipeline.execute()]
+        except Exception as e:
+            logging.warning("RedisDB.exists_many got exception: " + str(e))
+            self.__open__()
+        return [False] * len(keys)
+
+    def publish(self, channel: str, message: str):
+        try:
+            self.REDIS.publish(channel, message)
+            return True
+        except Exception as e:
+            logging.warning("RedisDB.publish " + str(channel) + " got exception: " + str(e))
+            self.__open__()
+        return False
+
+    async def async_get(self, k):
+        return await trio.to_thread.run_sync(self.get, k)
+
+    async def async_mget(self, keys: list) -> list:
+        return await trio.to_thread.run_sync(self.mget, keys)
+
+    async def async_mset(self, mapping: dict, exp=3600):
+        return await trio.to_thread.run_sync(self.mset, mapping, exp)
+
+    async def async_exists_many(self, keys: list) -> list:
+        return await trio.to_thread.run_sync(self.exists_many, keys)
+
+    def incr(self, key: str):
+        try:
+            return self.REDIS.incr(key)
+        except Exception as e:
+            logging.warning("RedisDB.incr " + str(key) + " got exception: " + str(e))
+            self.__open__()
+        return None
+
+    def mget_bytes(self, keys: list) -> list:
+        if not self.REDIS_BIN or not keys:
+            return [None] * len(keys)
+        try:
+            return self.REDIS_BIN.mget(keys)
+        except Exception as e:
+            logging.warning("RedisDB.mget_bytes got exception: " + str(e))
+            self.__open__()
+        return [None] * len(keys)
+
+    def mset_bytes(self, mapping: dict, exp=3600):
+        if not self.REDIS_BIN or not mapping:
+            return False
+        try:
+            pipeline = self.REDIS_BIN.pipeline(transaction=False)
+            for k, v in mapping.items():
+                pipeline.set(k, v, exp)
+            pipeline.execute()
+            return True
+        except Exception as e:
+            logging.warning("RedisDB.mset_bytes got exception: " + str(e))
+            self.__open__()
+        return False
+
     def sadd(self, key: str, member: str):
         try:
             self.REDIS.sadd(key, member)
@@ -139,6 +244,25 @@ class RedisDB:
             self.__open__()
         return False
 
+    def sadd_many(self, key: str, members: list):
+        if not members:
+            return True
+        try:
+            self.REDIS.sadd(key, *members)
+            return True
+        except Exception as e:
+            logging.warning("RedisDB.sadd_many " + str(key) + " got exception: " + str(e))
+            self.__open__()
+        return False
+
+    def spop(self, key: str, count: int) -> list:
+        try:
+            return self.REDIS.spop(key, count) or []
+        except Exception as e:
+            logging.warning("RedisDB.spop " + str(key) + " got exception: " + str(e))
+            self.__open__()
+        return []
+
     def srem(self, key: str, member: str):
         try:
             self.REDIS.srem(key, member)
@@ -223,23 +347,23 @@ class RedisDB:
                 self.__open__()
         return False
 
+    def ensure_group(self, queue_name, group_name):
+        """Create the consumer group (and the stream) unless this process already did."""
+        if (queue_name, group_name) in self._groups:
+            return
+        try:
+            self.REDIS.xgroup_create(queue_name, group_name, id="0", mkstream=True)
+        except redis.exceptions.ResponseError as e:
+            if "busygroup" not in str(e).lower():
+                raise
+        self._groups.add((queue_name, group_name))
+
     def queue_consumer(self, queue_name, group_name, consumer_name, msg_id=b">") -> RedisMsg:
         """https://redis.io/docs/latest/commands/xreadgroup/"""
         for _ in range(3):
             try:
 
-                try:
-                    group_info = self.REDIS.xinfo_groups(queue_name)
-                    if not any(gi["name"] == group_name for gi in group_info):
-                        self.REDIS.xgroup_create(queue_name, group_name, id="0", mkstream=True)
-                except redis.exceptions.ResponseError as e:
-                    if "no such key" in str(e).lower():
-                        self.REDIS.xgroup_create(queue_name, group_name, id="0", mkstream=True)
-                    elif "busygroup" in str(e).lower():
-                        logging.warning("Group already exists, continue.")
-                        pass
-                    else:
-                        raise
+                self.ensure_group(queue_name, group_name)
 
                 args = {
                     "groupname": group_name,
@@ -258,6 +382,9 @@ class RedisDB:
                 res = RedisMsg(self.REDIS, queue_name, group_name, msg_id, payload)
                 return res
             except Exception as e:
+                if "nogroup" in str(e).lower():
+                    # The stream or its group was deleted since it was created.
+                    self._groups.discard((queue_name, group_name))
                 if str(e) == 'no such key':
                     pass
                 else:
@@ -354,6 +481,205 @@ class RedisDB:
 REDIS_CONN = RedisDB()
 
 
+# Seconds a "not canceled" answer is trusted locally; a cancellation is pushed over pub/sub meanwhile.
+CANCEL_FLAG_TTL = float(os.environ.get("CANCEL_FLAG_TTL", 3))
+CANCEL_CHANNEL = "task_cancel"
+
+
+class CancelFlags:
+    """
+    Process-local view of the `{task_id}-cancel` keys.
+
+    A set flag never goes back, so it is cached for good; an unset one is re-read
+    from Redis after CANCEL_FLAG_TTL seconds. `set()` publishes the task ids on
+    CANCEL_CHANNEL and a subscriber thread marks them at once in every process, so
+    the TTL only bounds the delay when a message is lost (e.g. on reconnection).
+    """
+
+    def __init__(self, conn, ttl=CANCEL_FLAG_TTL):
+        self.conn = conn
+        self.ttl = ttl
+        self._canceled = set()
+        self._checked = {}
+        self._lock = threading.Lock()
+        self._subscriber = None
+
+    @staticmethod
+    def key(task_id):
+        return f"{task_id}-cancel"
+
+    def _subscribe(self):
+        while True:
+            try:
+                pubsub = self.conn.REDIS.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CANCEL_CHANNEL)
+                for msg in pubsub.listen():
+                    if msg.get("type") == "message":
+                        with self._lock:
+                            self._canceled.update(str(msg["data"]).split())
+            except Exception as e:
+                logging.warning("CancelFlags subscriber got exception: " + str(e))
+            # Anything published meanwhile is missed; re-read the keys instead.
+            with self._lock:
+                self._checked.clear()
+            time.sleep(1)
+
+    def _ensure_subscriber(self):
+        if self._subscriber is not None or not self.conn.is_alive():
+            return
+        with self._lock:
+            if self._subscriber is None:
+                self._subscriber = threading.Thread(target=self._subscribe, name="cancel_flags", daemon=True)
+                self._subscriber.start()
+
+    def set(self, task_ids: list, exp=3600):
+        if not task_ids:
+            return
+        self.conn.mset({self.key(t): "x" for t in task_ids}, exp)
+        self.conn.publish(CANCEL_CHANNEL, " ".join(task_ids))
+        with self._lock:
+            self._canceled.update(task_ids)
+
+    def is_set_many(self, task_ids: list) -> list:
+        self._ensure_subscriber()
+        now = time.monotonic()
+        with self._lock:
+            stale = [t for t in task_ids if t not in self._canceled and self._checked.get(t, 0) < now]
+        if stale:
+            flags = self.conn.exists_many([self.key(t) for t in stale])
+            with self._lock:
+                for t, f in zip(stale, flags):
+                    if f:
+                        self._canceled.add(t)
+                    else:
+                        self._checked[t] = now + self.ttl
+                if len(self._checked) > 10000:
+                    self._checked = {t: exp for t, exp in self._checked.items() if exp >= now}
+        with self._lock:
+            return [t in self._canceled for t in task_ids]
+
+    def is_set(self, task_id) -> bool:
+        return self.is_set_many([task_id])[0]
+
+    async def async_is_set(self, task_id) -> bool:
+        with self._lock:
+            if task_id in self._canceled:
+                return True
+            if self._checked.get(task_id, 0) >= time.monotonic():
+                return False
+        return await trio.to_thread.run_sync(self.is_set, task_id)
+
+
+CANCEL_FLAGS = CancelFlags(REDIS_CONN)
+
+
+class RedisStreamConsumer:
+    """
+    Consumer of a group over several streams listed by decreasing priority.
+
+    The streams are read one at a time in priority order, each for the slots the caller
+    has left, because XREADGROUP's COUNT applies per stream. Only when all of them are
+    empty does a blocking XREADGROUP wait on every stream for one message. The messages
+    are kept in a local buffer and handed out highest priority first. Messages left
+    pending longer than `reclaim_idle_ms` by any consumer, i.e. by an executor which
+    died, are taken over with XAUTOCLAIM. A live consumer calls `refresh` more often than
+    that, so the messages it is still working on are never idle long enough to be taken.
+    """
+
+    def __init__(self, conn, queue_names: list[str], group_name, consumer_name,
+                 block_ms=5000, reclaim_idle_ms=3 * 3600 * 1000, reclaim_interval=60):
+        self.conn = conn
+        self.queue_names = queue_names
+        self.group_name = group_name
+        self.consumer_name = consumer_name
+        self.block_ms = block_ms
+        self.reclaim_idle_ms = reclaim_idle_ms
+        self.reclaim_interval = reclaim_interval
+        self._buffer = {q: [] for q in queue_names}
+        self._last_reclaim = 0
+        self._lock = trio.Lock()
+
+    def buffered(self):
+        return sum(len(msgs) for msgs in self._buffer.values())
+
+    def _pop(self):
+        for q in self.queue_names:
+            if self._buffer[q]:
+                return self._buffer[q].pop(0)
+        return None
+
+    def _push(self, queue_name, msg_id, payload):
+        if not payload or "message" not in payload:
+            logging.warning(f"RedisStreamConsumer drops empty message {queue_name}/{msg_id}")
+            self.conn.REDIS.xack(queue_name, self.group_name, msg_id)
+            return
+        self._buffer[queue_name].append(RedisMsg(self.conn.REDIS, queue_name, self.group_name, msg_id, payload))
+
+    def _reclaim(self):
+        for q in self.queue_names:
+            start_id = "0-0"
+            while True:
+                res = self.conn.REDIS.xautoclaim(q, self.group_name, self.consumer_name, self.reclaim_idle_ms,
+                                                 start_id=start_id, count=100)
+                start_id, messages = res[0], res[1]
+                for msg_id, payload in messages:
+                    logging.warning(f"RedisStreamConsumer reclaimed stale message {q}/{msg_id}")
+                    self._push(q, msg_id, payload)
+                if not messages or start_id in ("0-0", b"0-0"):
+                    break
+
+    def _refresh(self):
+        for q in self.queue_names:
+            pending = self.conn.REDIS.xpending_range(q, self.group_name, min="-", max="+", count=1000,
+                                                     consumername=self.consumer_name)
+            msg_ids = [p["message_id"] for p in pending]
+            if msg_ids:
+                # Claiming its own messages with JUSTID resets their idle time and nothing else.
+                self.conn.REDIS.xclaim(q, self.group_name, self.consumer_name, 0, msg_ids, justid=True)
+
+    async def refresh(self):
+        """Resets the idle time of the messages pending for this consumer, buffered or being handled."""
+        async with self._lock:
+            await trio.to_thread.run_sync(self._refresh)
+
+    def _fill(self, count):
+        for q in self.queue_names:
+            self.conn.ensure_group(q, self.group_name)
+        if time.time() - self._last_reclaim > self.reclaim_interval:
+            self._last_reclaim = time.time()
+            self._reclaim()
+        if self.buffered():
+            return
+        for q in self.queue_names:
+            if self.buffered() >= max(count, 1):
+                return
+            self._read({q: ">"}, max(count, 1) - self.buffered())
+        if self.buffered():
+            return
+        # One message a stream at most; any beyond `count` is served by the next calls.
+        self._read({q: ">" for q in self.queue_names}, 1, self.block_ms)
+
+    def _read(self, streams, count, block=None):
+        messages = self.conn.REDIS.xreadgroup(self.group_name, self.consumer_name, streams, count=count, block=block)
+        for queue_name, element_list in messages or []:
+            for msg_id, payload in element_list:
+                self._push(queue_name, msg_id, payload)
+
+    async def get(self, count=1) -> RedisMsg | None:
+        """The next message, reading up to `count` in all when the buffer is empty; None after `block_ms`."""
+        async with self._lock:
+            if not self.buffered():
+                try:
+                    await trio.to_thread.run_sync(self._fill, count)
+                except Exception as e:
+                    if "nogroup" in str(e).lower():
+                        self.conn._groups.difference_update((q, self.group_name) for q in self.queue_names)
+                    logging.exception("RedisStreamConsumer.get got exception")
+                    self.conn.__open__()
+                    await trio.sleep(1)
+            return self._pop()
+
+
 class RedisDistributedLock:
     def __init__(self, lock_key, lock_value=None, timeout=10, blocking_timeout=1):
         self.lock_key = lock_key
@@ -0,0 +1,133 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Cache of `Dealer.retrieval` results.
+
+Every knowledge base has a generation counter in Redis which the document store
+connections bump whenever they insert, update or delete chunks of it. The
+generations of the searched knowledge bases are part of the cache key, so a write
+makes all the cached results of that knowledge base unreachable at once.
+
+Elasticsearch and OpenSearch only make new chunks searchable at their next refresh.
+A search made in between would cache the old results under the new generation, so
+a knowledge base is not cached for RETRIEVAL_CACHE_SETTLE seconds after each write.
+"""
+import inspect
+import json
+import logging
+import os
+import re
+from functools import wraps
+
+import xxhash
+
+from rag.utils.redis_conn import REDIS_CONN
+
+# Seconds a retrieval result is kept, 0 disables the cache.
+RETRIEVAL_CACHE_TTL = int(os.environ.get("RETRIEVAL_CACHE_TTL", 600))
+# Seconds a knowledge base is not cached after a write, above the index refresh interval (1s).
+RETRIEVAL_CACHE_SETTLE = int(os.environ.get("RETRIEVAL_CACHE_SETTLE", 3))
+
+
+def kb_generation_key(kb_id):
+    return f"kb_generation:{kb_id}"
+
+
+def kb_settling_key(kb_id):
+    return f"kb_settling:{kb_id}"
+
+
+def bump_kb_generation(kb_ids):
+    if not kb_ids:
+        return
+    if isinstance(kb_ids, str):
+        kb_ids = [kb_ids]
+    for kb_id in kb_ids:
+        REDIS_CONN.incr(kb_generation_key(kb_id))
+        if RETRIEVAL_CACHE_SETTLE > 0:
+            REDIS_CONN.set(kb_settling_key(kb_id), "1", RETRIEVAL_CACHE_SETTLE)
+
+
+def get_kb_generations(kb_ids: list) -> list | None:
+    """The generations of `kb_ids`, None while one of them has just been written."""
+    values = REDIS_CONN.mget([kb_generation_key(kb_id) for kb_id in kb_ids] + [kb_settling_key(kb_id) for kb_id in kb_ids])
+    if any(values[len(kb_ids):]):
+        return None
+    return [g or "0" for g in values[:len(kb_ids)]]
+
+
+def invalidates_kb(func):
+    """Bump the generation of the `knowledgebaseId` a document store write is made against."""
+    sig = inspect.signature(func)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            try:
+                kb_id = sig.bind(*args, **kwargs).arguments.get("knowledgebaseId")
+                bump_kb_generation(kb_id)
+            except Exception:
+                logging.exception(f"{func.__qualname__} failed to bump knowledge base generation")
+
+    return wrapper
+
+
+def _model_name(mdl):
+    if mdl is None:
+        return None
+    return getattr(mdl, "cache_name", None) or getattr(mdl, "llm_name", None) or type(mdl).__name__
+
+
+def retrieval_cache_key(question, tenant_ids, kb_ids, doc_ids, embd_mdl, rerank_mdl, **params) -> str | None:
+    if not RETRIEVAL_CACHE_TTL or not kb_ids or not REDIS_CONN.is_alive():
+        return None
+    kb_ids = sorted(kb_ids)
+    generations = get_kb_generations(kb_ids)
+    if generations is None:
+        return None
+    hasher = xxhash.xxh128()
+    hasher.update(json.dumps({
+        "question": re.sub(r"\s+", " ", question).strip().lower(),
+        "tenant_ids": sorted(tenant_ids),
+        "kb_ids": kb_ids,
+        "generations": generations,
+        "doc_ids": sorted(doc_ids) if doc_ids else doc_ids,
+        "embd_mdl": _model_name(embd_mdl),
+        "rerank_mdl": _model_name(rerank_mdl),
+        "params": params,
+    }, sort_keys=True, default=str).encode("utf-8"))
+    return "retrieval:" + hasher.hexdigest()
+
+
+def get_retrieval_cache(key):
+    if not key:
+        return None
+    bin = REDIS_CONN.get(key)
+    if not bin:
+        return None
+    try:
+        return json.loads(bin)
+    except Exception:
+        return None
+
+
+def set_retrieval_cache(key, ranks):
+    if not key:
+        return
+    REDIS_CONN.set(key, json.dumps(ranks, ensure_ascii=False, default=lambda o: o.item() if hasattr(o, "item") else str(o)),
+                   RETRIEVAL_CACHE_TTL)
@@ -0,0 +1,186 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import threading
+import time
+
+import anyio
+import pytest
+
+from api import asgi
+from api.asgi import WSGIBridge
+
+
+def scope(path="/"):
+    return {"type": "http", "method": "POST", "path": path, "query_string": b"a=1", "http_version": "1.1",
+            "headers": [(b"content-type", b"application/json"), (b"x-token", b"t")]}
+
+
+class Client:
+    """
+    The ASGI server side of one request: its body in `chunks`, then a disconnect once `gone` is set.
+    `streaming` is set once the response start and two body messages are sent.
+    """
+
+    def __init__(self, chunks=(b"",)):
+        self.messages = [{"type": "http.request", "body": c, "more_body": i < len(chunks) - 1} for i, c in enumerate(chunks)]
+        self.sent = []
+        self.gone = anyio.Event()
+        self.streaming = anyio.Event()
+
+    async def receive(self):
+        if self.messages:
+            return self.messages.pop(0)
+        await self.gone.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(self, message):
+        self.sent.append(message)
+        if len(self.sent) >= 3:
+            self.streaming.set()
+
+    def body(self):
+        return b"".join(m.get("body", b"") for m in self.sent if m["type"] == "http.response.body")
+
+
+def echo(environ, start_response):
+    body = environ["wsgi.input"].read()
+    start_response("200 OK", [("Content-Type", "text/plain"), ("Content-Length", str(len(body)))])
+    echo.environ = environ
+    echo.spooled = getattr(environ["wsgi.input"], "_rolled", False)
+    return [body]
+
+
+class Stream:
+    def __init__(self, items):
+        self.items = items
+        self.closed = False
+        self.pulled = 0
+
+    def __call__(self, environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/event-stream")])
+        return self
+
+    def __iter__(self):
+        for item in self.items:
+            self.pulled += 1
+            yield item
+
+    def close(self):
+        self.closed = True
+
+
+class TestWSGIBridge:
+    @pytest.mark.p1
+    def test_small_response_is_sent_at_once(self):
+        client = Client([b'{"a":', b' 1}'])
+        anyio.run(WSGIBridge(echo), scope(), client.receive, client.send)
+        assert client.sent[0]["status"] == 200
+        assert (b"content-length", b"8") in client.sent[0]["headers"]
+        assert client.sent[1:] == [{"type": "http.response.body", "body": b'{"a": 1}'}]
+        assert echo.environ["QUERY_STRING"] == "a=1" and echo.environ["HTTP_X_TOKEN"] == "t"
+        assert not echo.spooled
+
+    @pytest.mark.p2
+    def test_write_callable(self):
+        def legacy(environ, start_response):
+            write = start_response("200 OK", [("Content-Type", "text/plain")])
+            write(b"head ")
+            return [b"tail"]
+
+        client = Client()
+        anyio.run(WSGIBridge(legacy), scope(), client.receive, client.send)
+        assert client.body() == b"head tail"
+
+    @pytest.mark.p1
+    def test_large_body_is_spooled(self, monkeypatch):
+        monkeypatch.setattr(asgi, "SPOOLED_BODY_BYTES", 8)
+        client = Client([b"0123456", b"789", b"abcdef"])
+        anyio.run(WSGIBridge(echo), scope(), client.receive, client.send)
+        assert client.body() == b"0123456789abcdef"
+        assert echo.spooled
+
+    @pytest.mark.p1
+    def test_stream_is_sent_item_by_item(self):
+        stream = Stream([b"data: 1\n\n", b"", b"data: 2\n\n"])
+        client = Client()
+        anyio.run(WSGIBridge(stream), scope(), client.receive, client.send)
+        assert [m.get("body") for m in client.sent[1:]] == [b"data: 1\n\n", b"data: 2\n\n", b""]
+        assert [m.get("more_body", False) for m in client.sent[1:]] == [True, True, False]
+        assert stream.closed
+
+    @pytest.mark.p1
+    def test_disconnect_stops_the_stream(self):
+        class Endless(Stream):
+            def __iter__(self):
+                while True:
+                    self.pulled += 1
+                    time.sleep(0.01)
+                    yield b"data: x\n\n"
+
+        stream = Endless([])
+        client = Client()
+
+        async def main():
+            async with anyio.create_task_group() as tg:
+                tg.start_soon(WSGIBridge(stream), scope(), client.receive, client.send)
+                await client.streaming.wait()
+                client.gone.set()
+
+        anyio.run(main)
+        assert stream.closed
+        assert client.sent[-1].get("more_body")
+
+    @pytest.mark.p2
+    def test_streams_share_the_stream_workers(self):
+        lock = threading.Lock()
+        active, most = [0], [0]
+
+        class Slow(Stream):
+            def __iter__(self):
+                for item in self.items:
+                    with lock:
+                        active[0] += 1
+                        most[0] = max(most[0], active[0])
+                    time.sleep(0.02)
+                    with lock:
+                        active[0] -= 1
+                    yield item
+
+        bridge = WSGIBridge(Slow([b"a", b"b", b"c"]), stream_workers=1)
+        clients = [Client() for _ in range(3)]
+
+        async def main():
+            async with anyio.create_task_group() as tg:
+                for c in clients:
+                    tg.start_soon(bridge, scope(), c.receive, c.send)
+
+        anyio.run(main)
+        assert all(c.body() == b"abc" for c in clients)
+        assert most[0] == 1
+
+    @pytest.mark.p2
+    def test_lifespan(self):
+        messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message["type"])
+
+        anyio.run(WSGIBridge(echo), {"type": "lifespan"}, receive, send)
+        assert sent == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
@@ -0,0 +1,90 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from api.db.services import dialog_service
+from api.db.services.dialog_service import FanOut
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    p = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(dialog_service, "_pool", p)
+    yield p
+    p.shutdown(wait=True, cancel_futures=True)
+
+
+def busy(pool, seconds):
+    """Keep the only thread of `pool` busy for `seconds`."""
+    pool.submit(time.sleep, seconds)
+
+
+class TestFanOut:
+    @pytest.mark.p1
+    def test_results_and_elapsed(self, pool):
+        fan_out = FanOut()
+        fan_out.submit("a", lambda x: x * 2, 21)
+        assert fan_out.result("a", 5) == 42
+        assert fan_out.run("b", threading.current_thread) is threading.current_thread()
+        assert set(fan_out.elapsed) == {"a", "b"}
+
+    @pytest.mark.p1
+    def test_timeout_counts_from_the_start(self, pool):
+        busy(pool, 0.3)
+        fan_out = FanOut()
+        fan_out.submit("a", lambda: time.sleep(0.1) or "done")
+        # 0.4s after the submission, but 0.1s after the step started.
+        assert fan_out.result("a", 0.35) == "done"
+        assert fan_out.elapsed["a"] < 0.3
+
+    @pytest.mark.p1
+    def test_step_outliving_its_timeout_is_left_out(self, pool):
+        fan_out = FanOut()
+        fan_out.submit("a", time.sleep, 0.3)
+        assert fan_out.result("a", 0.05) is None
+
+    @pytest.mark.p1
+    def test_step_never_started_is_cancelled(self, pool):
+        busy(pool, 0.2)
+        ran = threading.Event()
+        fan_out = FanOut()
+        fan_out.submit("a", ran.set)
+        assert fan_out.result("a", 0.05) is None
+        pool.shutdown(wait=True)
+        assert not ran.is_set()
+
+    @pytest.mark.p2
+    def test_required_step_raises(self, pool):
+        fan_out = FanOut()
+        fan_out.submit("a", lambda: 1 / 0)
+        with pytest.raises(ZeroDivisionError):
+            fan_out.result("a", 5, required=True)
+        fan_out.submit("b", lambda: 1 / 0)
+        assert fan_out.result("b", 5) is None
+
+    @pytest.mark.p2
+    def test_close_cancels_the_steps_left(self, pool):
+        busy(pool, 0.1)
+        ran = threading.Event()
+        fan_out = FanOut()
+        fan_out.submit("a", ran.set)
+        fan_out.close()
+        pool.shutdown(wait=True)
+        assert not ran.is_set()
@@ -0,0 +1,73 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import pytest
+
+from api.db.services import document_service
+from api.db.services.document_service import DocumentService, mark_docs_progress_changed, pop_changed_docs
+
+
+class FakeRedisSets:
+    def __init__(self):
+        self.sets = {}
+
+    def sadd_many(self, key, members):
+        self.sets.setdefault(key, set()).update(members)
+
+    def spop(self, key, count):
+        s = self.sets.get(key, set())
+        return [s.pop() for _ in range(min(count, len(s)))]
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    r = FakeRedisSets()
+    monkeypatch.setattr(document_service, "REDIS_CONN", r)
+    return r
+
+
+class TestChangedDocs:
+    @pytest.mark.p1
+    def test_marked_docs_are_popped_once(self, redis, monkeypatch):
+        monkeypatch.setattr(document_service, "DOC_PROGRESS_BATCH_SIZE", 2)
+        mark_docs_progress_changed(["d1", "d2"])
+        mark_docs_progress_changed(["d2", "d3"])
+        assert sorted(pop_changed_docs()) == ["d1", "d2", "d3"]
+        assert pop_changed_docs() == []
+
+
+class TestUpdateProgress:
+    @pytest.mark.p1
+    def test_refreshes_changed_docs_between_full_sweeps(self, redis, monkeypatch):
+        monkeypatch.setattr(document_service, "DOC_PROGRESS_FULL_SWEEP_TICKS", 3)
+        monkeypatch.setattr(DocumentService, "_progress_ticks", 0)
+        queried, refreshed = [], []
+
+        def get_unfinished_docs(doc_ids=None):
+            queried.append(doc_ids)
+            return [{"id": d} for d in (doc_ids or ["d1", "d2", "d3"])]
+
+        monkeypatch.setattr(DocumentService, "get_unfinished_docs", get_unfinished_docs)
+        monkeypatch.setattr(DocumentService, "_update_progress_of", lambda docs, _: refreshed.append([d["id"] for d in docs]))
+        # update_progress opens a database connection around its body.
+        update_progress = DocumentService.update_progress.__func__.__wrapped__
+
+        update_progress(DocumentService)
+        mark_docs_progress_changed(["d2"])
+        update_progress(DocumentService)
+        update_progress(DocumentService)
+        update_progress(DocumentService)
+        assert queried == [None, ["d2"], None]
+        assert refreshed == [["d1", "d2", "d3"], ["d2"], ["d1", "d2", "d3"]]
@@ -0,0 +1,116 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import pytest
+
+from api.db.services import tenant_llm_service
+from api.db.services.tenant_llm_service import ModelRegistry
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+        self.gets = 0
+
+    def get(self, k):
+        self.gets += 1
+        return self.data.get(k)
+
+    def incr(self, k):
+        self.data[k] = self.data.get(k, 0) + 1
+        return self.data[k]
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    r = FakeRedis()
+    monkeypatch.setattr(tenant_llm_service, "REDIS_CONN", r)
+    return r
+
+
+class Calls:
+    def __init__(self, config="cfg", value="client"):
+        self.config = config
+        self.value = value
+        self.resolved = 0
+        self.built = 0
+
+    def resolve(self):
+        self.resolved += 1
+        return self.config
+
+    def build(self, config):
+        self.built += 1
+        return self.value
+
+
+class TestModelRegistry:
+    @pytest.mark.p1
+    def test_entries_are_cached(self, redis):
+        registry = ModelRegistry(ttl=3600, version_ttl=3600)
+        calls = Calls()
+        for _ in range(3):
+            assert registry.get("t1", ("model",), calls.resolve, calls.build) == ("cfg", "client")
+        assert (calls.resolved, calls.built) == (1, 1)
+        # The version is read once too.
+        assert redis.gets == 1
+
+    @pytest.mark.p1
+    def test_version_is_read_again_after_its_ttl(self, redis):
+        registry = ModelRegistry(ttl=3600, version_ttl=0)
+        calls = Calls()
+        registry.get("t1", ("model",), calls.resolve, calls.build)
+        # Another process changed the settings.
+        redis.incr(tenant_llm_service.TENANT_LLM_VERSION_KEY.format("t1"))
+        registry.get("t1", ("model",), calls.resolve, calls.build)
+        assert calls.resolved == 2
+        # The config did not change, so the client is kept.
+        assert calls.built == 1
+
+    @pytest.mark.p1
+    def test_invalidate_drops_the_tenant(self, redis):
+        registry = ModelRegistry(ttl=3600, version_ttl=3600)
+        calls, other = Calls(), Calls()
+        registry.get("t1", ("model",), calls.resolve, calls.build)
+        registry.get("t2", ("model",), other.resolve, other.build)
+        registry.invalidate("t1")
+        calls.config = "cfg2"
+        assert registry.get("t1", ("model",), calls.resolve, calls.build) == ("cfg2", "client")
+        registry.get("t2", ("model",), other.resolve, other.build)
+        assert (calls.built, other.built) == (2, 1)
+
+    @pytest.mark.p1
+    def test_failed_build_is_not_cached(self, redis):
+        registry = ModelRegistry(ttl=3600, version_ttl=3600)
+        calls = Calls(config={"public_key": "pk"}, value=None)
+        registry.get("t1", ("langfuse",), calls.resolve, calls.build)
+        registry.get("t1", ("langfuse",), calls.resolve, calls.build)
+        assert calls.built == 2
+        # Nothing to build from is an answer.
+        nothing = Calls(config=None, value=None)
+        registry.get("t2", ("langfuse",), nothing.resolve, nothing.build)
+        registry.get("t2", ("langfuse",), nothing.resolve, nothing.build)
+        assert nothing.built == 1
+
+    @pytest.mark.p2
+    def test_least_recently_used_entries_are_dropped(self, redis):
+        registry = ModelRegistry(ttl=3600, version_ttl=3600, size=2)
+        calls = {t: Calls() for t in ["t1", "t2", "t3"]}
+        registry.get("t1", ("model",), calls["t1"].resolve, calls["t1"].build)
+        registry.get("t2", ("model",), calls["t2"].resolve, calls["t2"].build)
+        registry.get("t1", ("model",), calls["t1"].resolve, calls["t1"].build)
+        registry.get("t3", ("model",), calls["t3"].resolve, calls["t3"].build)
+        assert [k[0] for k in registry._entries] == ["t1", "t3"]
+        assert len(registry._versions) == 2
@@ -0,0 +1,65 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import pytest
+
+from api.db.services.task_service import ProgressAggregator, TaskService
+
+
+@pytest.fixture
+def writes(monkeypatch):
+    calls = []
+    monkeypatch.setattr(TaskService, "update_progress_many", classmethod(lambda cls, infos: calls.append(infos)))
+    return calls
+
+
+class TestProgressAggregator:
+    @pytest.mark.p1
+    def test_updates_are_merged_per_task(self, writes):
+        agg = ProgressAggregator(interval=3600)
+        agg.add("t1", {"progress_msg": "a", "progress": 0.1})
+        agg.add("t1", {"progress_msg": "b", "progress": 0.05})
+        agg.add("t2", {"progress_msg": "c"})
+        agg.add("t1", {"progress": 0.3})
+        assert not agg.due()
+        agg.flush()
+        assert writes == [{"t1": {"progress_msg": "a\nb", "progress": 0.3}, "t2": {"progress_msg": "c"}}]
+        assert agg.stats == {"updates": 4, "writes": 1}
+
+    @pytest.mark.p1
+    def test_failure_sticks(self, writes):
+        agg = ProgressAggregator(interval=3600)
+        agg.add("t1", {"progress": -1})
+        agg.add("t1", {"progress": 0.5})
+        agg.flush()
+        assert writes[0]["t1"]["progress"] == -1
+
+    @pytest.mark.p1
+    def test_completion_is_due_but_not_written_by_add(self, writes):
+        agg = ProgressAggregator(interval=3600)
+        agg.add("t1", {"progress": 0.2})
+        agg.add("t2", {"progress_msg": "done", "progress": 1.})
+        assert writes == []
+        assert agg.due()
+        agg.flush(["t2"])
+        assert writes == [{"t2": {"progress_msg": "done", "progress": 1.}}]
+        assert not agg.due()
+
+    @pytest.mark.p2
+    def test_due_after_the_interval(self, writes):
+        agg = ProgressAggregator(interval=0)
+        assert not agg.due()
+        agg.add("t1", {"progress_msg": "a"})
+        assert agg.due()
@@ -0,0 +1,142 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import contextlib
+from types import SimpleNamespace
+
+import pytest
+from peewee import OperationalError
+
+from api.db.services import tenant_llm_service
+from api.db.services.tenant_llm_service import TenantLLMService, TenantService, UsageAccumulator
+
+
+class FakeDB:
+    def connection_context(self):
+        return contextlib.nullcontext()
+
+
+class FakeUsage:
+    def __init__(self):
+        self.written = {}
+        self.fail_after = None
+        self.missing = set()
+
+    def increase_usage(self, tenant_id, llm_type, used_tokens, llm_name=None, raise_error=False):
+        if self.fail_after is not None and len(self.written) >= self.fail_after:
+            if not raise_error:
+                return 0
+            raise ConnectionError("database is gone")
+        if tenant_id in self.missing:
+            return 0
+        key = (tenant_id, llm_type, llm_name)
+        self.written[key] = self.written.get(key, 0) + used_tokens
+        return 1
+
+
+@pytest.fixture
+def usage(monkeypatch):
+    u = FakeUsage()
+    monkeypatch.setattr(tenant_llm_service, "DB", FakeDB())
+    monkeypatch.setattr(TenantLLMService, "increase_usage", classmethod(lambda cls, *args, **kwargs: u.increase_usage(*args, **kwargs)))
+    return u
+
+
+@pytest.fixture
+def acc():
+    a = UsageAccumulator(interval=3600)
+    # Keep the flusher thread and the exit hook out of the test.
+    a._thread = object()
+    return a
+
+
+class TestUsageAccumulator:
+    @pytest.mark.p1
+    def test_usage_is_summed_per_model(self, usage, acc):
+        acc.add("t1", "chat", 10, "m1")
+        acc.add("t1", "chat", "5", "m1")
+        acc.add("t1", "embedding", 3)
+        acc.add("t1", "chat", 0, "m1")
+        acc.add("t1", "chat", "n/a", "m1")
+        acc.flush()
+        assert usage.written == {("t1", "chat", "m1"): 15, ("t1", "embedding", None): 3}
+        assert acc.stats["flushes"] == 1 and acc.stats["tokens"] == 18 and acc.stats["failures"] == 0
+        acc.flush()
+        assert acc.stats["flushes"] == 1
+
+    @pytest.mark.p1
+    def test_unwritten_usage_is_added_back(self, usage, acc):
+        acc.add("t1", "chat", 10, "m1")
+        acc.add("t2", "chat", 20, "m1")
+        usage.fail_after = 1
+        with pytest.raises(ConnectionError):
+            acc.flush()
+        assert len(usage.written) == 1
+        assert acc.stats["failures"] == 1 and acc.stats["flushes"] == 0
+        acc.add("t2", "chat", 1, "m1")
+        usage.fail_after = None
+        acc.flush()
+        assert usage.written == {("t1", "chat", "m1"): 10, ("t2", "chat", "m1"): 21}
+
+    @pytest.mark.p2
+    def test_usage_of_a_missing_model_is_counted_as_failed(self, usage, acc):
+        usage.missing = {"t1"}
+        acc.add("t1", "chat", 10, "m1")
+        acc.flush()
+        assert acc.stats["failures"] == 1
+        # It is not retried.
+        usage.missing = set()
+        acc.flush()
+        assert usage.written == {}
+
+
+class BrokenTenantLLM:
+    """TenantLLM model of a database that went away after the tenant was read."""
+
+    tenant_id = llm_name = llm_factory = used_tokens = 0
+
+    @classmethod
+    def update(cls, **kwargs):
+        raise OperationalError("Lost connection to MySQL server")
+
+
+class TestIncreaseUsage:
+    @pytest.fixture
+    def increase_usage(self, monkeypatch):
+        tenant = SimpleNamespace(llm_id="m1", embd_id="e1", asr_id="", img2txt_id="", rerank_id="", tts_id="")
+        monkeypatch.setattr(TenantService.model, "get_or_none", classmethod(lambda cls, *args: tenant))
+        monkeypatch.setattr(TenantService, "get_by_id", classmethod(lambda cls, pid: (True, tenant)))
+        monkeypatch.setattr(TenantLLMService, "model", BrokenTenantLLM)
+        # Without the connection context of the decorator.
+        monkeypatch.setattr(TenantLLMService, "increase_usage", classmethod(TenantLLMService.increase_usage.__func__.__wrapped__))
+        return TenantLLMService.increase_usage
+
+    @pytest.mark.p1
+    def test_database_error_returns_0(self, increase_usage):
+        assert increase_usage("t1", "chat", 10) == 0
+
+    @pytest.mark.p1
+    def test_database_error_is_raised_for_the_accumulator(self, increase_usage):
+        with pytest.raises(OperationalError):
+            increase_usage("t1", "chat", 10, raise_error=True)
+
+    @pytest.mark.p1
+    def test_flush_keeps_usage_the_database_did_not_take(self, monkeypatch, increase_usage, acc):
+        monkeypatch.setattr(tenant_llm_service, "DB", FakeDB())
+        acc.add("t1", "chat", 10)
+        with pytest.raises(OperationalError, match="Lost connection"):
+            acc.flush()
+        assert acc.stats["failures"] == 1 and acc.stats["tokens"] == 0
+        assert dict(acc._pending) == {("t1", "chat", None): 10}
@@ -0,0 +1,50 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+from deepdoc.parser.pdf_parser import _DecodedPages, _EncodedPage
+
+
+def page(color):
+    img = Image.new("RGB", (300, 400), "white")
+    ImageDraw.Draw(img).rectangle((20, 30, 200, 120), fill=color)
+    return img
+
+
+class TestEncodedPage:
+    @pytest.mark.p1
+    def test_behaves_like_the_page(self):
+        img = page((30, 120, 200))
+        encoded = _EncodedPage(img, _DecodedPages())
+        assert encoded.size == img.size
+        assert encoded.mode == "RGB"
+        assert np.array_equal(np.array(encoded), np.array(img))
+        assert list(encoded.crop((10, 10, 60, 80)).getdata()) == list(img.crop((10, 10, 60, 80)).getdata())
+        assert encoded.convert("L").size == img.size
+        assert len(encoded.png) < len(img.tobytes())
+
+    @pytest.mark.p2
+    def test_only_the_last_pages_stay_decoded(self):
+        decoded = _DecodedPages(capacity=2)
+        pages = [_EncodedPage(page((i, i, i)), decoded) for i in range(4)]
+        first = pages[0].image()
+        assert pages[0].image() is first
+        for p in pages[1:]:
+            p.image()
+        assert len(decoded._pages) == 2
+        assert pages[0].image() is not first
@@ -0,0 +1,69 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import os
+
+import numpy as np
+import pytest
+
+from deepdoc.vision.session_pool import _PooledSession, default_sessions
+
+
+class FakeBinding:
+    def __init__(self):
+        self.inputs = {}
+
+    def bind_cpu_input(self, name, arr):
+        self.inputs[name] = arr
+
+    def bind_ortvalue_input(self, name, v):
+        self.inputs[name] = v.numpy()
+
+    def bind_output(self, name):
+        pass
+
+    def copy_outputs_to_cpu(self):
+        return self.outputs
+
+
+class FakeSession:
+    """Doubles its input, the way a session reads the buffers bound to it."""
+
+    def io_binding(self):
+        return FakeBinding()
+
+    def run_with_iobinding(self, binding, run_options):
+        binding.outputs = [binding.inputs["x"] * 2]
+
+    def get_outputs(self):
+        return []
+
+
+class TestPooledSession:
+    @pytest.mark.p1
+    def test_callers_buffers_are_not_overwritten(self):
+        ps = _PooledSession(FakeSession(), "cpu", 0)
+        first, second = np.zeros(3, np.float32), np.ones(3, np.float32)
+        assert ps.run_with_io_binding(["y"], {"x": first}, None)[0].tolist() == [0., 0., 0.]
+        assert ps.run_with_io_binding(["y"], {"x": second}, None)[0].tolist() == [2., 2., 2.]
+        assert first.tolist() == [0., 0., 0.]
+
+    @pytest.mark.p2
+    def test_default_sessions(self, monkeypatch):
+        monkeypatch.setattr(os, "cpu_count", lambda: 64)
+        assert default_sessions(["CPUExecutionProvider"]) == 4
+        assert default_sessions(["CUDAExecutionProvider", "CPUExecutionProvider"]) == 1
+        monkeypatch.setattr(os, "cpu_count", lambda: 1)
+        assert default_sessions(["CPUExecutionProvider"]) == 1
@@ -0,0 +1,94 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import json
+
+import networkx as nx
+import pytest
+
+from graphrag.utils import graph_snapshot, is_sharded, rank_graph, update_pagerank
+
+
+def weighted_graph(n=30, seed=0):
+    g = nx.connected_watts_strogatz_graph(n, 4, 0.3, seed=seed)
+    g = nx.relabel_nodes(g, {i: f"n{i}" for i in g.nodes})
+    for i, (u, v) in enumerate(g.edges):
+        g.edges[u, v]["weight"] = 1 + i % 3
+    return g
+
+
+class TestPagerank:
+    @pytest.mark.p1
+    def test_rank_graph_stores_pagerank_and_strength(self):
+        g = weighted_graph()
+        rank_graph(g)
+        expected = nx.pagerank(g)
+        assert all(g.nodes[n]["pagerank"] == pytest.approx(expected[n], abs=1e-6) for n in g.nodes)
+        assert all(g.nodes[n]["strength"] == g.degree(n, weight="weight") for n in g.nodes)
+
+    @pytest.mark.p1
+    def test_update_of_every_node_converges_to_pagerank(self):
+        g = weighted_graph()
+        rank_graph(g)
+        g.add_edge("new", "n0", weight=2)
+        update_pagerank(g, list(g.nodes), len(g.nodes), tol=1e-9)
+        expected = nx.pagerank(g, tol=1e-9)
+        assert all(g.nodes[n]["pagerank"] == pytest.approx(expected[n], abs=1e-5) for n in g.nodes)
+
+    @pytest.mark.p2
+    def test_update_leaves_the_other_nodes(self):
+        g = weighted_graph()
+        rank_graph(g)
+        before = dict(g.nodes(data="pagerank"))
+        g.add_edge("new", "n0", weight=2)
+        update_pagerank(g, ["new", "n0"], len(g.nodes))
+        assert all(g.nodes[n]["pagerank"] == before[n] for n in before if n != "n0")
+        assert g.nodes["new"]["pagerank"] > 0
+        assert g.nodes["n0"]["strength"] == g.degree("n0", weight="weight")
+
+
+class TestSnapshot:
+    @pytest.mark.p1
+    def test_keeps_the_top_nodes_and_their_edges(self):
+        g = weighted_graph()
+        rank_graph(g)
+        g.graph["source_id"] = ["d1"]
+        snapshot = graph_snapshot(g, size=10)
+        top = sorted(g.nodes, key=lambda n: g.nodes[n]["pagerank"], reverse=True)[:10]
+        assert set(snapshot.nodes) == set(top)
+        assert set(map(frozenset, snapshot.edges)) == set(map(frozenset, g.subgraph(top).edges))
+        assert snapshot.graph == {}
+
+    @pytest.mark.p2
+    def test_graph_overrides_the_previous_snapshot(self):
+        previous = nx.Graph()
+        previous.add_node("a", pagerank=0.9)
+        previous.add_node("b", pagerank=0.5)
+        previous.add_edge("a", "b")
+        g = nx.Graph()
+        g.add_node("a", pagerank=0.1)
+        g.add_node("c", pagerank=0.7)
+        snapshot = graph_snapshot(g, previous, size=2)
+        assert dict(snapshot.nodes(data="pagerank")) == {"c": 0.7, "b": 0.5}
+
+
+class TestIsSharded:
+    @pytest.mark.p2
+    def test_is_sharded(self):
+        sharded = nx.node_link_data(nx.Graph(sharded=True), edges="edges")
+        assert is_sharded({"removed_kwd": "N", "content_with_weight": json.dumps(sharded)})
+        assert not is_sharded({"removed_kwd": "Y", "content_with_weight": json.dumps(sharded)})
+        assert not is_sharded({"removed_kwd": "N", "content_with_weight": json.dumps(nx.node_link_data(nx.Graph(), edges="edges"))})
+        assert not is_sharded(None)
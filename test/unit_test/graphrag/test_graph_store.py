@@ -0,0 +1,255 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import json
+
+import networkx as nx
+import pytest
+import trio
+
+from graphrag import utils
+from graphrag.utils import GraphChange, delete_graph_edges, get_graph, graph_chunk_id, search_graph_chunks, set_graph
+from rag.utils.doc_store_conn import DocStoreConnection
+
+
+def matches(row, condition):
+    for k, v in condition.items():
+        value = row.get(k)
+        values = value if isinstance(value, list) else [value]
+        if isinstance(v, list):
+            if not set(v) & set(values):
+                return False
+        elif v not in values:
+            return False
+    return True
+
+
+class FakeDocStore:
+    """Rows of one knowledge base, with the scan, insert and delete the graph code relies on."""
+
+    def __init__(self, rows=()):
+        self.rows = {r["id"]: dict(r) for r in rows}
+        self.pages = 0
+        self.ops = []
+
+    def scan(self, selectFields, condition, indexName, knowledgebaseIds, pageSize=1000):
+        found = [r for r in self.rows.values() if matches(r, condition)]
+        for i in range(0, len(found), pageSize):
+            self.pages += 1
+            yield found[i:i + pageSize]
+
+    def getFields(self, res, fields):
+        return {r["id"]: {f: r[f] for f in fields if f in r} for r in res}
+
+    def insert(self, rows, indexName, knowledgebaseId=None):
+        self.ops.append(("insert", [r["id"] for r in rows]))
+        for r in rows:
+            self.rows[r["id"]] = dict(r)
+        return []
+
+    def delete(self, condition, indexName, knowledgebaseId):
+        self.ops.append(("delete", condition))
+        ids = [i for i, r in self.rows.items() if matches(r, condition)]
+        for i in ids:
+            del self.rows[i]
+        return len(ids)
+
+
+@pytest.fixture
+def store(monkeypatch):
+    s = FakeDocStore()
+    monkeypatch.setattr(utils.settings, "docStoreConn", s, raising=False)
+    return s
+
+
+def entity(name, **meta):
+    return {"id": f"e-{name}", "kb_id": "kb1", "knowledge_graph_kwd": "entity", "entity_kwd": name,
+            "content_with_weight": json.dumps({"description": name, "source_id": ["d1"], **meta})}
+
+
+def graph_chunk(graph: nx.Graph):
+    return {"removed_kwd": "N", "source_id": ["d1"], "content_with_weight": json.dumps(nx.node_link_data(graph, edges="edges"))}
+
+
+class TestSearchGraphChunks:
+    @pytest.mark.p1
+    def test_reads_past_the_result_window(self, store, monkeypatch):
+        monkeypatch.setattr(utils, "GRAPH_LOAD_PAGE", 3)
+        store.rows = {e["id"]: e for e in (entity(f"n{i}") for i in range(20))}
+        chunks = trio.run(search_graph_chunks, "t1", "kb1", {"knowledge_graph_kwd": ["entity"]}, ["entity_kwd"])
+        assert sorted(c["entity_kwd"] for c in chunks) == sorted(f"n{i}" for i in range(20))
+        assert store.pages == 7
+
+    @pytest.mark.p2
+    def test_search_errors_are_raised(self, store, monkeypatch):
+        def scan(*args, **kwargs):
+            raise ConnectionError("search failed")
+            yield
+
+        monkeypatch.setattr(store, "scan", scan)
+        with pytest.raises(ConnectionError):
+            trio.run(search_graph_chunks, "t1", "kb1", {}, ["entity_kwd"])
+
+
+class FakeSearch:
+    def __init__(self, n_rows):
+        self.n_rows = n_rows
+        self.calls = []
+
+    def search(self, selectFields, highlightFields, condition, matchExprs, orderBy, offset, limit, indexNames, knowledgebaseIds):
+        self.calls.append((orderBy.fields, offset, limit))
+        return [f"c{i}" for i in range(offset, min(offset + limit, self.n_rows))]
+
+    def getChunkIds(self, res):
+        return res
+
+
+class TestDefaultScan:
+    @pytest.mark.p2
+    def test_pages_in_id_order_until_a_short_page(self):
+        fake = FakeSearch(5)
+        pages = list(DocStoreConnection.scan(fake, ["id"], {}, "idx", ["kb1"], pageSize=2))
+        assert pages == [["c0", "c1"], ["c2", "c3"], ["c4"]]
+        assert [c[1] for c in fake.calls] == [0, 2, 4]
+        assert fake.calls[0][0] == [("id", 0)]
+
+
+class TestGetGraph:
+    @pytest.mark.p1
+    def test_sharded_graph_is_loaded_from_its_chunks(self, store, monkeypatch):
+        store.rows = {e["id"]: e for e in (entity("a"), entity("b"))}
+        snapshot = nx.Graph(sharded=True)
+
+        async def get_graph_chunk(tenant_id, kb_id):
+            return graph_chunk(snapshot)
+
+        monkeypatch.setattr(utils, "get_graph_chunk", get_graph_chunk)
+        g = trio.run(get_graph, "t1", "kb1")
+        assert sorted(g.nodes) == ["a", "b"]
+        assert g.graph["source_id"] == ["d1"]
+
+    @pytest.mark.p1
+    def test_broken_graph_is_an_error(self, store, monkeypatch):
+        async def get_graph_chunk(tenant_id, kb_id):
+            return {"removed_kwd": "N", "source_id": [], "content_with_weight": "{broken"}
+
+        monkeypatch.setattr(utils, "get_graph_chunk", get_graph_chunk)
+        with pytest.raises(ValueError):
+            trio.run(get_graph, "t1", "kb1")
+
+
+def stable_entity(name):
+    return {**entity(name), "id": graph_chunk_id("kb1", "entity", name)}
+
+
+def relation(f, t, _id=None):
+    return {"id": _id or graph_chunk_id("kb1", "relation", *sorted([f, t])), "kb_id": "kb1", "knowledge_graph_kwd": "relation",
+            "from_entity_kwd": f, "to_entity_kwd": t, "content_with_weight": "{}"}
+
+
+@pytest.fixture
+def no_embedding(monkeypatch):
+    async def node_to_chunk(kb_id, embd_mdl, name, meta, chunks):
+        chunks.append(stable_entity(name))
+
+    async def edge_to_chunk(kb_id, embd_mdl, f, t, meta, chunks):
+        chunks.append(relation(f, t))
+
+    monkeypatch.setattr(utils, "graph_node_to_chunk", node_to_chunk)
+    monkeypatch.setattr(utils, "graph_edge_to_chunk", edge_to_chunk)
+
+
+def kinds(store):
+    return sorted((r["knowledge_graph_kwd"], r["id"]) for r in store.rows.values())
+
+
+@pytest.mark.usefixtures("no_embedding")
+class TestSetGraph:
+    @pytest.mark.p1
+    def test_changed_chunks_are_written_before_stale_ones_go(self, store):
+        store.rows = {r["id"]: r for r in [
+            {"id": "old-graph", "kb_id": "kb1", "knowledge_graph_kwd": "graph"},
+            {**entity("a"), "id": "legacy-a"},
+            stable_entity("b"),
+            stable_entity("c"),
+            relation("b", "a", "legacy-ab"),
+            relation("a", "c"),
+        ]}
+        graph = nx.Graph(partial=True)
+        graph.add_node("a", description="a", source_id=["d1"], pagerank=0.5)
+        graph.add_node("c", description="c", source_id=["d1"], pagerank=0.5)
+        graph.add_edge("a", "c", weight=1)
+        change = GraphChange(removed_nodes={"b"}, added_updated_nodes={"a"}, removed_edges={("a", "b")})
+        trio.run(set_graph, "t1", "kb1", None, graph, change, None)
+
+        assert store.ops[0] == ("insert", [graph_chunk_id("kb1", "graph"), graph_chunk_id("kb1", "entity", "a")])
+        assert all(op == "delete" for op, _ in store.ops[1:])
+        assert kinds(store) == sorted([
+            ("graph", graph_chunk_id("kb1", "graph")),
+            ("entity", graph_chunk_id("kb1", "entity", "a")),
+            ("entity", graph_chunk_id("kb1", "entity", "c")),
+            ("relation", graph_chunk_id("kb1", "relation", "a", "c")),
+        ])
+
+    @pytest.mark.p1
+    def test_rewrite_replaces_every_chunk(self, store):
+        store.rows = {r["id"]: r for r in [
+            {"id": "old-graph", "kb_id": "kb1", "knowledge_graph_kwd": "graph"},
+            {**entity("a"), "id": "legacy-a"},
+            {**entity("gone"), "id": "legacy-gone"},
+            relation("a", "gone", "legacy-rel"),
+        ]}
+        graph = nx.Graph(source_id=["d1"])
+        graph.add_node("a", description="a", source_id=["d1"], pagerank=1.)
+        change = GraphChange(added_updated_nodes={"a"})
+        trio.run(set_graph, "t1", "kb1", None, graph, change, None, None, True)
+
+        assert store.ops[0][0] == "insert"
+        assert kinds(store) == sorted([
+            ("graph", graph_chunk_id("kb1", "graph")),
+            ("subgraph", graph_chunk_id("kb1", "subgraph", "d1")),
+            ("entity", graph_chunk_id("kb1", "entity", "a")),
+        ])
+        snapshot = json.loads(store.rows[graph_chunk_id("kb1", "graph")]["content_with_weight"])
+        assert snapshot["graph"] == {"sharded": True, "node_count": 1}
+
+
+class TestDeleteGraphEdges:
+    @pytest.mark.p1
+    def test_edges_are_deleted_by_id_in_one_request(self, store):
+        store.rows = {r["id"]: r for r in [
+            relation("a", "b"),
+            relation("d", "c", "legacy-cd"),
+            relation("a", "e", "legacy-ae"),
+            relation("a", "d"),
+        ]}
+        change = GraphChange(removed_edges={("a", "b"), ("c", "d"), ("e", "a")})
+        trio.run(delete_graph_edges, "t1", "kb1", change)
+        # The edge between two of their entities that was not removed stays.
+        assert list(store.rows) == [graph_chunk_id("kb1", "relation", "a", "d")]
+        assert len(store.ops) == 1
+
+    @pytest.mark.p2
+    def test_kept_chunks_stay(self, store):
+        store.rows = {r["id"]: r for r in [relation("a", "b")]}
+        change = GraphChange(removed_edges={("a", "b")})
+        trio.run(delete_graph_edges, "t1", "kb1", change, {graph_chunk_id("kb1", "relation", "a", "b")})
+        assert len(store.rows) == 1 and store.ops == []
+
+    @pytest.mark.p2
+    def test_relations_of_removed_nodes_go_by_entity(self, store):
+        store.rows = {r["id"]: r for r in [relation("a", "b", "r1"), relation("c", "a", "r2"), relation("c", "d", "r3")]}
+        trio.run(delete_graph_edges, "t1", "kb1", GraphChange(removed_nodes={"a"}, removed_edges={("a", "b"), ("a", "c")}))
+        assert list(store.rows) == ["r3"]
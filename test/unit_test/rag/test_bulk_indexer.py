@@ -0,0 +1,167 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import json
+import threading
+import time
+
+import numpy as np
+import pytest
+from elastic_transport import ConnectionTimeout
+
+from rag.utils import bulk_indexer
+from rag.utils.bulk_indexer import bulk_index, bulk_line, split_by_bytes
+from rag.utils.es_conn import ESConnection
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(bulk_indexer.time, "sleep", lambda _: None)
+
+
+def parse(body: bytes):
+    lines = [json.loads(line) for line in body.splitlines()]
+    return list(zip(lines[::2], lines[1::2]))
+
+
+class FakeCluster:
+    """Answers bulk requests like Elasticsearch, rejecting the ids in `reject` with their status."""
+
+    def __init__(self, reject=None, fail_requests=0):
+        self.reject = dict(reject or {})
+        self.fail_requests = fail_requests
+        self.indexed = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def bulk(self, body):
+        with self.lock:
+            self.requests += 1
+            if self.fail_requests:
+                self.fail_requests -= 1
+                raise ConnectionError("connection reset")
+        items = []
+        for action, src in parse(body):
+            _id = action["index"]["_id"]
+            status = self.reject.get(_id)
+            if status:
+                # A transient rejection goes away on the next attempt.
+                if status == 429:
+                    self.reject.pop(_id)
+                items.append({"index": {"_id": _id, "status": status, "error": {"type": f"status {status}"}}})
+                continue
+            with self.lock:
+                self.indexed[_id] = src
+            items.append({"index": {"_id": _id, "status": 201}})
+        return {"errors": any("error" in next(iter(i.values())) for i in items), "items": items}
+
+
+def chunks(n):
+    return [{"id": f"c{i}", "content_with_weight": f"chunk {i}", "q_4_vec": np.arange(4, dtype=np.float32) + i} for i in range(n)]
+
+
+class TestBulkLines:
+    @pytest.mark.p1
+    def test_line_format(self):
+        d = {"id": "c1", "q_4_vec": np.ones(4, dtype=np.float32), "tags": {"a"}}
+        (action, src), = parse(bulk_line(d, "ragflow_t1", {"kb_id": "kb1"}))
+        assert action == {"index": {"_index": "ragflow_t1", "_id": "c1"}}
+        assert src == {"q_4_vec": [1., 1., 1., 1.], "tags": ["a"], "kb_id": "kb1"}
+        # The chunk itself is not modified.
+        assert d["id"] == "c1" and "kb_id" not in d
+
+    @pytest.mark.p2
+    def test_split_by_bytes(self):
+        lines = [b"x" * 10, b"x" * 10, b"x" * 25, b"x" * 5]
+        assert split_by_bytes(lines, [0, 1, 2, 3], max_bytes=20) == [[0, 1], [2], [3]]
+        assert split_by_bytes(lines, [3, 0], max_bytes=20) == [[3, 0]]
+
+
+@pytest.mark.usefixtures("no_backoff")
+class TestBulkIndex:
+    @pytest.mark.p1
+    def test_requests_are_cut_by_size(self):
+        cluster = FakeCluster()
+        docs = chunks(7)
+        for d in docs:
+            d["content_with_weight"] = "x" * (bulk_indexer.DOC_BULK_BYTES // 3)
+        assert bulk_index(cluster.bulk, docs, "idx", {"kb_id": "kb1"}) == []
+        assert sorted(cluster.indexed) == sorted(d["id"] for d in docs)
+        assert cluster.indexed["c0"]["kb_id"] == "kb1"
+        # Two chunks a request.
+        assert cluster.requests == 4
+
+    @pytest.mark.p1
+    def test_only_transient_rejections_are_retried(self):
+        cluster = FakeCluster(reject={"c1": 429, "c2": 400})
+        errors = bulk_index(cluster.bulk, chunks(4), "idx")
+        assert len(errors) == 1 and errors[0].startswith("c2:")
+        assert sorted(cluster.indexed) == ["c0", "c1", "c3"]
+        assert cluster.requests == 2
+
+    @pytest.mark.p2
+    def test_failed_request_is_sent_again(self):
+        cluster = FakeCluster(fail_requests=1)
+        assert bulk_index(cluster.bulk, chunks(3), "idx") == []
+        assert len(cluster.indexed) == 3
+
+    @pytest.mark.p2
+    def test_gives_up_after_the_attempts(self):
+        cluster = FakeCluster(fail_requests=bulk_indexer.DOC_BULK_ATTEMPTS)
+        errors = bulk_index(cluster.bulk, chunks(2), "idx")
+        assert [e.split(":")[0] for e in errors] == ["c0", "c1"]
+
+
+class StalledES:
+    def __init__(self):
+        self.started = threading.Barrier(4)
+
+    def bulk(self, **kwargs):
+        self.started.wait()
+        raise ConnectionTimeout("timed out")
+
+
+class TestESBulk:
+    @pytest.mark.p2
+    def test_concurrent_timeouts_reconnect_once(self):
+        # ESConnection is the @singleton factory, the class is held in its closure.
+        cls = next(c.cell_contents for c in ESConnection.__closure__ if isinstance(c.cell_contents, type))
+        conn = cls.__new__(cls)
+        conn.es = StalledES()
+        conn._reconnect_lock = threading.Lock()
+        connects = []
+
+        def connect():
+            time.sleep(0.05)
+            connects.append(1)
+            conn.es = StalledES()
+
+        conn._connect = connect
+
+        raised = []
+
+        def bulk():
+            try:
+                conn._bulk(b"")
+            except ConnectionTimeout as e:
+                raised.append(e)
+
+        threads = [threading.Thread(target=bulk) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(raised) == 4
+        assert len(connects) == 1
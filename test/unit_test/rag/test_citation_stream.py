@@ -0,0 +1,138 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from rag.nlp import rag_tokenizer
+from rag.nlp.query import FulltextQueryer
+from rag.nlp.search import Dealer
+
+VOCAB = ["apple", "orange", "banana", "train", "station", "ticket", "river", "bridge", "water", "price"]
+
+CHUNKS = [
+    "The apple and the orange are sold by price at the market.",
+    "The train leaves the station after you buy a ticket.",
+    "The bridge crosses the river where the water runs fast.",
+]
+
+ANSWER = ("Apples and oranges are sold by price. You need a ticket before the train leaves the station. "
+          "The bridge goes over the river water. That is all.")
+
+
+class BagOfWords:
+    """Embeds texts by their counts of VOCAB words."""
+
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, texts):
+        self.encoded.append(list(texts))
+        vs = []
+        for t in texts:
+            v = np.array([t.lower().count(w) for w in VOCAB], dtype=float) + 0.01
+            vs.append(v / np.linalg.norm(v))
+        return np.array(vs), 0
+
+
+@pytest.fixture(scope="module")
+def dealer():
+    d = Dealer.__new__(Dealer)
+    d.qryr = FulltextQueryer()
+    return d
+
+
+@pytest.fixture
+def pool():
+    p = ThreadPoolExecutor(max_workers=2)
+    yield p
+    p.shutdown(wait=True)
+
+
+def chunk_inputs():
+    embd = BagOfWords()
+    chunks = [rag_tokenizer.tokenize(c) for c in CHUNKS]
+    return chunks, [list(v) for v in embd.encode(CHUNKS)[0]]
+
+
+def stream(dealer, pool, embd, answer, settle=False):
+    """Feed `answer` 10 characters at a time; with `settle`, as slowly as the scoring goes."""
+    chunks, chunk_v = chunk_inputs()
+    citations = dealer.citation_stream(chunks, chunk_v, embd, pool, tkweight=0.3, vtweight=0.7)
+    for i in range(10, len(answer), 10):
+        if settle:
+            # Waits for the chunk tokens.
+            citations.chunks_tks
+            for f in citations.futures:
+                f.result()
+        citations.feed(answer[:i])
+    return citations
+
+
+class TestCitationStream:
+    @pytest.mark.p1
+    def test_finish_gives_the_citations_of_insert_citations(self, dealer, pool):
+        embd = BagOfWords()
+        res = stream(dealer, pool, embd, ANSWER).finish(ANSWER)
+        chunks, chunk_v = chunk_inputs()
+        expected = dealer.insert_citations(ANSWER, chunks, chunk_v, BagOfWords(), tkweight=0.3, vtweight=0.7)
+        assert res == expected
+        assert res[1]
+
+    @pytest.mark.p1
+    def test_sentences_are_scored_while_streamed(self, dealer, pool):
+        embd = BagOfWords()
+        citations = stream(dealer, pool, embd, ANSWER, settle=True)
+        for f in citations.futures:
+            f.result()
+        assert len([t for batch in embd.encoded for t in batch]) == 3
+        citations.finish(ANSWER)
+        # Only the last sentence is left to finish.
+        assert embd.encoded[-1] == ["That is all."]
+
+    @pytest.mark.p1
+    def test_feed_waits_for_the_chunk_tokens(self, dealer, pool, monkeypatch):
+        ready = threading.Event()
+        tokens = dealer.citation_tokens
+
+        def slow_tokens(chunks):
+            ready.wait()
+            return tokens(chunks)
+
+        monkeypatch.setattr(dealer, "citation_tokens", slow_tokens)
+        embd = BagOfWords()
+        citations = stream(dealer, pool, embd, ANSWER)
+        assert embd.encoded == [] and citations.futures == []
+        ready.set()
+        chunks, chunk_v = chunk_inputs()
+        assert citations.finish(ANSWER) == dealer.insert_citations(ANSWER, chunks, chunk_v, BagOfWords(), tkweight=0.3, vtweight=0.7)
+
+    @pytest.mark.p2
+    def test_answer_citing_by_itself_is_not_scored(self, dealer, pool):
+        embd = BagOfWords()
+        cited = "Apples are sold by price [ID:0]. Trains leave the station [ID:1]. Done here."
+        stream(dealer, pool, embd, cited)
+        assert embd.encoded == []
+
+    @pytest.mark.p2
+    def test_no_chunks(self, dealer, pool):
+        embd = BagOfWords()
+        citations = dealer.citation_stream([], [], embd, pool)
+        citations.feed(ANSWER)
+        assert citations.finish(ANSWER) == (ANSWER, set())
+        assert embd.encoded == []
@@ -0,0 +1,80 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import json
+import os
+
+import pytest
+
+from rag.nlp import compiled_dict
+from rag.nlp.compiled_dict import KIND_INT, KIND_JSON, CompiledDict, load_compiled, load_json_dict, write_compiled
+
+
+class TestCompiledDict:
+    @pytest.mark.p1
+    def test_int_values(self, tmp_path):
+        d = {f"term{i}": i * 7 - 100 for i in range(1000)} | {"检索": 3, "": 1}
+        write_compiled(d, tmp_path / "d.bin", KIND_INT)
+        c = CompiledDict(tmp_path / "d.bin")
+        assert len(c) == len(d)
+        assert all(c[k] == v for k, v in d.items())
+        assert dict(c) == d
+        assert "term1000" not in c
+        assert c.get("term1000", -1) == -1
+        assert c.get(3) is None
+        with pytest.raises(KeyError):
+            c["missing"]
+
+    @pytest.mark.p1
+    def test_json_values(self, tmp_path):
+        d = {"ragflow": ["rag flow", "检索增强"], "org": "组织", "n": {"a": 1}}
+        write_compiled(d, tmp_path / "d.bin", KIND_JSON)
+        c = CompiledDict(tmp_path / "d.bin")
+        assert {k: c[k] for k in d} == d
+        assert c.get("missing") is None
+
+    @pytest.mark.p2
+    def test_empty(self, tmp_path):
+        write_compiled({}, tmp_path / "d.bin", KIND_INT)
+        c = CompiledDict(tmp_path / "d.bin")
+        assert len(c) == 0
+        assert "a" not in c
+
+
+class TestLoadCompiled:
+    @pytest.mark.p1
+    def test_rebuilt_when_the_source_changes(self, tmp_path):
+        src = tmp_path / "synonym.json"
+        src.write_text(json.dumps({"a": ["b"]}))
+        assert isinstance(load_compiled(str(src), load_json_dict, KIND_JSON), CompiledDict)
+        src.write_text(json.dumps({"a": ["b"], "c": ["d"]}))
+        os.utime(src, ns=(0, 0))
+        assert load_compiled(str(src), load_json_dict, KIND_JSON)["c"] == ["d"]
+
+    @pytest.mark.p2
+    def test_rebuilt_from_another_version(self, tmp_path, monkeypatch):
+        src = tmp_path / "ner.json"
+        src.write_text(json.dumps({"a": "org"}))
+        monkeypatch.setattr(compiled_dict, "VERSION", compiled_dict.VERSION - 1)
+        load_compiled(str(src), load_json_dict, KIND_JSON)
+        monkeypatch.undo()
+        assert load_compiled(str(src), load_json_dict, KIND_JSON)["a"] == "org"
+
+    @pytest.mark.p2
+    def test_parsed_dict_when_it_can_not_be_written(self, tmp_path):
+        src = tmp_path / "ner.json"
+        src.write_text(json.dumps({"a": "org"}))
+        d = load_compiled(str(src), load_json_dict, KIND_JSON, compiled=str(tmp_path / "missing" / "ner.json.bin"))
+        assert d == {"a": "org"}
@@ -0,0 +1,100 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import numpy as np
+import pytest
+
+from rag.utils import embedding_cache
+from rag.utils.embedding_cache import EMBED_CACHE, cache_model_name, decode_vector, encode_vector
+
+
+class FakeRedisBytes:
+    def __init__(self):
+        self.data = {}
+
+    def mget_bytes(self, keys):
+        return [self.data.get(k) for k in keys]
+
+    def mset_bytes(self, mapping, exp=3600):
+        self.data.update(mapping)
+        return True
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    redis = FakeRedisBytes()
+    monkeypatch.setattr(embedding_cache, "REDIS_CONN", redis)
+    # A fresh instance rather than the process-wide singleton.
+    c = type(EMBED_CACHE)()
+    c.redis = redis
+    return c
+
+
+class TestVectorEncoding:
+    @pytest.mark.p1
+    @pytest.mark.parametrize("dtype, size, atol", [("float32", 1 + 4 * 64, 0), ("float16", 1 + 2 * 64, 1e-3), ("int8", 1 + 4 + 64, 1e-2)])
+    def test_round_trip(self, dtype, size, atol):
+        v = np.random.default_rng(0).uniform(-1, 1, 64).astype(np.float32)
+        b = encode_vector(v, dtype)
+        assert len(b) == size
+        d = decode_vector(b)
+        assert d.dtype == np.float32
+        assert np.allclose(d, v, atol=atol)
+
+    @pytest.mark.p2
+    def test_int8_zero_vector(self):
+        assert np.array_equal(decode_vector(encode_vector(np.zeros(8), "int8")), np.zeros(8, dtype=np.float32))
+
+    @pytest.mark.p2
+    def test_decoded_float32_is_writable(self):
+        d = decode_vector(encode_vector(np.ones(4), "float32"))
+        d[0] = 2.
+        assert d[0] == 2.
+
+
+class TestCacheModelName:
+    @pytest.mark.p1
+    def test_endpoint_provider_and_tenant_are_part_of_the_name(self):
+        config = {"llm_factory": "Ollama", "llm_name": "bge-m3", "api_base": "http://a:11434"}
+        name = cache_model_name("t1", config)
+        assert name != cache_model_name("t1", {**config, "api_base": "http://b:11434"})
+        assert name != cache_model_name("t1", {**config, "llm_factory": "OpenAI-API-Compatible"})
+        assert name != cache_model_name("t2", config)
+        assert name == cache_model_name("t1", dict(config))
+
+
+class TestEmbeddingCache:
+    @pytest.mark.p1
+    def test_get_many_returns_none_for_misses(self, cache):
+        cache.set_many("m", ["a", "b"], [np.ones(4), np.zeros(4)])
+        res = cache.get_many("m", ["a", "x", "b"])
+        assert np.array_equal(res[0], np.ones(4))
+        assert res[1] is None
+        assert np.array_equal(res[2], np.zeros(4))
+
+    @pytest.mark.p1
+    def test_models_do_not_share_vectors(self, cache):
+        cache.set("m1", "a", np.ones(4))
+        assert cache.get("m2", "a") is None
+
+    @pytest.mark.p1
+    def test_redis_serves_what_l1_evicted(self, cache):
+        cache._l1_capacity = 3 * 4 * 4
+        for i in range(5):
+            cache.set("m", str(i), np.full(4, i))
+        assert len(cache._l1) == 3
+        assert len(cache.redis.data) == 5
+        assert np.array_equal(cache.get("m", "0"), np.zeros(4))
+        assert cache._l1_bytes <= cache._l1_capacity
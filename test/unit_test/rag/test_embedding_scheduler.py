@@ -0,0 +1,182 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import numpy as np
+import pytest
+import trio
+from trio.testing import MockClock
+
+from rag.settings import EMBEDDING_BATCH_SIZE
+from rag.svr.embedding_scheduler import EmbeddingScheduler
+
+
+class FakeEmbedding:
+    """An embedding model without `cache_name`, so that every text reaches it."""
+
+    _BATCH_SIZE = 4
+
+    def __init__(self, llm_name="fake", fail_first=0):
+        self.tenant_id = "tenant"
+        self.llm_name = llm_name
+        self.fail_first = fail_first
+        self.calls = []
+
+    def encode(self, texts):
+        self.calls.append(list(texts))
+        if self.fail_first:
+            self.fail_first -= 1
+            raise Exception("Error code: 429 - rate limit exceeded")
+        return np.array([[float(t), 1.] for t in texts]), 10 * len(texts)
+
+
+def texts(start, n):
+    return [str(i) for i in range(start, start + n)]
+
+
+class TestEmbeddingScheduler:
+    @pytest.mark.p1
+    def test_concurrent_requests_are_merged(self):
+        mdl = FakeEmbedding()
+        scheduler = EmbeddingScheduler(trio.CapacityLimiter(1), linger=0.05)
+        results = {}
+
+        async def encode(name, txts):
+            results[name] = await scheduler.encode(mdl, txts)
+
+        async def main():
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(encode, "a", texts(0, 2))
+                nursery.start_soon(encode, "b", texts(2, 1))
+
+        trio.run(main)
+        assert len(mdl.calls) == 1
+        assert sorted(mdl.calls[0]) == texts(0, 3)
+        vts, tk = results["a"]
+        assert vts[:, 0].tolist() == [0., 1.]
+        assert tk == 20
+        vts, tk = results["b"]
+        assert vts[:, 0].tolist() == [2.]
+        assert tk == 10
+
+    @pytest.mark.p1
+    def test_batch_grows_past_start_size(self):
+        mdl = FakeEmbedding()
+        scheduler = EmbeddingScheduler(trio.CapacityLimiter(1), linger=0)
+        vts, _ = trio.run(scheduler.encode, mdl, texts(0, 400))
+        assert vts[:, 0].tolist() == [float(i) for i in range(400)]
+        sizes = [len(c) for c in mdl.calls]
+        assert sizes[0] == EMBEDDING_BATCH_SIZE
+        assert max(sizes) > EMBEDDING_BATCH_SIZE
+        assert sizes == sorted(sizes[:-1]) + sizes[-1:]
+
+    @pytest.mark.p1
+    def test_backoff_does_not_hold_the_limiter(self):
+        throttled = FakeEmbedding("throttled", fail_first=1)
+        other = FakeEmbedding("other")
+        scheduler = EmbeddingScheduler(trio.CapacityLimiter(1), linger=0.01)
+        done = {}
+
+        async def encode(mdl):
+            await scheduler.encode(mdl, texts(0, 2))
+            done[mdl.llm_name] = trio.current_time()
+
+        async def main():
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(encode, throttled)
+                await trio.sleep(0.001)
+                nursery.start_soon(encode, other)
+
+        trio.run(main, clock=MockClock(autojump_threshold=0))
+        assert len(throttled.calls) == 2
+        assert scheduler.stats["retries"] == 1
+        # The other model is served while the throttled one backs off.
+        assert done["other"] < 1
+        assert done["throttled"] >= 2
+
+    @pytest.mark.p2
+    def test_non_retryable_error_fails_the_request(self):
+        class Broken(FakeEmbedding):
+            def encode(self, texts):
+                raise ValueError("invalid api key")
+
+        scheduler = EmbeddingScheduler(trio.CapacityLimiter(1), linger=0)
+        with pytest.raises(ValueError):
+            trio.run(scheduler.encode, Broken(), texts(0, 3))
+
+    @pytest.mark.p1
+    def test_cancelled_caller_gives_back_the_merged_batch(self, monkeypatch):
+        mdl = FakeEmbedding()
+        scheduler = EmbeddingScheduler(trio.CapacityLimiter(1), linger=0.05)
+        scopes, results = {}, {}
+        run_sync = trio.to_thread.run_sync
+
+        async def cancel_first_runner(fn, *args, **kwargs):
+            # The caller that took the merged batch is cancelled right before sending it.
+            if not mdl.calls and not results:
+                results["cancelled"] = trio.lowlevel.current_task()
+                scopes[results["cancelled"]].cancel()
+            return await run_sync(fn, *args, **kwargs)
+
+        monkeypatch.setattr(trio.to_thread, "run_sync", cancel_first_runner)
+
+        async def encode(name, txts):
+            with trio.CancelScope() as scope:
+                scopes[trio.lowlevel.current_task()] = scope
+                results[name] = await scheduler.encode(mdl, txts)
+
+        async def main():
+            with trio.fail_after(30):
+                async with trio.open_nursery() as nursery:
+                    nursery.start_soon(encode, "a", texts(0, 2))
+                    nursery.start_soon(encode, "b", texts(2, 1))
+
+        trio.run(main, clock=MockClock(autojump_threshold=0))
+        assert len(mdl.calls) == 1
+        served = [n for n in ("a", "b") if n in results]
+        assert len(served) == 1
+        vts, _ = results[served[0]]
+        assert vts[:, 0].tolist() == ([0., 1.] if served[0] == "a" else [2.])
+        assert sorted(mdl.calls[0]) == (texts(0, 2) if served[0] == "a" else texts(2, 1))
+
+    @pytest.mark.p2
+    def test_non_retryable_error_retries_merged_requests_alone(self):
+        class RejectsOne(FakeEmbedding):
+            def encode(self, texts):
+                self.calls.append(list(texts))
+                if "bad" in texts:
+                    raise ValueError("input is too long")
+                return np.array([[float(t), 1.] for t in texts]), 10 * len(texts)
+
+        mdl = RejectsOne()
+        scheduler = EmbeddingScheduler(trio.CapacityLimiter(1), linger=0.05)
+        results = {}
+
+        async def encode(name, txts):
+            try:
+                results[name] = await scheduler.encode(mdl, txts)
+            except ValueError as e:
+                results[name] = e
+
+        async def main():
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(encode, "good", texts(0, 2))
+                nursery.start_soon(encode, "bad", ["bad"])
+
+        trio.run(main)
+        assert sorted(len(c) for c in mdl.calls) == [1, 2, 3]
+        assert isinstance(results["bad"], ValueError)
+        vts, tk = results["good"]
+        assert vts[:, 0].tolist() == [0., 1.]
+        assert tk == 20
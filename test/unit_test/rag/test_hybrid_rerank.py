@@ -0,0 +1,88 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+from collections import defaultdict
+
+import numpy as np
+import pytest
+from sklearn.metrics.pairwise import cosine_similarity
+
+from rag.nlp.query import FulltextQueryer
+from rag.nlp.search import Dealer
+from rag.settings import PAGERANK_FLD, TAG_FLD
+
+
+@pytest.fixture(scope="module")
+def queryer():
+    return FulltextQueryer()
+
+
+def weighted(queryer, tks):
+    d = defaultdict(int)
+    for t, c in queryer.tw.weights(tks, preprocess=False):
+        d[t] += c
+    return d
+
+
+class TestVectorSimilarity:
+    @pytest.mark.p1
+    def test_matches_cosine_similarity(self):
+        rng = np.random.default_rng(0)
+        avec, bvecs = rng.normal(size=8), rng.normal(size=(5, 8))
+        assert np.allclose(FulltextQueryer.vector_similarity(avec, bvecs), cosine_similarity([avec], bvecs)[0], atol=1e-6)
+
+    @pytest.mark.p1
+    def test_zero_vector_scores_zero(self):
+        sims = FulltextQueryer.vector_similarity([1., 0.], [[0., 0.], [1., 0.]])
+        assert sims.tolist() == pytest.approx([0., 1.])
+        assert isinstance(sims[0], float)
+
+
+class TestTokenSimilarity:
+    @pytest.mark.p1
+    def test_matches_pairwise_similarity(self, queryer):
+        atks = "ragflow open source retrieval engine".split()
+        btkss = ["ragflow is an engine", "retrieval retrieval source", "nothing relevant", ""]
+        expected = [queryer.similarity(weighted(queryer, atks), weighted(queryer, b.split())) for b in btkss]
+        assert np.allclose(queryer.token_similarity(atks, btkss), expected)
+
+    @pytest.mark.p2
+    def test_hybrid_weights(self, queryer):
+        sim, tksim, vtsim = queryer.hybrid_similarity([1., 0.], [[1., 0.], [0., 1.]], ["ragflow"], [["ragflow"], ["other"]], 0.3, 0.7)
+        assert np.allclose(sim, 0.7 * vtsim + 0.3 * tksim)
+
+
+@pytest.fixture
+def dealer():
+    # Rank feature scores need no document store.
+    return Dealer.__new__(Dealer)
+
+
+class TestRankFeatureScores:
+    @pytest.mark.p1
+    def test_tags_and_pagerank(self, dealer):
+        sres = Dealer.SearchResult(total=3, ids=["a", "b", "c"], field={
+            "a": {TAG_FLD: {"finance": 3, "law": 4}, PAGERANK_FLD: 1},
+            "b": {TAG_FLD: "{'finance': 1}"},
+            "c": {},
+        })
+        scores = dealer._rank_feature_scores({"finance": 2, PAGERANK_FLD: 10}, sres)
+        # finance·2 over |tags of the chunk| and |query tags|, times 10, plus the pagerank.
+        assert scores.tolist() == pytest.approx([3 * 2 / 5 / 2 * 10 + 1, 1 * 2 / 1 / 2 * 10, 0.])
+
+    @pytest.mark.p2
+    def test_only_pagerank_in_query(self, dealer):
+        sres = Dealer.SearchResult(total=1, ids=["a"], field={"a": {TAG_FLD: {"finance": 3}, PAGERANK_FLD: 2}})
+        assert dealer._rank_feature_scores({PAGERANK_FLD: 10}, sres).tolist() == [2.]
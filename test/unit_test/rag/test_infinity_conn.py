@@ -0,0 +1,127 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import copy
+
+import pytest
+
+from rag.utils import infinity_conn
+from rag.utils.infinity_conn import InfinityConnection, to_rows
+
+
+class TestToRows:
+    @pytest.mark.p1
+    def test_columns_are_converted(self):
+        docs = [{
+            "id": "c1",
+            "important_kwd": ["a", "b"],
+            "docnm_kwd": "doc.pdf",
+            "tag_feas": {"t": 1},
+            "kb_id": ["kb1"],
+            "position_int": [[1, 2, 3, 4, 5], [6, 7, 8, 9, 10]],
+            "page_num_int": [1, 2],
+            "top_int": [255],
+            "content_with_weight": "text",
+        }]
+        row, = to_rows(docs, [])
+        assert row == {
+            "id": "c1",
+            "important_kwd": "a###b",
+            "docnm_kwd": "doc.pdf",
+            "tag_feas": '{"t": 1}',
+            "kb_id": "kb1",
+            "position_int": "_".join(f"{n:08x}" for n in range(1, 11)),
+            "page_num_int": "00000001_00000002",
+            "top_int": "000000ff",
+            "content_with_weight": "text",
+        }
+
+    @pytest.mark.p1
+    def test_missing_embeddings_are_zero_filled(self):
+        docs = [{"id": "c1", "q_3_vec": [1., 2., 3.]}, {"id": "c2", "important_kwd": "x"}]
+        rows = to_rows(docs, [("q_3_vec", 3)])
+        assert rows == [
+            {"id": "c1", "q_3_vec": [1., 2., 3.]},
+            {"id": "c2", "important_kwd": "x", "q_3_vec": [0, 0, 0]},
+        ]
+
+    @pytest.mark.p2
+    def test_documents_are_left_untouched(self):
+        docs = [{"id": "c1", "important_kwd": ["a"], "kb_id": ["kb1"], "page_num_int": [1]}]
+        before = copy.deepcopy(docs)
+        to_rows(docs, [("q_3_vec", 3)])
+        assert docs == before
+
+
+class FakeTable:
+    def __init__(self, ids):
+        self.ids = set(ids)
+        self.filters = []
+
+    def delete(self, cond):
+        self.filters.append(cond)
+        ids = {i.strip().strip("'").replace("''", "'") for i in cond[len("id IN ("):-1].split(", ")}
+        deleted = self.ids & ids
+        self.ids -= deleted
+        return type("DeleteResult", (), {"deleted_rows": len(deleted)})
+
+
+class FakePool:
+    def __init__(self, table):
+        self.table = table
+        self.released = []
+
+    def get_conn(self):
+        pool = self
+
+        class Conn:
+            def get_database(self, name):
+                return self
+
+            def get_table(self, name):
+                return pool.table
+
+        return Conn()
+
+    def release_conn(self, conn):
+        self.released.append(conn)
+
+
+@pytest.fixture
+def conn():
+    # InfinityConnection is the @singleton factory, the class is held in its closure.
+    cls = next(c.cell_contents for c in InfinityConnection.__closure__ if isinstance(c.cell_contents, type))
+    conn = cls.__new__(cls)
+    conn.dbName = "default_db"
+    return conn
+
+
+class TestDeleteIds:
+    @pytest.mark.p1
+    def test_one_filter_per_batch(self, conn, monkeypatch):
+        monkeypatch.setattr(infinity_conn, "INFINITY_DELETE_BATCH", 2)
+        table = FakeTable(["a", "b", "c", "d"])
+        conn.connPool = FakePool(table)
+        assert conn.delete_ids(["a", "b", "c", "x", "y"], "t") == 3
+        assert table.filters == ["id IN ('a', 'b')", "id IN ('c', 'x')", "id IN ('y')"]
+        assert table.ids == {"d"}
+        assert len(conn.connPool.released) == 1
+
+    @pytest.mark.p2
+    def test_quotes_are_escaped(self, conn):
+        table = FakeTable(["it's"])
+        conn.connPool = FakePool(table)
+        assert conn.delete_ids(["it's"], "t") == 1
+        assert table.filters == ["id IN ('it''s')"]
@@ -0,0 +1,98 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import threading
+import time
+
+import pytest
+
+from rag.nlp.rag_tokenizer import RagTokenizer
+
+DICTIONARY = """\
+南京 5000 ns
+南京市 3000 ns
+市长 4000 n
+长江 6000 ns
+大桥 5000 n
+长江大桥 2000 ns
+"""
+
+
+@pytest.fixture
+def tokenizer(tmp_path):
+    (tmp_path / "huqie.txt").write_text(DICTIONARY, encoding="utf-8")
+    tknzr = RagTokenizer()
+    tknzr.DIR_ = str(tmp_path / "huqie")
+    return tknzr
+
+
+def strQ2B(ustring):
+    """The character by character conversion the translation table replaced."""
+    rstring = ""
+    for uchar in ustring:
+        inside_code = ord(uchar)
+        if inside_code == 0x3000:
+            inside_code = 0x0020
+        else:
+            inside_code -= 0xfee0
+        if inside_code < 0x0020 or inside_code > 0x7e:
+            rstring += uchar
+        else:
+            rstring += chr(inside_code)
+    return rstring
+
+
+class TestRagTokenizer:
+    @pytest.mark.p1
+    def test_trie_is_loaded_once_across_threads(self, tokenizer, monkeypatch):
+        loads = []
+        load_trie = tokenizer._load_trie
+
+        def slow_load():
+            loads.append(1)
+            time.sleep(0.05)
+            return load_trie()
+
+        monkeypatch.setattr(tokenizer, "_load_trie", slow_load)
+        tries = []
+        threads = [threading.Thread(target=lambda: tries.append(tokenizer.trie_)) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(loads) == 1
+        assert all(t is tries[0] for t in tries)
+
+    @pytest.mark.p1
+    def test_tokenize(self, tokenizer):
+        assert tokenizer.tokenize("南京市长江大桥") == "南京市 长江大桥"
+        assert tokenizer.tag("大桥") == "n"
+
+    @pytest.mark.p1
+    def test_tokenize_many_matches_tokenize(self, tokenizer):
+        lines = ["南京市长江大桥", "长江", "南京市长江大桥", "大桥南京"]
+        assert tokenizer.tokenize_many(lines) == [tokenizer.tokenize(line) for line in lines]
+
+    @pytest.mark.p2
+    def test_full_width_to_half_width(self, tokenizer):
+        text = "ＲＡＧ　Ｆｌｏｗ，１２３！南京　～｟"
+        assert tokenizer._strQ2B(text) == strQ2B(text)
+
+    @pytest.mark.p2
+    def test_user_dictionary_clears_the_cache(self, tokenizer, tmp_path):
+        assert tokenizer.tokenize("南京市长江大桥") == "南京市 长江大桥"
+        (tmp_path / "user.txt").write_text("南京市长江大桥 100000 ns\n", encoding="utf-8")
+        tokenizer.addUserDict(str(tmp_path / "user.txt"))
+        assert tokenizer.tokenize("南京市长江大桥") == "南京市长江大桥"
@@ -0,0 +1,182 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import numpy as np
+import pytest
+import trio
+from trio.testing import MockClock
+
+from rag import raptor
+from rag.raptor import AdaptiveConcurrency, RecursiveAbstractiveProcessing4TreeOrganizedRetrieval as Raptor, checkpoint_key
+from rag.settings import EMBEDDING_BATCH_SIZE
+
+
+class FakeCache:
+    def __init__(self, cached=()):
+        self.data = {t: np.array([-1., 1.]) for t in cached}
+
+    def get_many(self, llmnm, txts):
+        return [self.data.get(t) for t in txts]
+
+    def set_many(self, llmnm, txts, vectors):
+        self.data.update(zip(txts, vectors))
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+
+    def get(self, k):
+        return self.data.get(k)
+
+    def set(self, k, v, exp=3600):
+        self.data[k] = v
+        return True
+
+
+class FakeEmbedding:
+    llm_name = "fake-embedding"
+    cache_name = "fake"
+
+    def __init__(self):
+        self.calls = []
+
+    def encode(self, texts):
+        self.calls.append(list(texts))
+        return np.array([[float(len(t)), 1.] for t in texts]), len(texts)
+
+
+class FakeChat:
+    llm_name = "fake-chat"
+    max_length = 8192
+
+    def __init__(self, broken=False):
+        self.broken = broken
+        self.calls = 0
+
+    def chat(self, system, history, gen_conf):
+        if self.broken:
+            raise AssertionError("no summary should be asked for")
+        self.calls += 1
+        return f"summary {self.calls}"
+
+
+@pytest.fixture
+def stores(monkeypatch):
+    cache, redis = FakeCache(), FakeRedis()
+    monkeypatch.setattr(raptor, "EMBED_CACHE", cache)
+    monkeypatch.setattr(raptor, "REDIS_CONN", redis)
+    monkeypatch.setattr(raptor, "get_llm_cache", lambda *args: None)
+    monkeypatch.setattr(raptor, "set_llm_cache", lambda *args: None)
+    return cache, redis
+
+
+def new_raptor(chat=None, embd=None):
+    return Raptor(64, chat or FakeChat(), embd or FakeEmbedding(), "{cluster_content}")
+
+
+class TestAdaptiveConcurrency:
+    @pytest.mark.p1
+    def test_halves_on_rate_limiting(self):
+        c = AdaptiveConcurrency(initial=8, maximum=16)
+        assert c.failed(Exception("Error code: 429 - rate limit exceeded"))
+        assert c.limiter.total_tokens == 4
+        assert c.failed(TimeoutError())
+        assert c.limiter.total_tokens == 2
+        assert not c.failed(ValueError("invalid api key"))
+        assert c.limiter.total_tokens == 2
+
+    @pytest.mark.p1
+    def test_shrinks_on_slow_calls_and_grows_on_fast_ones(self):
+        c = AdaptiveConcurrency(initial=4, maximum=5, target_latency=10.)
+        c.succeeded(11.)
+        assert c.limiter.total_tokens == 3
+        for _ in range(3):
+            c.succeeded(1.)
+        assert c.limiter.total_tokens == 4
+        for _ in range(20):
+            c.succeeded(1.)
+        assert c.limiter.total_tokens == 5
+
+    @pytest.mark.p2
+    def test_run_retries_overload_errors_only(self):
+        c = AdaptiveConcurrency(initial=4, maximum=4)
+        attempts = []
+
+        async def throttled():
+            attempts.append(trio.current_time())
+            if len(attempts) < 3:
+                raise Exception("429 too many requests")
+            return "ok"
+
+        assert trio.run(c.run, throttled, clock=MockClock(autojump_threshold=0)) == "ok"
+        # Backs off 1s then 2s, down to one call at once, then grows again on the success.
+        assert attempts == [0., 1., 3.]
+        assert c.limiter.total_tokens == 2
+
+        async def broken():
+            raise ValueError("invalid api key")
+
+        with pytest.raises(ValueError):
+            trio.run(c.run, broken)
+
+
+class TestEmbeddingEncodeBatch:
+    @pytest.mark.p1
+    def test_only_missed_texts_are_encoded_in_batches(self, stores):
+        cache, _ = stores
+        txts = [f"text {i}" for i in range(EMBEDDING_BATCH_SIZE + 3)]
+        cache.data = {t: np.array([-1., 1.]) for t in txts[::2]}
+        embd = FakeEmbedding()
+        embds = trio.run(new_raptor(embd=embd)._embedding_encode_batch, txts)
+        missed = txts[1::2]
+        assert [t for c in embd.calls for t in c] == missed
+        assert all(len(c) <= EMBEDDING_BATCH_SIZE for c in embd.calls)
+        assert [v[0] for v in embds] == [-1. if i % 2 == 0 else float(len(t)) for i, t in enumerate(txts)]
+        # The new vectors are cached for the next run.
+        assert all(t in cache.data for t in txts)
+
+
+class TestCheckpoint:
+    @pytest.mark.p1
+    def test_rerun_resumes_after_the_saved_layer(self, stores):
+        chunks = [("first chunk", np.array([1., 0.])), ("second chunk", np.array([0., 1.]))]
+        chat = FakeChat()
+        res = trio.run(lambda: new_raptor(chat)(list(chunks), 0, None, "ckpt"))
+        assert chat.calls == 1 and res[2][0] == "summary 1"
+
+        messages = []
+        again = trio.run(lambda: new_raptor(FakeChat(broken=True))(list(chunks), 0, lambda msg: messages.append(msg), "ckpt"))
+        assert [c for c, _ in again] == [c for c, _ in res]
+        assert again[2][1].tolist() == res[2][1].tolist()
+        assert messages == ["Resume from layer 1 (1 summaries)"]
+
+    @pytest.mark.p2
+    def test_checkpoint_of_other_chunks_is_ignored(self, stores):
+        chunks = [("first chunk", np.array([1., 0.])), ("second chunk", np.array([0., 1.]))]
+        Raptor._save_checkpoint("ckpt", chunks + [("summary", np.array([1., 1.]))], 3, [(0, 3), (3, 4)], [0, 0, 0])
+        assert Raptor._load_checkpoint("ckpt", 2) is None
+        assert Raptor._load_checkpoint(None, 3) is None
+        assert Raptor._load_checkpoint("ckpt", 3)["layers"] == [[0, 3], [3, 4]]
+
+    @pytest.mark.p1
+    def test_key_changes_with_the_chunks(self):
+        conf = {"max_token": 256, "threshold": 0.1}
+        chunks = [("first chunk", np.array([1., 0.])), ("second chunk", np.array([0., 1.]))]
+        reparsed = [("first chunk", np.array([1., 0.])), ("other chunk", np.array([0., 1.]))]
+        key = checkpoint_key("doc", conf, FakeChat(), FakeEmbedding(), chunks)
+        assert key == checkpoint_key("doc", dict(conf), FakeChat(), FakeEmbedding(), list(chunks))
+        assert key != checkpoint_key("doc", conf, FakeChat(), FakeEmbedding(), reparsed)
+        assert key != checkpoint_key("doc", {**conf, "threshold": 0.2}, FakeChat(), FakeEmbedding(), chunks)
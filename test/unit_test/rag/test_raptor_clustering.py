@@ -0,0 +1,76 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import numpy as np
+import pytest
+
+from rag.raptor_clustering import _compact, cluster_counts, hdbscan_labels, kmeans_labels, reduce_dimensions
+
+
+def blobs(n_centers, per_center, dim=64, scale=0.05, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_centers, dim))
+    truth = np.repeat(np.arange(n_centers), per_center)
+    return centers[truth] + rng.normal(scale=scale, size=(len(truth), dim)), truth
+
+
+def same_partition(labels, truth):
+    return len(set(zip(labels, truth))) == len(set(truth)) == len(set(labels))
+
+
+class TestHelpers:
+    @pytest.mark.p2
+    def test_compact(self):
+        assert _compact([7, 3, 7, 9, 3]) == [0, 1, 0, 2, 1]
+
+    @pytest.mark.p2
+    def test_cluster_counts(self):
+        assert cluster_counts(2, 64) == []
+        assert cluster_counts(3, 64) == [2]
+        ks = cluster_counts(1000, 64, candidates=8)
+        assert ks[0] == 2 and ks[-1] == 64 and len(ks) <= 8
+
+    @pytest.mark.p2
+    def test_reduce_dimensions(self):
+        X, _ = blobs(3, 20, dim=128)
+        assert reduce_dimensions(X, 16).shape == (60, 16)
+        assert reduce_dimensions(X[:2]).shape == (2, 128)
+
+
+class TestBackends:
+    @pytest.mark.p1
+    def test_kmeans_finds_the_blobs(self):
+        # 3 is among the cluster counts tried for 90 chunks.
+        X, truth = blobs(3, 30)
+        labels = kmeans_labels(reduce_dimensions(X), 64, 0)
+        assert sorted(set(labels)) == [0, 1, 2]
+        assert same_partition(labels, truth)
+
+    @pytest.mark.p1
+    def test_hdbscan_finds_the_blobs(self):
+        X, truth = blobs(4, 30)
+        labels = hdbscan_labels(reduce_dimensions(X), 64)
+        assert same_partition(labels, truth)
+
+    @pytest.mark.p2
+    def test_hdbscan_respects_max_cluster(self):
+        X, _ = blobs(6, 10)
+        labels = hdbscan_labels(reduce_dimensions(X), 3)
+        assert sorted(set(labels)) == [0, 1, 2]
+
+    @pytest.mark.p2
+    def test_too_few_chunks_make_one_cluster(self):
+        X, _ = blobs(1, 2)
+        assert kmeans_labels(X, 64, 0) == [0, 0]
@@ -0,0 +1,261 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import json
+
+import pytest
+import trio
+
+from rag.utils.redis_conn import REDIS_CONN, CancelFlags, RedisStreamConsumer
+
+
+class FakeStreams:
+    """The XREADGROUP/XACK/XAUTOCLAIM/XCLAIM semantics the consumer relies on, for one group."""
+
+    def __init__(self):
+        self.streams = {}
+        self.delivered = {}
+        self.acked = []
+        self.reads = []
+        # (stream, message id) -> [consumer, delivery time in ms], the pending entries list.
+        self.pending = {}
+        self.now = 0
+
+    def add(self, queue_name, n):
+        msgs = self.streams.setdefault(queue_name, [])
+        for _ in range(n):
+            msgs.append((f"{len(msgs)}-0", {"message": json.dumps({"queue": queue_name, "i": len(msgs)})}))
+
+    def xreadgroup(self, group, consumer, streams, count=None, block=None):
+        self.reads.append((list(streams), count, block))
+        res = []
+        for q in streams:
+            start = self.delivered.get(q, 0)
+            msgs = self.streams.get(q, [])[start:start + count]
+            self.delivered[q] = start + len(msgs)
+            for msg_id, _ in msgs:
+                self.pending[(q, msg_id)] = [consumer, self.now]
+            if msgs:
+                res.append((q, msgs))
+        return res
+
+    def xautoclaim(self, q, group, consumer, min_idle_time, start_id="0-0", count=100):
+        claimed = []
+        for msg_id, payload in self.streams.get(q, []):
+            entry = self.pending.get((q, msg_id))
+            if entry and self.now - entry[1] >= min_idle_time:
+                self.pending[(q, msg_id)] = [consumer, self.now]
+                claimed.append((msg_id, payload))
+        return ["0-0", claimed]
+
+    def xpending_range(self, q, group, min, max, count, consumername=None):
+        return [{"message_id": msg_id, "consumer": c, "time_since_delivered": self.now - t, "times_delivered": 1}
+                for (stream, msg_id), (c, t) in self.pending.items() if stream == q and c == consumername][:count]
+
+    def xclaim(self, q, group, consumer, min_idle_time, message_ids, justid=False):
+        claimed = [msg_id for msg_id in message_ids if (q, msg_id) in self.pending]
+        for msg_id in claimed:
+            self.pending[(q, msg_id)] = [consumer, self.now]
+        return claimed
+
+    def xack(self, q, group, msg_id):
+        self.acked.append((q, msg_id))
+        self.pending.pop((q, msg_id), None)
+
+
+class FakeConn:
+    def __init__(self):
+        self.REDIS = FakeStreams()
+        self._groups = set()
+
+    def ensure_group(self, queue_name, group_name):
+        self._groups.add((queue_name, group_name))
+
+    def __open__(self):
+        pass
+
+
+def consumer(conn, name="consumer", reclaim_interval=3600):
+    return RedisStreamConsumer(conn, ["high", "low"], "group", name, reclaim_idle_ms=60000, reclaim_interval=reclaim_interval)
+
+
+class TestRedisStreamConsumer:
+    @pytest.mark.p1
+    def test_takes_no_more_than_the_free_slots(self):
+        conn = FakeConn()
+        conn.REDIS.add("high", 1)
+        conn.REDIS.add("low", 5)
+        c = consumer(conn)
+        msg = trio.run(c.get, 3)
+        assert msg.get_message() == {"queue": "high", "i": 0}
+        assert c.buffered() == 2
+        assert sum(conn.REDIS.delivered.values()) == 3
+
+    @pytest.mark.p1
+    def test_priority_order(self):
+        conn = FakeConn()
+        conn.REDIS.add("low", 2)
+        conn.REDIS.add("high", 2)
+        c = consumer(conn)
+
+        async def drain():
+            return [(await c.get(4)).get_message()["queue"] for _ in range(4)]
+
+        assert trio.run(drain) == ["high", "high", "low", "low"]
+        # Both streams were read without blocking.
+        assert all(block is None for _, _, block in conn.REDIS.reads)
+
+    @pytest.mark.p2
+    def test_blocks_on_all_streams_when_empty(self):
+        conn = FakeConn()
+        c = consumer(conn)
+        assert trio.run(c.get, 4) is None
+        assert conn.REDIS.reads[-1] == (["high", "low"], 1, c.block_ms)
+
+    @pytest.mark.p2
+    def test_empty_message_is_acked_and_dropped(self):
+        conn = FakeConn()
+        conn.REDIS.streams["high"] = [("0-0", {})]
+        c = consumer(conn)
+        assert trio.run(c.get, 1) is None
+        assert conn.REDIS.acked == [("high", "0-0")]
+
+    @pytest.mark.p1
+    def test_stale_messages_are_reclaimed(self):
+        conn = FakeConn()
+        conn.REDIS.add("high", 1)
+        assert trio.run(consumer(conn, "dead").get, 1) is not None
+        conn.REDIS.now = 61000
+        msg = trio.run(consumer(conn, "live", reclaim_interval=0).get, 1)
+        assert msg.get_message() == {"queue": "high", "i": 0}
+        assert conn.REDIS.pending[("high", "0-0")][0] == "live"
+
+    @pytest.mark.p1
+    def test_refreshed_messages_are_not_reclaimed(self):
+        conn = FakeConn()
+        conn.REDIS.add("high", 3)
+        busy = consumer(conn, "busy")
+        msg = trio.run(busy.get, 2)
+        msg.ack()
+        other = consumer(conn, "other", reclaim_interval=0)
+        for now in range(30000, 300000, 30000):
+            conn.REDIS.now = now
+            trio.run(busy.refresh)
+            # The message `busy` holds in its buffer stays with it, however long it waits.
+            other._reclaim()
+            assert conn.REDIS.pending == {("high", "1-0"): ["busy", now]}
+        assert trio.run(busy.get, 1).get_msg_id() == "1-0"
+
+
+class FakeFlagStore:
+    def __init__(self):
+        self.keys = set()
+        self.reads = 0
+        self.published = []
+
+    def is_alive(self):
+        # No subscriber thread in tests.
+        return False
+
+    def mset(self, mapping, exp):
+        self.keys.update(mapping)
+
+    def publish(self, channel, message):
+        self.published.append(message)
+
+    def exists_many(self, keys):
+        self.reads += 1
+        return [k in self.keys for k in keys]
+
+
+class TestCancelFlags:
+    @pytest.mark.p1
+    def test_set_is_seen_without_reading_redis(self):
+        store = FakeFlagStore()
+        flags = CancelFlags(store)
+        flags.set(["t1", "t2"])
+        assert flags.is_set_many(["t1", "t2"]) == [True, True]
+        assert store.reads == 0
+        assert store.published == ["t1 t2"]
+
+    @pytest.mark.p1
+    def test_unset_flag_is_trusted_for_the_ttl(self):
+        store = FakeFlagStore()
+        flags = CancelFlags(store, ttl=3600)
+        assert not flags.is_set("t1")
+        # Set by another process whose message got lost.
+        store.keys.add(CancelFlags.key("t1"))
+        assert not flags.is_set("t1")
+        assert store.reads == 1
+
+    @pytest.mark.p2
+    def test_flag_set_elsewhere_is_read_after_the_ttl(self):
+        store = FakeFlagStore()
+        flags = CancelFlags(store, ttl=0)
+        assert not flags.is_set("t1")
+        store.keys.add(CancelFlags.key("t1"))
+        assert trio.run(flags.async_is_set, "t1")
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def set(self, k, v, exp):
+        self.commands.append(lambda: self.redis.data.__setitem__(k, v))
+
+    def exists(self, k):
+        self.commands.append(lambda: int(k in self.redis.data))
+
+    def execute(self):
+        if self.redis.down:
+            raise ConnectionError("redis is down")
+        self.redis.round_trips += 1
+        return [c() for c in self.commands]
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+        self.round_trips = 0
+        self.down = False
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+@pytest.fixture
+def redis_db(monkeypatch):
+    # A fresh instance rather than the process-wide singleton; reconnecting would replace the fake client.
+    db = type(REDIS_CONN)()
+    db.REDIS = FakeRedis()
+    monkeypatch.setattr(db, "__open__", lambda: None)
+    return db
+
+
+class TestPipelinedBatches:
+    @pytest.mark.p1
+    def test_one_round_trip_per_batch(self, redis_db):
+        assert redis_db.mset({"a": "1", "b": "2"})
+        assert redis_db.exists_many(["a", "x", "b"]) == [True, False, True]
+        assert redis_db.REDIS.round_trips == 2
+
+    @pytest.mark.p2
+    def test_failures_answer_the_defaults(self, redis_db):
+        redis_db.REDIS.down = True
+        assert not redis_db.mset({"a": "1"})
+        assert redis_db.exists_many(["a", "b"]) == [False, False]
+        assert trio.run(redis_db.async_exists_many, ["a"]) == [False]
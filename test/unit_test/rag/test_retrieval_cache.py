@@ -0,0 +1,116 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import pytest
+
+from rag.utils import retrieval_cache
+from rag.utils.retrieval_cache import get_retrieval_cache, invalidates_kb, kb_settling_key, retrieval_cache_key, set_retrieval_cache
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+
+    def is_alive(self):
+        return True
+
+    def get(self, k):
+        return self.data.get(k)
+
+    def set(self, k, v, exp=3600):
+        self.data[k] = v
+        return True
+
+    def mget(self, keys):
+        return [self.data.get(k) for k in keys]
+
+    def incr(self, k):
+        self.data[k] = str(int(self.data.get(k, 0)) + 1)
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    r = FakeRedis()
+    monkeypatch.setattr(retrieval_cache, "REDIS_CONN", r)
+    return r
+
+
+class DocStore:
+    def __init__(self):
+        self.writes = 0
+
+    @invalidates_kb
+    def insert(self, documents, indexName, knowledgebaseId=None):
+        self.writes += 1
+        return []
+
+    @invalidates_kb
+    def delete(self, condition, indexName, knowledgebaseId):
+        raise ConnectionError("document store is down")
+
+
+def settle(redis, kb_id):
+    """What the expiry of the settling key does after RETRIEVAL_CACHE_SETTLE seconds."""
+    redis.data.pop(kb_settling_key(kb_id), None)
+
+
+def key(question="What is RAGFlow?", kb_ids=("kb1",), **params):
+    return retrieval_cache_key(question, ["t1"], list(kb_ids), None, None, None, top=1024, **params)
+
+
+class TestRetrievalCache:
+    @pytest.mark.p1
+    def test_round_trip(self, redis):
+        k = key()
+        set_retrieval_cache(k, {"total": 1, "chunks": [{"chunk_id": "c1", "similarity": 0.5}]})
+        assert get_retrieval_cache(key())["chunks"][0]["chunk_id"] == "c1"
+
+    @pytest.mark.p1
+    def test_question_is_normalized(self, redis):
+        assert key("  what is  RAGFlow? ") == key("What is RAGFlow?")
+        assert key("What is RAGFlow?", kb_ids=("kb1", "kb2")) == key("What is RAGFlow?", kb_ids=("kb2", "kb1"))
+        assert key(similarity=0.2) != key(similarity=0.3)
+
+    @pytest.mark.p1
+    def test_write_invalidates_only_its_knowledge_base(self, redis):
+        k1, k2 = key(kb_ids=("kb1",)), key(kb_ids=("kb2",))
+        DocStore().insert([], "ragflow_t1", "kb1")
+        settle(redis, "kb1")
+        assert key(kb_ids=("kb1",)) != k1
+        assert key(kb_ids=("kb2",)) == k2
+
+    @pytest.mark.p1
+    def test_not_cached_until_the_write_is_searchable(self, redis):
+        DocStore().insert([], "ragflow_t1", knowledgebaseId="kb1")
+        # The index has not refreshed yet: nothing may be cached under the new generation.
+        assert key(kb_ids=("kb1",)) is None
+        assert key(kb_ids=("kb1", "kb2")) is None
+        assert key(kb_ids=("kb2",)) is not None
+        settle(redis, "kb1")
+        assert key(kb_ids=("kb1",)) is not None
+
+    @pytest.mark.p2
+    def test_failed_write_still_invalidates(self, redis):
+        k = key()
+        with pytest.raises(ConnectionError):
+            DocStore().delete({"id": ["c1"]}, "ragflow_t1", "kb1")
+        settle(redis, "kb1")
+        assert key() != k
+
+    @pytest.mark.p2
+    def test_disabled_without_ttl(self, redis, monkeypatch):
+        monkeypatch.setattr(retrieval_cache, "RETRIEVAL_CACHE_TTL", 0)
+        assert key() is None
+        assert get_retrieval_cache(None) is None
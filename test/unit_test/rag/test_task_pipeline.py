@@ -0,0 +1,99 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import pytest
+import trio
+
+from rag.svr import task_executor
+from rag.svr.task_executor import pipeline_batches, run_pipeline
+
+
+class TestPipelineBatches:
+    @pytest.mark.p1
+    def test_batches_drop_items(self):
+        items = list(range(10))
+        batches = pipeline_batches(items, 4)
+        assert next(batches) == [0, 1, 2, 3]
+        assert items == [4, 5, 6, 7, 8, 9]
+        assert list(batches) == [[4, 5, 6, 7], [8, 9]]
+        assert items == []
+
+
+class TestRunPipeline:
+    @pytest.mark.p1
+    def test_every_batch_goes_through_every_stage_in_order(self):
+        seen = []
+
+        async def double(batch):
+            return [x * 2 for x in batch]
+
+        async def record(batch):
+            seen.extend(batch)
+            return batch
+
+        stats = {}
+        completed = trio.run(run_pipeline, pipeline_batches(list(range(7)), 3),
+                             [("double", double), ("record", record)], stats)
+        assert completed
+        assert seen == [0, 2, 4, 6, 8, 10, 12]
+        assert stats["double"]["batches"] == 3
+        assert stats["record"]["chunks"] == 7
+
+    @pytest.mark.p2
+    def test_stages_overlap_within_queue_depth(self, monkeypatch):
+        monkeypatch.setattr(task_executor, "PIPELINE_QUEUE_DEPTH", 1)
+        pulled = []
+        inserted = []
+
+        def batches():
+            for i in range(6):
+                pulled.append(i)
+                yield [i]
+
+        async def slow_insert(batch):
+            inserted.extend(batch)
+            # The source may only run ahead of the slow stage by the channel buffers.
+            assert len(pulled) - len(inserted) <= 3
+            await trio.sleep(0.01)
+            return batch
+
+        assert trio.run(run_pipeline, batches(), [("insert", slow_insert)])
+        assert inserted == list(range(6))
+
+    @pytest.mark.p1
+    def test_stage_returning_none_aborts(self):
+        reached = []
+
+        async def cancel_on_second(batch):
+            return None if batch == [1] else batch
+
+        async def record(batch):
+            reached.extend(batch)
+            return batch
+
+        completed = trio.run(run_pipeline, pipeline_batches(list(range(5)), 1),
+                             [("cancel", cancel_on_second), ("record", record)])
+        assert not completed
+        assert 1 not in reached
+        assert 4 not in reached
+
+    @pytest.mark.p1
+    def test_stage_exception_propagates(self):
+        async def fail(batch):
+            raise ValueError("insert failed")
+
+        with pytest.raises(Exception) as e:
+            trio.run(run_pipeline, pipeline_batches(list(range(3)), 1), [("insert", fail)])
+        assert "insert failed" in repr(e.value)
@@ -0,0 +1,98 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from rag.nlp import rag_tokenizer, tokenize, tokenize_batch, tokenizer_pool
+from rag.nlp.tokenizer_pool import get_pool, shutdown_pool, tokenize_texts
+
+TEXTS = [
+    "检索增强生成把文档切成片段",
+    "<table><caption>季度收入</caption><tr><td>2024年</td><td>1200万</td></tr></table>",
+    "检索增强生成把文档切成片段",
+    "长江大桥，全长6772米。",
+    "",
+]
+
+
+class BrokenPool:
+    def map(self, fn, *iterables):
+        raise BrokenProcessPool("a worker died")
+
+    def shutdown(self, cancel_futures=False):
+        pass
+
+
+@pytest.fixture
+def no_min_chunks(monkeypatch):
+    monkeypatch.setattr(tokenizer_pool, "TOKENIZER_PARALLEL_MIN_CHUNKS", 0)
+    monkeypatch.setattr(tokenizer_pool, "TOKENIZER_POOL_SLICE", 2)
+    yield
+    shutdown_pool()
+
+
+def expected():
+    docs = []
+    for t in TEXTS:
+        d = {"docnm_kwd": "doc"}
+        tokenize(d, t, False)
+        docs.append(d)
+    return docs
+
+
+def tokenized(texts):
+    return [(rag_tokenizer.tokenize(t), rag_tokenizer.fine_grained_tokenize(rag_tokenizer.tokenize(t))) for t in texts]
+
+
+class TestTokenizeBatch:
+    @pytest.mark.p1
+    def test_matches_tokenize(self):
+        docs = [{"docnm_kwd": "doc"} for _ in TEXTS]
+        tokenize_batch(docs, TEXTS, False)
+        for d, e in zip(docs, expected()):
+            assert d.keys() == e.keys()
+            for k in e:
+                assert d[k] == e[k], k
+
+    @pytest.mark.p1
+    def test_pool_matches_tokenize(self, no_min_chunks, monkeypatch):
+        monkeypatch.setattr(tokenizer_pool, "TOKENIZER_PROCESSES", 2)
+        docs = [{"docnm_kwd": "doc"} for _ in TEXTS]
+        tokenize_batch(docs, TEXTS, False)
+        assert tokenizer_pool._pool is not None
+        for d, e in zip(docs, expected()):
+            assert d == e
+
+
+class TestTokenizeTexts:
+    @pytest.mark.p1
+    def test_no_pool_unless_processes_are_set(self):
+        assert get_pool(0) is None
+        assert tokenize_texts(TEXTS, 0) == tokenized(TEXTS)
+
+    @pytest.mark.p2
+    def test_small_batches_stay_in_process(self, monkeypatch):
+        monkeypatch.setattr(tokenizer_pool, "get_pool", lambda processes=None: pytest.fail("the pool was asked for"))
+        assert len(tokenize_texts(TEXTS, 2)) == len(TEXTS)
+
+    @pytest.mark.p1
+    def test_falls_back_in_process_when_the_pool_fails(self, no_min_chunks, monkeypatch):
+        monkeypatch.setattr(tokenizer_pool, "_pool", BrokenPool())
+        res = tokenize_texts(TEXTS, 2)
+        assert res == tokenized(TEXTS)
+        # The broken pool is dropped, for the next batch to start a new one.
+        assert tokenizer_pool._pool is None